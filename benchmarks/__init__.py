@@ -0,0 +1,4 @@
+"""
+Benchmarks sin conexión del Módulo de Encuestas
+(BigQuery y FCM reemplazados por dobles locales)
+"""
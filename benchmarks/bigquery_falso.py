@@ -0,0 +1,357 @@
+"""
+Doble en memoria del subconjunto de bigquery.Client que usa main.py:
+query con parámetros (incluido el MERGE de estados), load_table_from_json,
+insert_rows_json y get_table.
+
+No interpreta SQL: cada consulta se resuelve según la etiqueta `operacion`
+que pone ejecutar_consulta(), con un manejador Python por operación.
+"""
+
+from datetime import datetime
+from types import SimpleNamespace
+from google.cloud import bigquery
+import threading
+import time
+import zlib
+
+# Columnas TIMESTAMP que llegan como texto ISO en las cargas
+CAMPOS_FECHA = ("fecha_programada", "fecha_creacion", "fecha_limite", "fecha_envio", "fecha_fin")
+
+# Columnas de encuestas_solicitudes que se leen como Solicitud en main.py
+COLUMNAS_SOLICITUD = ("encuesta_id", "cliente_rol", "instalacion_rol", "modo", "email_destinatario",
+                      "estado", "fecha_creacion", "fecha_limite")
+
+
+class ResultadoFalso:
+    """Imita RowIterator: iterable, con .pages, .total_rows y .schema"""
+
+    def __init__(self, filas, tamano_pagina, latencia_pagina):
+        self.filas = [fila_bigquery(f) for f in filas]
+        self.tamano_pagina = tamano_pagina or max(len(self.filas), 1)
+        self.latencia_pagina = latencia_pagina
+        self.total_rows = len(self.filas)
+        self.schema = []
+
+    def __iter__(self):
+        for pagina in self.pages:
+            yield from pagina
+
+    @property
+    def pages(self):
+        for inicio in range(0, len(self.filas), self.tamano_pagina):
+            if inicio and self.latencia_pagina:
+                time.sleep(self.latencia_pagina)
+            yield iter(self.filas[inicio:inicio + self.tamano_pagina])
+
+
+class TrabajoFalso:
+    """Imita QueryJob / LoadJob ya terminado"""
+
+    def __init__(self, filas=(), latencia_pagina=0.0):
+        self._filas = list(filas)
+        self._latencia_pagina = latencia_pagina
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.slot_millis = 0
+        self.job_id = f"falso-{time.monotonic_ns()}"
+
+    def result(self, page_size=None, **kwargs):
+        return ResultadoFalso(self._filas, page_size, self._latencia_pagina)
+
+
+class ClienteBigQueryFalso:
+    """
+    Tablas en memoria y manejadores por operación. latencia_job simula el
+    tiempo de ida y vuelta de cada job; latencia_pagina el de cada página
+    adicional del resultado.
+    """
+
+    # Se fijan antes de importar main (que crea su cliente al importarse)
+    latencia_job = 0.0
+    latencia_pagina = 0.0
+
+    def __init__(self, project=None, **kwargs):
+        self.project = project
+        self.tablas = {}
+        self.miembros = []
+        self.configuracion = None
+        self.jobs = {}
+        self._notificaciones_por_id = {}
+        self._lock = threading.Lock()
+
+    # ---------- API de bigquery.Client ----------
+
+    def query(self, query, job_config=None, **kwargs):
+        operacion = (job_config.labels or {}).get("operacion") if job_config else None
+        manejador = getattr(self, f"_op_{operacion}", None)
+        if manejador is None:
+            raise NotImplementedError(f"Consulta sin manejador en el doble: {operacion}")
+        parametros = leer_parametros(job_config.query_parameters)
+        self._contar(operacion)
+        with self._lock:
+            filas = manejador(parametros)
+        return TrabajoFalso(filas, self.latencia_pagina)
+
+    def load_table_from_json(self, filas, tabla, job_config=None, **kwargs):
+        self._contar("carga")
+        self._agregar(tabla, filas)
+        return TrabajoFalso()
+
+    def insert_rows_json(self, tabla, filas, row_ids=None, **kwargs):
+        self._contar("streaming")
+        self._agregar(tabla, filas)
+        return []
+
+    def get_table(self, tabla):
+        return SimpleNamespace(schema=[], table_id=str(tabla).split(".")[-1])
+
+    # ---------- Datos ----------
+
+    def tabla(self, nombre):
+        """Filas de la tabla cuyo id termina en `nombre`"""
+        return self.tablas.setdefault(nombre, [])
+
+    def total_jobs(self):
+        return sum(self.jobs.values())
+
+    def _contar(self, operacion):
+        time.sleep(self.latencia_job)
+        with self._lock:
+            self.jobs[operacion] = self.jobs.get(operacion, 0) + 1
+
+    def _agregar(self, tabla, filas):
+        nombre = str(tabla).split(".")[-1]
+        nuevas = [leer_fechas(dict(f)) for f in filas]
+        with self._lock:
+            self.tabla(nombre).extend(nuevas)
+            if nombre == "encuestas_notificaciones_programadas":
+                for fila in nuevas:
+                    self._notificaciones_por_id[fila["notificacion_id"]] = fila
+
+    # ---------- Manejadores por operación ----------
+
+    def _op_configuracion(self, p):
+        return [self.configuracion]
+
+    def _op_preguntas(self, p):
+        preguntas = [
+            {
+                **{k: f[k] for k in ("pregunta_id", "orden", "texto", "tipo")},
+                "permite_comentario": bool(f.get("permite_comentario")),
+            }
+            for f in self.tabla("encuestas_preguntas") if f.get("activo", True)
+        ]
+        return sorted(preguntas, key=lambda f: f["orden"])
+
+    def _op_feriados(self, p):
+        return [{"fecha": f["fecha"]} for f in self.tabla("encuestas_feriados")]
+
+    def _op_generacion_instalaciones(self, p):
+        n = p["shard_count"]
+        return [
+            m for m in self.miembros
+            if zlib.crc32(f"{m['cliente_rol']}|{m['instalacion_rol']}".encode()) % n == p["shard_index"]
+        ]
+
+    def _op_generacion_terminadas(self, p):
+        vistas = {
+            (f["cliente_rol"], f["instalacion_rol"])
+            for f in self.tabla("encuestas_generacion_progreso") if f["periodo"] == p["periodo"]
+        }
+        return [{"cliente_rol": c, "instalacion_rol": i} for c, i in vistas]
+
+    def _op_generacion_existentes(self, p):
+        return [
+            {k: f[k] for k in ("encuesta_id", "cliente_rol", "instalacion_rol", "modo", "email_destinatario")}
+            for f in self.tabla("encuestas_solicitudes") if f["periodo"] == p["periodo"]
+        ]
+
+    def _op_generacion_notificaciones_existentes(self, p):
+        ids = set(p["encuesta_ids"])
+        return [
+            {k: f[k] for k in ("encuesta_id", "email_destinatario", "tipo")}
+            for f in self.tabla("encuestas_notificaciones_programadas") if f["encuesta_id"] in ids
+        ]
+
+    def _pendientes(self, p):
+        tokens = {u["email_login"]: u["fcm_token"] for u in self.tabla("usuarios_app") if u["fcm_token"]}
+        desde = (p["desde_fecha"], p["desde_email"], p["desde_id"]) if "desde_fecha" in p else None
+        orden = lambda f: (f["fecha_programada"], f["email_destinatario"] or "", f["notificacion_id"])
+        filas = [
+            f for f in self.tabla("encuestas_notificaciones_programadas")
+            if f["estado"] == "pendiente"
+            and f.get("plantilla_id") is not None
+            and p["desde_ventana"] <= f["fecha_programada"] <= p["ahora_utc"]
+            and (desde is None or orden(f) > desde)
+        ]
+        filas.sort(key=orden)
+        return filas, tokens
+
+    def _op_envio_pendientes(self, p):
+        filas, tokens = self._pendientes(p)
+        if p.get("limite"):
+            filas = filas[:p["limite"]]
+        columnas = ("notificacion_id", "plantilla_id", "encuesta_id", "tipo",
+                    "instalacion_rol", "email_destinatario", "fecha_programada")
+        return [
+            {
+                **{k: f[k] for k in columnas},
+                "intentos": f.get("intentos") or 0,
+                "topico": f.get("topico"),
+                "fcm_token": tokens.get(f["email_destinatario"]),
+            }
+            for f in filas
+        ]
+
+    def _op_envio_conteo(self, p):
+        filas, _ = self._pendientes(p)
+        return [{"restantes": len(filas)}]
+
+    def _op_envio_estados(self, p):
+        for estado in p["estados"]:
+            fila = self._notificaciones_por_id.get(estado["notificacion_id"])
+            if fila is None:
+                continue
+            fila["estado"] = estado["estado"]
+            fila["intentos"] = estado["intentos"]
+            if estado["estado"] == "pendiente":
+                fila["fecha_programada"] = estado["fecha_programada"]
+            if estado["estado"] == "enviada":
+                fila["fecha_envio"] = estado["fecha_envio"]
+            else:
+                fila["error_mensaje"] = estado["error_mensaje"]
+        return []
+
+    def _op_topicos_diferencias(self, p):
+        tokens = {u["email_login"]: u["fcm_token"] for u in self.tabla("usuarios_app") if u["fcm_token"]}
+        deseadas = {
+            (tokens[m["email_login"]], m["cliente_rol"], m["instalacion_rol"])
+            for m in self.miembros
+            if not m["requiere_individual"] and m["email_login"] in tokens
+        }
+        registradas = {
+            (s["fcm_token"], s["cliente_rol"], s["instalacion_rol"])
+            for s in self.tabla("encuestas_suscripciones_topico")
+        }
+        diferencias = [(c, i, "alta", t) for t, c, i in deseadas - registradas]
+        diferencias += [(c, i, "baja", t) for t, c, i in registradas - deseadas]
+        return [
+            {"fcm_token": t, "cliente_rol": c, "instalacion_rol": i, "accion": a}
+            for c, i, a, t in sorted(diferencias)
+        ]
+
+    def _op_topicos_bajas(self, p):
+        bajas = {(b["fcm_token"], b["cliente_rol"], b["instalacion_rol"]) for b in p["bajas"]}
+        self.tablas["encuestas_suscripciones_topico"] = [
+            s for s in self.tabla("encuestas_suscripciones_topico")
+            if (s["fcm_token"], s["cliente_rol"], s["instalacion_rol"]) not in bajas
+        ]
+        return []
+
+    def _op_respuestas_solicitud(self, p):
+        return [
+            {k: f[k] for k in COLUMNAS_SOLICITUD}
+            for f in self.tabla("encuestas_solicitudes")
+            if f["encuesta_id"] == p["encuesta_id"] and f["fecha_creacion"] >= p["desde"]
+        ][:1]
+
+    def _op_respuestas_miembro(self, p):
+        activos = {u["email_login"].lower() for u in self.tabla("usuarios_app") if u.get("activo", True)}
+        es_miembro = any(
+            m["email_login"].lower() == p["email"] and m["email_login"].lower() in activos
+            and (m["cliente_rol"], m["instalacion_rol"]) == (p["cliente_rol"], p["instalacion_rol"])
+            and not m["requiere_individual"]
+            for m in self.miembros
+        )
+        return [{"es_miembro": es_miembro}]
+
+    def _op_respuestas_completar(self, p):
+        respondidas = {r["encuesta_id"]: r for r in p["respondidas"]}
+        for fila in self.tabla("encuestas_solicitudes"):
+            r = respondidas.get(fila["encuesta_id"])
+            if r and fila["estado"] == "pendiente" and fila["fecha_creacion"] >= p["desde"]:
+                fila.update(
+                    estado="completada",
+                    respondido_por_email=r["email_login"],
+                    respondido_por_nombre=r["nombre"],
+                    fecha_respuesta=r["fecha_respuesta"],
+                )
+        # Solo las filas de la respuesta que quedó en su solicitud, sin repetir respuesta_id
+        ganadoras = {
+            f["encuesta_id"]: (f.get("respondido_por_email"), f.get("fecha_respuesta"))
+            for f in self.tabla("encuestas_solicitudes") if f["encuesta_id"] in respondidas
+        }
+        escritas = {f["respuesta_id"] for f in self.tabla("encuestas_respuestas")}
+        nuevas = [
+            dict(f) for f in p["filas"]
+            if ganadoras.get(f["encuesta_id"]) == (f["email_login"], f["fecha_respuesta"])
+            and f["respuesta_id"] not in escritas
+        ]
+        self.tabla("encuestas_respuestas").extend(nuevas)
+        return [{"filas_insertadas": len(nuevas)}]
+
+    def _solicitudes_periodo(self, p):
+        return [
+            f for f in self.tabla("encuestas_solicitudes")
+            if f["periodo"] == p["periodo"] and f["fecha_creacion"] >= p["inicio_periodo"]
+        ]
+
+    def _op_pendientes_carga(self, p):
+        return [
+            {k: f[k] for k in COLUMNAS_SOLICITUD}
+            for f in self._solicitudes_periodo(p)
+            if f["estado"] == "pendiente" and f["fecha_limite"] > p["ahora"]
+        ]
+
+    def _op_pendientes_cambios(self, p):
+        return [
+            {k: f[k] for k in COLUMNAS_SOLICITUD}
+            for f in self._solicitudes_periodo(p)
+            if f["fecha_creacion"] >= p["desde"]
+            or (f.get("fecha_respuesta") is not None and f["fecha_respuesta"] >= p["desde"])
+        ]
+
+    def _op_pendientes_miembros(self, p):
+        activos = {u["email_login"] for u in self.tabla("usuarios_app") if u.get("activo", True)}
+        return [
+            {"email": m["email_login"].lower(), "cliente_rol": m["cliente_rol"],
+             "instalacion_rol": m["instalacion_rol"]}
+            for m in self.miembros
+            if not m["requiere_individual"] and m["email_login"] in activos
+        ]
+
+    def _op_envio_tokens_invalidos(self, p):
+        tokens = set(p["tokens"])
+        for usuario in self.tabla("usuarios_app"):
+            if usuario["fcm_token"] in tokens:
+                usuario["fcm_token"] = None
+        return []
+
+
+def leer_parametros(parametros):
+    """{nombre: valor} de los parámetros de un QueryJobConfig"""
+    valores = {}
+    for parametro in parametros or ():
+        if isinstance(parametro, bigquery.ArrayQueryParameter):
+            valores[parametro.name] = [
+                v.struct_values if isinstance(v, bigquery.StructQueryParameter) else v
+                for v in parametro.values
+            ]
+        else:
+            valores[parametro.name] = parametro.value
+    return valores
+
+
+def leer_fechas(fila):
+    """Convierte a datetime las columnas de fecha que llegan como texto ISO"""
+    for campo in CAMPOS_FECHA:
+        if isinstance(fila.get(campo), str):
+            fila[campo] = datetime.fromisoformat(fila[campo])
+    return fila
+
+
+def fila_bigquery(fila):
+    """dict -> bigquery.Row (acceso por atributo y por clave, como las filas reales)"""
+    if isinstance(fila, bigquery.Row):
+        return fila
+    return bigquery.Row(tuple(fila.values()), {k: i for i, k in enumerate(fila)})
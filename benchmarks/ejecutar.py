@@ -0,0 +1,95 @@
+"""
+Ejecuta los escenarios de benchmark y muestra tiempo, jobs de BigQuery,
+llamadas HTTP a FCM, memoria pico y filas por segundo de cada endpoint.
+
+Uso (desde la raíz del proyecto):
+    python -m benchmarks.ejecutar
+    python -m benchmarks.ejecutar --instalaciones 100 1000 --latencia-bq 0.1
+    python -m benchmarks.ejecutar --tasa-no-disponible 0.01 --json resultados.json
+    python -m benchmarks.ejecutar --por-topico
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+
+from benchmarks.escenarios import correr_escenario
+from benchmarks.fcm_local import ServidorFCMLocal
+
+
+def leer_argumentos():
+    parser = argparse.ArgumentParser(description="Benchmarks sin conexión de generación y envío")
+    parser.add_argument("--instalaciones", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--usuarios-por-instalacion", type=int, default=5)
+    parser.add_argument("--latencia-bq", type=float, default=0.05,
+                        help="segundos por job de BigQuery")
+    parser.add_argument("--latencia-pagina-bq", type=float, default=0.01,
+                        help="segundos por página adicional de resultados")
+    parser.add_argument("--latencia-fcm", type=float, default=0.005,
+                        help="segundos por request a FCM")
+    parser.add_argument("--tasa-no-disponible", type=float, default=0.0,
+                        help="fracción de requests FCM que responden 503")
+    parser.add_argument("--tasa-token-invalido", type=float, default=0.0,
+                        help="fracción de requests FCM que responden 404 UNREGISTERED")
+    parser.add_argument("--por-topico", action="store_true",
+                        help="encuestas compartidas por tópico FCM (sincroniza suscripciones antes)")
+    parser.add_argument("--heap", action="store_true",
+                        help="medir también el heap de Python con tracemalloc (más lento)")
+    parser.add_argument("--json", help="guardar los resultados en este archivo")
+    return parser.parse_args()
+
+
+def imprimir_tabla(resultados):
+    columnas = ("instalaciones", "fase", "tiempo_s", "jobs_bigquery", "llamadas_http",
+                "rss_pico_mb", "filas", "filas_por_s")
+    print(" | ".join(f"{c:>13}" for c in columnas))
+    print("-" * (16 * len(columnas)))
+    for resultado in resultados:
+        for fase in resultado["fases"]:
+            fila = {"instalaciones": resultado["instalaciones"], **fase}
+            print(" | ".join(
+                f"{fila.get(c, 0):>13.2f}" if isinstance(fila.get(c), float) else f"{fila.get(c, '-'):>13}"
+                for c in columnas
+            ))
+
+
+def main():
+    args = leer_argumentos()
+    servidor = ServidorFCMLocal(
+        latencia=args.latencia_fcm,
+        tasa_no_disponible=args.tasa_no_disponible,
+        tasa_token_invalido=args.tasa_token_invalido,
+    ).iniciar()
+    contexto = multiprocessing.get_context("spawn")
+
+    resultados = []
+    try:
+        for instalaciones in args.instalaciones:
+            print(f"🏁 {instalaciones} instalaciones x {args.usuarios_por_instalacion} usuarios")
+            servidor.reiniciar_contadores()
+            with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as proceso:
+                resultado = proceso.submit(
+                    correr_escenario, instalaciones, args.usuarios_por_instalacion, servidor.url,
+                    args.latencia_bq, args.latencia_pagina_bq, args.heap,
+                    iid_url=servidor.url_iid if args.por_topico else None
+                ).result()
+            # La generación no llama a FCM: las llamadas son del envío y de Instance ID
+            llamadas = {"envio": servidor.llamadas, "topicos": servidor.llamadas_iid}
+            for fase in resultado["fases"]:
+                fase["llamadas_http"] = llamadas.get(fase["fase"], 0)
+            resultado["respuestas_fcm"] = dict(servidor.respuestas)
+            resultados.append(resultado)
+    finally:
+        servidor.detener()
+
+    print()
+    imprimir_tabla(resultados)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as archivo:
+            json.dump(resultados, archivo, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
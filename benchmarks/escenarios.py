@@ -0,0 +1,164 @@
+"""
+Escenarios de benchmark: datos sintéticos de instalaciones y usuarios, y
+la ejecución de generación + envío contra los dobles locales.
+
+Cada escenario corre en un proceso propio (ver ejecutar.py) para que la
+memoria pico y los cachés de main.py no se mezclen entre escenarios.
+"""
+
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import asyncio
+import io
+import os
+import random
+import resource
+import time
+import tracemalloc
+
+INSTALACIONES_POR_CLIENTE = 10
+
+
+def generar_fixtures(instalaciones, usuarios_por_instalacion, semilla=0,
+                     prob_individual=0.2, prob_token=0.85):
+    """Filas de usuario_instalaciones ⋈ usuarios_app y de usuarios_app"""
+    aleatorio = random.Random(semilla)
+    miembros = []
+    usuarios = []
+    for i in range(instalaciones):
+        cliente_rol = f"CLI{i // INSTALACIONES_POR_CLIENTE:05d}"
+        instalacion_rol = f"INST{i:06d}"
+        for j in range(usuarios_por_instalacion):
+            email = f"usuario{i:06d}_{j}@cliente.cl"
+            token = f"token-{i}-{j}" if aleatorio.random() < prob_token else None
+            usuarios.append({"email_login": email, "fcm_token": token, "activo": True})
+            miembros.append({
+                "cliente_rol": cliente_rol,
+                "instalacion_rol": instalacion_rol,
+                "email_login": email,
+                "fcm_token": token,
+                "requiere_individual": aleatorio.random() < prob_individual,
+            })
+    miembros.sort(key=lambda m: (m["cliente_rol"], m["instalacion_rol"]))
+    return miembros, usuarios
+
+
+CONFIGURACION_BENCHMARK = {
+    "dias_para_responder": 30,
+    "dia_recordatorio_1": 15,
+    "dia_recordatorio_2": 25,
+    "notificaciones_activas": True,
+    "horario_inicio": 0,
+    "horario_fin": 24,
+    "dias_laborales": [0, 1, 2, 3, 4, 5, 6],
+}
+
+
+def rss_pico_mb():
+    """Memoria residente máxima del proceso (Linux reporta KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def medir(cliente, fase, medir_heap):
+    """Contexto de medición: tiempo, jobs BigQuery y memoria de una fase"""
+    class Medicion:
+        def __enter__(self):
+            self.jobs = cliente.total_jobs()
+            if medir_heap:
+                tracemalloc.reset_peak()
+            self.inicio = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            self.resultado = {
+                "fase": fase,
+                "tiempo_s": time.perf_counter() - self.inicio,
+                "jobs_bigquery": cliente.total_jobs() - self.jobs,
+                "rss_pico_mb": rss_pico_mb(),
+            }
+            if medir_heap:
+                self.resultado["heap_pico_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            return False
+
+    return Medicion()
+
+
+def correr_escenario(instalaciones, usuarios_por_instalacion, fcm_url,
+                     latencia_bq=0.0, latencia_pagina_bq=0.0, medir_heap=False, semilla=0,
+                     iid_url=None):
+    """
+    Genera las encuestas del mes y luego drena todas las notificaciones
+    (dejadas vencidas) a través de los endpoints de main.py. Con iid_url
+    las compartidas van por tópico: antes se sincronizan las suscripciones.
+    """
+    os.environ["FCM_URL"] = fcm_url
+    if iid_url:
+        os.environ["IID_URL"] = iid_url
+        os.environ["ENVIO_POR_TOPICO"] = "true"
+
+    # main.py crea su cliente al importarse: se reemplaza la clase antes
+    from google.cloud import bigquery
+    from benchmarks.bigquery_falso import ClienteBigQueryFalso
+    ClienteBigQueryFalso.latencia_job = latencia_bq
+    ClienteBigQueryFalso.latencia_pagina = latencia_pagina_bq
+    bigquery.Client = ClienteBigQueryFalso
+
+    with redirect_stdout(io.StringIO()):
+        import main
+    cliente = main.client
+    cliente.configuracion = dict(CONFIGURACION_BENCHMARK)
+    cliente.miembros, cliente.tablas["usuarios_app"] = generar_fixtures(
+        instalaciones, usuarios_por_instalacion, semilla
+    )
+    main.proveedor_token_fcm._credenciales = SimpleNamespace(token="token-local", expiry=None)
+    rss_base = rss_pico_mb()
+    if medir_heap:
+        tracemalloc.start()
+
+    fases = []
+    registro = io.StringIO()
+    with redirect_stdout(registro):
+        # 0. Suscripciones a tópicos
+        if iid_url:
+            with medir(cliente, "topicos", medir_heap) as topicos:
+                resultado_topicos = asyncio.run(main.sincronizar_topicos(esperar=True))
+            topicos.resultado.update(filas=resultado_topicos["altas"])
+            fases.append(topicos.resultado)
+        
+        # 1. Generación
+        with medir(cliente, "generacion", medir_heap) as generacion:
+            resultado_generacion = asyncio.run(
+                main.generar_encuestas_mensuales(motor="python", esperar=True)
+            )
+
+        # 2. Todas las notificaciones quedan vencidas
+        vencida = datetime.now(main.pytz.UTC) - timedelta(minutes=1)
+        for notificacion in cliente.tabla("encuestas_notificaciones_programadas"):
+            notificacion["fecha_programada"] = vencida
+
+        # 3. Envío (drenado completo)
+        with medir(cliente, "envio", medir_heap) as envio:
+            resultado_envio = asyncio.run(
+                main.enviar_notificaciones_push(
+                    drenar=True, presupuesto_segundos=float("inf"), esperar=True
+                )
+            )
+
+    generacion.resultado.update(
+        filas=resultado_generacion["notificaciones_programadas"],
+        filas_por_s=resultado_generacion["notificaciones_programadas"] / generacion.resultado["tiempo_s"],
+    )
+    envio.resultado.update(
+        filas=resultado_envio["total"],
+        enviadas=resultado_envio["enviadas"],
+        fallidas=resultado_envio["fallidas"],
+        filas_por_s=resultado_envio["enviadas"] / envio.resultado["tiempo_s"],
+    )
+    return {
+        "instalaciones": instalaciones,
+        "usuarios": len(cliente.tabla("usuarios_app")),
+        "rss_base_mb": rss_base,
+        "fases": fases + [generacion.resultado, envio.resultado],
+        "jobs_por_operacion": dict(cliente.jobs),
+    }
@@ -0,0 +1,120 @@
+"""
+Servidor HTTP local que imita el endpoint FCM v1 (messages:send) con
+latencia y tasas de error configurables, y los batchAdd/batchRemove de
+Instance ID (siempre exitosos).
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+
+
+class ServidorFCMLocal:
+    """
+    Responde 200 con un message name, o con probabilidad:
+    - tasa_no_disponible: 503 con Retry-After (error transitorio)
+    - tasa_token_invalido: 404 UNREGISTERED (token muerto)
+    """
+
+    def __init__(self, latencia=0.0, tasa_no_disponible=0.0, tasa_token_invalido=0.0,
+                 retry_after=0.1, semilla=0):
+        self.latencia = latencia
+        self.tasa_no_disponible = tasa_no_disponible
+        self.tasa_token_invalido = tasa_token_invalido
+        self.retry_after = retry_after
+        self.llamadas = 0
+        self.llamadas_iid = 0
+        self.respuestas = {}
+        self._aleatorio = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", 0), self._manejador())
+        self._servidor.daemon_threads = True
+        self._hilo = None
+
+    @property
+    def url(self):
+        host, puerto = self._servidor.server_address
+        return f"http://{host}:{puerto}/v1/projects/local/messages:send"
+
+    @property
+    def url_iid(self):
+        host, puerto = self._servidor.server_address
+        return f"http://{host}:{puerto}/iid/v1"
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._servidor.serve_forever, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            self.llamadas = 0
+            self.llamadas_iid = 0
+            self.respuestas = {}
+
+    def _responder_iid(self, cuerpo):
+        """Instance ID: un resultado vacío (éxito) por token"""
+        with self._lock:
+            self.llamadas_iid += 1
+        return 200, {}, {"results": [{} for _ in cuerpo.get("registration_tokens", [])]}
+
+    def _responder(self):
+        """(status, headers, cuerpo) de la próxima respuesta"""
+        with self._lock:
+            self.llamadas += 1
+            sorteo = self._aleatorio.random()
+        if sorteo < self.tasa_no_disponible:
+            return 503, {"Retry-After": str(self.retry_after)}, {
+                "error": {"code": 503, "status": "UNAVAILABLE", "message": "Servicio no disponible"}
+            }
+        if sorteo < self.tasa_no_disponible + self.tasa_token_invalido:
+            return 404, {}, {
+                "error": {
+                    "code": 404, "status": "NOT_FOUND",
+                    "message": "Requested entity was not found.",
+                    "details": [{
+                        "@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError",
+                        "errorCode": "UNREGISTERED",
+                    }],
+                }
+            }
+        return 200, {}, {"name": f"projects/local/messages/{time.monotonic_ns()}"}
+
+    def _manejador(self):
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                solicitud = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if servidor.latencia:
+                    time.sleep(servidor.latencia)
+                if self.path.startswith("/iid/"):
+                    status, headers, cuerpo = servidor._responder_iid(json.loads(solicitud))
+                else:
+                    status, headers, cuerpo = servidor._responder()
+                datos = json.dumps(cuerpo).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                for clave, valor in headers.items():
+                    self.send_header(clave, valor)
+                self.end_headers()
+                self.wfile.write(datos)
+                if self.path.startswith("/iid/"):
+                    return
+                with servidor._lock:
+                    servidor.respuestas[status] = servidor.respuestas.get(status, 0) + 1
+
+            def log_message(self, *args):
+                pass
+
+        return Manejador
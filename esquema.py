@@ -0,0 +1,378 @@
+"""
+Esquema de las tablas del Módulo de Encuestas
+Crea las tablas que faltan y migra las existentes (columnas nuevas,
+clustering y, con --recrear, particionado).
+
+Uso:
+    python esquema.py            # crea / migra sin reescribir datos
+    python esquema.py --recrear  # además recrea las tablas mal particionadas
+
+Las notificaciones programadas del formato antiguo (fcm_token, titulo,
+cuerpo, data) se completan con las columnas compactas en cada ejecución.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+import sys
+
+# ============================================
+# DEFINICIÓN DE TABLAS
+# ============================================
+
+C = bigquery.SchemaField
+
+
+@dataclass(frozen=True)
+class DefinicionTabla:
+    """Columnas, particionado (campo TIMESTAMP y DAY/MONTH) y clustering de una tabla"""
+    nombre: str
+    columnas: tuple
+    particion: Optional[str] = None
+    particion_tipo: str = bigquery.TimePartitioningType.DAY
+    clustering: tuple = ()
+
+    def expresion_particion(self):
+        """Expresión PARTITION BY equivalente, para el DDL de recreación"""
+        return f"TIMESTAMP_TRUNC({self.particion}, {self.particion_tipo})"
+
+
+TABLAS = (
+    DefinicionTabla(
+        nombre="usuarios_app",
+        columnas=(
+            C("email_login", "STRING", mode="REQUIRED"),
+            C("nombre", "STRING"),
+            C("fcm_token", "STRING"),
+            C("activo", "BOOL"),
+        ),
+        clustering=("email_login",),
+    ),
+    DefinicionTabla(
+        nombre="usuario_instalaciones",
+        columnas=(
+            C("email_login", "STRING", mode="REQUIRED"),
+            C("cliente_rol", "STRING", mode="REQUIRED"),
+            C("instalacion_rol", "STRING", mode="REQUIRED"),
+            C("puede_ver", "BOOL"),
+            C("requiere_encuesta_individual", "BOOL"),
+        ),
+        clustering=("cliente_rol", "instalacion_rol", "email_login"),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_configuracion",
+        columnas=(
+            C("id", "STRING"),
+            C("periodicidad_dias", "INT64"),
+            C("dia_generacion", "INT64"),
+            C("dias_para_responder", "INT64"),
+            C("dia_recordatorio_1", "INT64"),
+            C("dia_recordatorio_2", "INT64"),
+            C("notificaciones_activas", "BOOL"),
+            C("horario_inicio", "INT64"),
+            C("horario_fin", "INT64"),
+            C("dias_laborales", "INT64", mode="REPEATED"),
+            C("activo", "BOOL"),
+            C("fecha_actualizacion", "TIMESTAMP"),
+        ),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_preguntas",
+        columnas=(
+            C("pregunta_id", "STRING", mode="REQUIRED"),
+            C("orden", "INT64"),
+            C("texto", "STRING"),
+            C("tipo", "STRING"),            # "escala" (1-5) o "texto"
+            C("permite_comentario", "BOOL"),
+            C("activo", "BOOL"),
+        ),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_solicitudes",
+        columnas=(
+            C("encuesta_id", "STRING", mode="REQUIRED"),
+            C("periodo", "STRING"),
+            C("cliente_rol", "STRING"),
+            C("instalacion_rol", "STRING"),
+            C("modo", "STRING"),
+            C("email_destinatario", "STRING"),
+            C("estado", "STRING"),
+            C("fecha_creacion", "TIMESTAMP"),
+            C("fecha_limite", "TIMESTAMP"),
+            C("respondido_por_email", "STRING"),
+            C("respondido_por_nombre", "STRING"),
+            C("tipo_respuesta", "STRING"),
+            C("fecha_respuesta", "TIMESTAMP"),
+        ),
+        particion="fecha_creacion",
+        particion_tipo=bigquery.TimePartitioningType.MONTH,
+        clustering=("periodo", "cliente_rol", "instalacion_rol"),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_respuestas",
+        columnas=(
+            C("respuesta_id", "STRING", mode="REQUIRED"),
+            C("encuesta_id", "STRING"),
+            C("pregunta_id", "STRING"),
+            C("email_login", "STRING"),
+            C("valor", "INT64"),
+            C("comentario", "STRING"),
+            C("fecha_respuesta", "TIMESTAMP"),
+        ),
+        particion="fecha_respuesta",
+        particion_tipo=bigquery.TimePartitioningType.MONTH,
+        clustering=("encuesta_id",),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_notificaciones_programadas",
+        columnas=(
+            C("notificacion_id", "STRING", mode="REQUIRED"),
+            C("plantilla_id", "STRING"),
+            C("encuesta_id", "STRING"),
+            C("tipo", "STRING"),
+            C("instalacion_rol", "STRING"),
+            C("email_destinatario", "STRING"),
+            C("fecha_programada", "TIMESTAMP"),
+            C("estado", "STRING"),
+            C("intentos", "INT64"),
+            C("topico", "STRING"),
+            C("fecha_envio", "TIMESTAMP"),
+            C("error_mensaje", "STRING"),
+        ),
+        particion="fecha_programada",
+        clustering=("estado", "email_destinatario"),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_notificaciones_log",
+        columnas=(
+            C("log_id", "STRING", mode="REQUIRED"),
+            C("encuesta_id", "STRING"),
+            C("email_destinatario", "STRING"),
+            C("tipo_notificacion", "STRING"),
+            C("fecha_envio", "TIMESTAMP"),
+            C("estado", "STRING"),
+            C("error_mensaje", "STRING"),
+        ),
+        particion="fecha_envio",
+        clustering=("encuesta_id",),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_generacion_progreso",
+        columnas=(
+            C("periodo", "STRING"),
+            C("cliente_rol", "STRING"),
+            C("instalacion_rol", "STRING"),
+            C("shard_index", "INT64"),
+            C("shard_count", "INT64"),
+            C("fecha_fin", "TIMESTAMP"),
+        ),
+        particion="fecha_fin",
+        particion_tipo=bigquery.TimePartitioningType.MONTH,
+        clustering=("periodo", "cliente_rol", "instalacion_rol"),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_suscripciones_topico",
+        columnas=(
+            C("fcm_token", "STRING", mode="REQUIRED"),
+            C("cliente_rol", "STRING", mode="REQUIRED"),
+            C("instalacion_rol", "STRING", mode="REQUIRED"),
+            C("topico", "STRING"),
+            C("fecha_alta", "TIMESTAMP"),
+        ),
+        clustering=("cliente_rol", "instalacion_rol"),
+    ),
+    DefinicionTabla(
+        nombre="encuestas_feriados",
+        columnas=(
+            C("fecha", "DATE", mode="REQUIRED"),
+            C("descripcion", "STRING"),
+        ),
+    ),
+)
+
+
+# ============================================
+# PROVISIÓN
+# ============================================
+
+def provisionar_tablas(cliente, proyecto, dataset, recrear=False):
+    """Crea o migra cada tabla de TABLAS; devuelve {nombre: acción}"""
+    acciones = {}
+    for definicion in TABLAS:
+        tabla_id = f"{proyecto}.{dataset}.{definicion.nombre}"
+        try:
+            tabla = cliente.get_table(tabla_id)
+        except NotFound:
+            cliente.create_table(nueva_tabla(tabla_id, definicion))
+            print(f"✅ Creada {definicion.nombre}")
+            acciones[definicion.nombre] = "creada"
+            continue
+        acciones[definicion.nombre] = migrar_tabla(cliente, tabla, definicion, recrear)
+    return acciones
+
+
+def nueva_tabla(tabla_id, definicion):
+    """Objeto Table con el esquema, particionado y clustering de la definición"""
+    tabla = bigquery.Table(tabla_id, schema=list(definicion.columnas))
+    if definicion.particion:
+        tabla.time_partitioning = bigquery.TimePartitioning(
+            type_=definicion.particion_tipo, field=definicion.particion
+        )
+    if definicion.clustering:
+        tabla.clustering_fields = list(definicion.clustering)
+    return tabla
+
+
+def migrar_tabla(cliente, tabla, definicion, recrear):
+    """
+    Agrega columnas faltantes y ajusta el clustering en el lugar. El
+    particionado no se puede cambiar sin reescribir la tabla: solo con
+    recrear=True se copia a una tabla nueva y la original queda de respaldo.
+    """
+    cambios = []
+
+    existentes = {campo.name for campo in tabla.schema}
+    faltantes = [c for c in definicion.columnas if c.name not in existentes]
+    if faltantes:
+        # Las columnas agregadas a una tabla existente deben ser NULLABLE/REPEATED
+        tabla.schema = list(tabla.schema) + [
+            c if c.mode != "REQUIRED" else C(c.name, c.field_type) for c in faltantes
+        ]
+        tabla = cliente.update_table(tabla, ["schema"])
+        cambios.append(f"columnas {', '.join(c.name for c in faltantes)}")
+
+    if list(tabla.clustering_fields or []) != list(definicion.clustering):
+        tabla.clustering_fields = list(definicion.clustering) or None
+        tabla = cliente.update_table(tabla, ["clustering_fields"])
+        cambios.append("clustering")
+
+    particion_actual = tabla.time_partitioning
+    particion_ok = (
+        (definicion.particion is None and particion_actual is None)
+        or (particion_actual is not None
+            and particion_actual.field == definicion.particion
+            and particion_actual.type_ == definicion.particion_tipo)
+    )
+    if not particion_ok:
+        if recrear and definicion.particion:
+            recrear_particionada(cliente, tabla, definicion)
+            cambios.append("particionado (recreada)")
+        else:
+            print(f"⚠️ {definicion.nombre} no está particionada por "
+                  f"{definicion.particion} ({definicion.particion_tipo}); usar --recrear")
+
+    if cambios:
+        print(f"🔧 {definicion.nombre}: {'; '.join(cambios)}")
+        return "migrada: " + "; ".join(cambios)
+    print(f"✅ {definicion.nombre} al día")
+    return "sin cambios" if particion_ok else "particionado pendiente"
+
+
+def recrear_particionada(cliente, tabla, definicion):
+    """Copia la tabla con el particionado nuevo y deja la original como respaldo"""
+    base = f"{tabla.project}.{tabla.dataset_id}"
+    respaldo = f"{definicion.nombre}_respaldo_{datetime.now().strftime('%Y%m%d%H%M')}"
+    cluster = (
+        f"CLUSTER BY {', '.join(definicion.clustering)}" if definicion.clustering else ""
+    )
+    script = f"""
+    CREATE TABLE `{base}.{definicion.nombre}_nueva`
+    PARTITION BY {definicion.expresion_particion()}
+    {cluster}
+    AS SELECT * FROM `{base}.{definicion.nombre}`;
+
+    ALTER TABLE `{base}.{definicion.nombre}` RENAME TO `{respaldo}`;
+    ALTER TABLE `{base}.{definicion.nombre}_nueva` RENAME TO `{definicion.nombre}`;
+    """
+    cliente.query(script).result()
+    print(f"🔁 {definicion.nombre} recreada; respaldo en {respaldo}")
+
+
+# ============================================
+# NOTIFICACIONES DEL FORMATO ANTIGUO
+# ============================================
+
+# Plantillas equivalentes a los textos fijos del formato antiguo, por tipo
+PLANTILLAS_ANTIGUAS = {
+    "nueva": "encuesta_nueva_v1",
+    "recordatorio_1": "encuesta_recordatorio_1_v1",
+    "recordatorio_2": "encuesta_recordatorio_2_v1",
+}
+
+# Instalación dentro de los cuerpos antiguos (mismos textos que las plantillas v1)
+PATRON_INSTALACION = (
+    r"^(?:Tiene una nueva encuesta de satisfacción para |Recuerde completar la encuesta de "
+    r"|La encuesta de )(.*?)(?: vence pronto)?$"
+)
+
+
+def completar_notificaciones_antiguas(cliente, proyecto, dataset):
+    """
+    Llena plantilla_id, encuesta_id, tipo, instalacion_rol, intentos y (por
+    el token) email_destinatario en las filas escritas antes del formato
+    compacto, para que el envío las lea y la generación no las repita.
+    Devuelve las filas actualizadas (0 si la tabla no tiene el formato antiguo).
+    """
+    base = f"{proyecto}.{dataset}"
+    tabla = cliente.get_table(f"{base}.encuestas_notificaciones_programadas")
+    columnas = {campo.name for campo in tabla.schema}
+    if "data" not in columnas:
+        return 0
+
+    # Antes de email_destinatario solo estaba el token: se busca su usuario actual
+    if "fcm_token" in columnas:
+        email = "COALESCE(a.email_destinatario, u.email_login)"
+        cruce_tokens = f"""
+        LEFT JOIN (
+            SELECT fcm_token, ANY_VALUE(email_login) AS email_login
+            FROM `{base}.usuarios_app`
+            WHERE fcm_token IS NOT NULL AND fcm_token != ''
+            GROUP BY fcm_token
+        ) u ON a.fcm_token = u.fcm_token"""
+    else:
+        email, cruce_tokens = "a.email_destinatario", ""
+    casos_plantilla = " ".join(
+        f"WHEN '{tipo}' THEN '{plantilla_id}'" for tipo, plantilla_id in PLANTILLAS_ANTIGUAS.items()
+    )
+
+    query_completar = f"""
+    UPDATE `{base}.encuestas_notificaciones_programadas` n
+    SET plantilla_id = x.plantilla_id,
+        encuesta_id = x.encuesta_id,
+        tipo = x.tipo,
+        instalacion_rol = x.instalacion_rol,
+        email_destinatario = x.email_destinatario,
+        intentos = COALESCE(n.intentos, 0)
+    FROM (
+        SELECT
+            a.notificacion_id,
+            CASE JSON_VALUE(a.data, '$.tipo') {casos_plantilla} END AS plantilla_id,
+            COALESCE(a.encuesta_id, JSON_VALUE(a.data, '$.encuesta_id')) AS encuesta_id,
+            COALESCE(a.tipo, JSON_VALUE(a.data, '$.tipo')) AS tipo,
+            COALESCE(a.instalacion_rol, REGEXP_EXTRACT(a.cuerpo, r'{PATRON_INSTALACION}')) AS instalacion_rol,
+            {email} AS email_destinatario
+        FROM `{base}.encuestas_notificaciones_programadas` a{cruce_tokens}
+        WHERE a.plantilla_id IS NULL
+          AND a.data IS NOT NULL
+    ) x
+    WHERE n.notificacion_id = x.notificacion_id
+      AND n.plantilla_id IS NULL
+    """
+    job = cliente.query(query_completar)
+    job.result()
+    filas = job.num_dml_affected_rows or 0
+    print(f"🔧 encuestas_notificaciones_programadas: {filas} filas antiguas completadas")
+    return filas
+
+
+# ============================================
+# EJECUTAR
+# ============================================
+
+if __name__ == "__main__":
+    from main import client, PROJECT_ID, DATASET
+
+    provisionar_tablas(client, PROJECT_ID, DATASET, recrear="--recrear" in sys.argv)
+    completar_notificaciones_antiguas(client, PROJECT_ID, DATASET)
@@ -5,16 +5,49 @@ Proyecto: WFSA App
 
 from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
 from google.cloud import bigquery
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as hora_del_dia
+from typing import Optional, List
+from pydantic import BaseModel
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import uvicorn
+import asyncio
 import os
 import uuid
 import json
+import base64
+import gzip
+import threading
+import time
 import google.auth.transport.requests
 import requests
 import pytz
+import bisect
+import contextvars
+import itertools
+import hashlib
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from metricas import registro
+
+# Opcional: lectura de resultados grandes con la BigQuery Storage Read API
+# (pip install "google-cloud-bigquery[bqstorage]")
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
+# Opcional: snapshot del índice de pendientes en Cloud Storage
+# (pip install google-cloud-storage)
+try:
+    from google.cloud import storage
+except ImportError:
+    storage = None
 
 # ============================================
 # CONFIGURACIÓN
@@ -32,10 +65,118 @@ TABLE_ENCUESTAS_SOLICITUDES = f"{PROJECT_ID}.{DATASET}.encuestas_solicitudes"
 TABLE_ENCUESTAS_RESPUESTAS = f"{PROJECT_ID}.{DATASET}.encuestas_respuestas"
 TABLE_ENCUESTAS_NOTIF_PROG = f"{PROJECT_ID}.{DATASET}.encuestas_notificaciones_programadas"
 TABLE_ENCUESTAS_NOTIF_LOG = f"{PROJECT_ID}.{DATASET}.encuestas_notificaciones_log"
+TABLE_ENCUESTAS_GEN_PROGRESO = f"{PROJECT_ID}.{DATASET}.encuestas_generacion_progreso"
+TABLE_ENCUESTAS_FERIADOS = f"{PROJECT_ID}.{DATASET}.encuestas_feriados"
+TABLE_ENCUESTAS_SUSCRIPCIONES = f"{PROJECT_ID}.{DATASET}.encuestas_suscripciones_topico"
 
 # Cliente BigQuery
 client = bigquery.Client(project=PROJECT_ID)
 
+# Zona horaria de los horarios y días laborales de la configuración
+TZ_CHILE = pytz.timezone('America/Santiago')
+
+# Máximo de estados de notificación por MERGE
+TAMANO_LOTE_ESTADOS = int(os.getenv("TAMANO_LOTE_ESTADOS", "500"))
+
+# Envío FCM
+FCM_URL = os.getenv("FCM_URL", f"https://fcm.googleapis.com/v1/projects/{PROJECT_ID}/messages:send")
+FCM_CONCURRENCIA = int(os.getenv("FCM_CONCURRENCIA", "20"))
+FCM_MAX_REINTENTOS = int(os.getenv("FCM_MAX_REINTENTOS", "3"))
+FCM_TIMEOUT_SEGUNDOS = float(os.getenv("FCM_TIMEOUT_SEGUNDOS", "10"))
+FCM_MAX_ESPERA_SEGUNDOS = 60
+FCM_MARGEN_TOKEN_SEGUNDOS = int(os.getenv("FCM_MARGEN_TOKEN_SEGUNDOS", "300"))
+
+# Reintentos de notificaciones con error transitorio (429, 5xx, timeouts):
+# vuelven a quedar pendientes con backoff exponencial hasta el máximo de intentos
+NOTIFICACION_MAX_INTENTOS = int(os.getenv("NOTIFICACION_MAX_INTENTOS", "5"))
+NOTIFICACION_REINTENTO_BASE_SEGUNDOS = int(os.getenv("NOTIFICACION_REINTENTO_BASE_SEGUNDOS", "300"))
+NOTIFICACION_REINTENTO_MAX_SEGUNDOS = int(os.getenv("NOTIFICACION_REINTENTO_MAX_SEGUNDOS", "21600"))
+
+# Notificaciones vencidas del mismo dispositivo y tipo se envían como un
+# solo mensaje resumen (hasta NOTIFICACION_RESUMEN_MAX encuestas por mensaje)
+AGRUPAR_NOTIFICACIONES = os.getenv("AGRUPAR_NOTIFICACIONES", "true").lower() == "true"
+NOTIFICACION_RESUMEN_MAX = int(os.getenv("NOTIFICACION_RESUMEN_MAX", "50"))
+
+# Encuestas compartidas por tópico FCM: una notificación por instalación al
+# tópico al que están suscritos sus usuarios (ver /api/topicos/sincronizar)
+ENVIO_POR_TOPICO = os.getenv("ENVIO_POR_TOPICO", "false").lower() == "true"
+TOPICO_PREFIJO = "encuestas_instalacion_"
+IID_URL = os.getenv("IID_URL", "https://iid.googleapis.com/iid/v1")
+IID_LOTE_TOKENS = 1000  # máximo de tokens por batchAdd/batchRemove
+
+# Errores FCM que indican un token muerto: se borra de usuarios_app
+CODIGOS_TOKEN_INVALIDO = ("UNREGISTERED", "INVALID_ARGUMENT", "SENDER_ID_MISMATCH")
+
+# Drenado de notificaciones (debe quedar bajo el timeout de Cloud Run)
+TAMANO_PAGINA_DRENADO = int(os.getenv("TAMANO_PAGINA_DRENADO", "500"))
+PRESUPUESTO_DRENADO_SEGUNDOS = float(os.getenv("PRESUPUESTO_DRENADO_SEGUNDOS", "240"))
+
+# Días hacia atrás en que se buscan notificaciones pendientes (poda de particiones)
+VENTANA_PENDIENTES_DIAS = int(os.getenv("VENTANA_PENDIENTES_DIAS", "45"))
+
+# Trabajos en segundo plano
+TRABAJOS_MAX_CONCURRENTES = int(os.getenv("TRABAJOS_MAX_CONCURRENTES", "2"))
+TRABAJOS_HISTORIAL_MAX = 100
+# Trabajos entre instancias: lease por tipo y estado compartido en
+# gs://bucket/prefijo. Vacío: el solapamiento y /api/jobs son por instancia
+TRABAJOS_RUTA = os.getenv("TRABAJOS_RUTA", "").rstrip("/")
+TRABAJOS_LEASE_SEGUNDOS = float(os.getenv("TRABAJOS_LEASE_SEGUNDOS", "120"))
+TRABAJOS_SONDEO_SEGUNDOS = 2          # esperar=True sobre un trabajo de otra instancia
+TRABAJOS_PUBLICACION_SEGUNDOS = 10    # frecuencia máxima con que se publica el progreso
+
+# Escritura en BigQuery (límites por lote de carga)
+ESCRITURA_MAX_FILAS = int(os.getenv("ESCRITURA_MAX_FILAS", "20000"))
+ESCRITURA_MAX_BYTES = int(os.getenv("ESCRITURA_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# Segundos que se reutiliza la configuración activa
+CONFIG_TTL_SEGUNDOS = float(os.getenv("CONFIG_TTL_SEGUNDOS", "300"))
+
+# Motores de generación de encuestas
+MOTORES_GENERACION = ("python", "bigquery")
+
+# Instalaciones por lote escrito (y registrado como terminado) en la generación
+GENERACION_LOTE_INSTALACIONES = int(os.getenv("GENERACION_LOTE_INSTALACIONES", "200"))
+
+# Lectura de resultados por páginas (memoria acotada en la instancia)
+TAMANO_PAGINA_CONSULTA = int(os.getenv("TAMANO_PAGINA_CONSULTA", "5000"))
+USAR_STORAGE_API = os.getenv("USAR_STORAGE_API", "true").lower() == "true"
+STORAGE_API_UMBRAL_FILAS = int(os.getenv("STORAGE_API_UMBRAL_FILAS", "50000"))
+
+# Respuestas: se escriben en lotes de hasta RESPUESTAS_LOTE_MAX envíos o cada
+# RESPUESTAS_LOTE_SEGUNDOS, con un script (MERGE de solicitudes + INSERT) por lote
+RESPUESTAS_LOTE_MAX = int(os.getenv("RESPUESTAS_LOTE_MAX", "200"))
+RESPUESTAS_LOTE_SEGUNDOS = float(os.getenv("RESPUESTAS_LOTE_SEGUNDOS", "5"))
+# Un lote que falla vuelve a la cola y se reintenta con espera exponencial hasta este tope
+RESPUESTAS_REINTENTO_MAX_SEGUNDOS = float(os.getenv("RESPUESTAS_REINTENTO_MAX_SEGUNDOS", "30"))
+# Cloud Run da 10 s entre SIGTERM y SIGKILL: el vaciado al detenerse debe caber
+RESPUESTAS_CIERRE_SEGUNDOS = float(os.getenv("RESPUESTAS_CIERRE_SEGUNDOS", "8"))
+RESPUESTA_COMENTARIO_MAX = 2000
+ESCALA_RESPUESTA = range(1, 6)
+
+# Solicitudes que se pueden responder: antigüedad máxima y caché por encuesta_id
+# (una pendiente se relee pasado el TTL: otra instancia puede haberla completado)
+VENTANA_SOLICITUDES_DIAS = int(os.getenv("VENTANA_SOLICITUDES_DIAS", "90"))
+SOLICITUDES_CACHE_MAX = 50000
+SOLICITUDES_PENDIENTE_TTL_SEGUNDOS = float(os.getenv("SOLICITUDES_PENDIENTE_TTL_SEGUNDOS", "60"))
+
+# Miembros que responden la compartida de una instalación, fuera del índice de pendientes
+MIEMBROS_CACHE_TTL_SEGUNDOS = float(os.getenv("MIEMBROS_CACHE_TTL_SEGUNDOS", "300"))
+
+# Índice en memoria de encuestas pendientes del periodo: se actualiza con las
+# filas creadas o respondidas desde la última marca (menos un margen para
+# escrituras que se hacen visibles tarde)
+INDICE_REFRESCO_SEGUNDOS = float(os.getenv("INDICE_REFRESCO_SEGUNDOS", "30"))
+INDICE_MARGEN_SEGUNDOS = int(os.getenv("INDICE_MARGEN_SEGUNDOS", "900"))
+INDICE_MIEMBROS_SEGUNDOS = float(os.getenv("INDICE_MIEMBROS_SEGUNDOS", "600"))
+
+# Snapshot del índice compartido entre instancias: gs://bucket/objeto o un
+# volumen montado (el /tmp de Cloud Run es memoria de cada instancia y se
+# pierde con ella). Vacío lo desactiva. El tope es de JSON sin comprimir y se
+# mide contra la memoria de la instancia: el índice cargado ocupa ~3-4 veces eso
+INDICE_SNAPSHOT_RUTA = os.getenv("INDICE_SNAPSHOT_RUTA", "")
+INDICE_SNAPSHOT_SEGUNDOS = float(os.getenv("INDICE_SNAPSHOT_SEGUNDOS", "300"))
+INDICE_SNAPSHOT_MAX_BYTES = int(os.getenv("INDICE_SNAPSHOT_MAX_BYTES", str(32 * 1024 * 1024)))
+
 # ============================================
 # CREAR APLICACIÓN
 # ============================================
@@ -56,6 +197,62 @@ app.add_middleware(
 )
 
 
+# ============================================
+# MÉTRICAS Y LOGS
+# ============================================
+
+# Id del trabajo en curso; va en cada línea de log (lo fija correr_trabajo)
+_run_id = contextvars.ContextVar("run_id", default=None)
+
+metrica_bq_segundos = registro.histograma(
+    "encuestas_bigquery_segundos",
+    "Duración de llamadas a BigQuery: ejecucion (job hasta primer resultado), lectura (página) y carga",
+    ("operacion", "etapa"),
+)
+metrica_bq_jobs = registro.contador(
+    "encuestas_bigquery_jobs_total", "Jobs de BigQuery ejecutados", ("operacion",)
+)
+metrica_bq_bytes_procesados = registro.contador(
+    "encuestas_bigquery_bytes_procesados_total", "Bytes procesados por BigQuery", ("operacion",)
+)
+metrica_bq_bytes_facturados = registro.contador(
+    "encuestas_bigquery_bytes_facturados_total", "Bytes facturados por BigQuery", ("operacion",)
+)
+metrica_bq_slot_ms = registro.contador(
+    "encuestas_bigquery_slot_ms_total", "Milisegundos de slot consumidos", ("operacion",)
+)
+metrica_bq_filas_escritas = registro.contador(
+    "encuestas_bigquery_filas_escritas_total", "Filas escritas con load jobs", ("tabla",)
+)
+metrica_fcm_segundos = registro.histograma(
+    "encuestas_fcm_segundos", "Duración de cada request a FCM", ("status",)
+)
+metrica_notificaciones = registro.contador(
+    "encuestas_notificaciones_total",
+    "Notificaciones procesadas por resultado (enviada, reintento, fallida, token_invalido)",
+    ("resultado",),
+)
+metrica_etapa_segundos = registro.histograma(
+    "encuestas_etapa_segundos", "Duración de las etapas de generación y envío", ("etapa",)
+)
+metrica_pendientes_segundos = registro.histograma(
+    "encuestas_pendientes_consulta_segundos", "Duración de las consultas al índice de encuestas pendientes",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1),
+)
+metrica_trabajo_segundos = registro.histograma(
+    "encuestas_trabajo_segundos", "Duración total de los trabajos en segundo plano",
+    ("tipo", "estado"), buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+
+def log(mensaje, severidad=None, **campos):
+    """Línea de log JSON (formato de Cloud Logging) con el run_id del trabajo en curso"""
+    if severidad is None:
+        severidad = "ERROR" if mensaje.startswith("❌") else "WARNING" if mensaje.startswith("⚠️") else "INFO"
+    entrada = {"severity": severidad, "message": mensaje, "run_id": _run_id.get(), **campos}
+    print(json.dumps(entrada, ensure_ascii=False, default=str), flush=True)
+
+
 # ============================================
 # ENDPOINTS BÁSICOS
 # ============================================
@@ -74,185 +271,475 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Métricas de la instancia en formato de texto de Prometheus"""
+    return PlainTextResponse(registro.exponer(), media_type="text/plain; version=0.0.4")
+
+
 # ============================================
 # ENDPOINT 1: GENERAR ENCUESTAS MENSUALES
 # ============================================
 
 @app.post("/api/encuestas/generar-mensuales")
-async def generar_encuestas_mensuales():
+async def generar_encuestas_mensuales(motor: str = "python", dry_run: bool = False,
+                                      esperar: bool = False,
+                                      shard_index: int = 0, shard_count: int = 1):
     """
     Genera encuestas mensuales para todas las instalaciones.
     Se ejecuta automáticamente vía Cloud Scheduler el día 1 de cada mes.
+    
+    motor: "python" arma las filas en la API, "bigquery" las crea con un
+    script dentro de BigQuery. dry_run solo informa lo que se crearía.
+    Corre como trabajo en segundo plano; con esperar=true responde al terminar.
+    
+    shard_index/shard_count reparten las instalaciones por hash para
+    ejecutar varios shards en paralelo. Volver a ejecutar un periodo omite
+    las instalaciones terminadas y no duplica encuestas ni notificaciones.
     """
+    if motor not in MOTORES_GENERACION:
+        raise HTTPException(status_code=400, detail=f"Motor inválido: {motor}")
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise HTTPException(status_code=400, detail=f"Shard inválido: {shard_index}/{shard_count}")
+    
+    return await despachar_trabajo(
+        f"generar_encuestas:{shard_index}/{shard_count}", ejecutar_generacion, esperar,
+        motor=motor, dry_run=dry_run, shard_index=shard_index, shard_count=shard_count
+    )
+
+
+def ejecutar_generacion(motor="python", dry_run=False, shard_index=0, shard_count=1,
+                        reportar=None):
+    """Genera las encuestas del periodo (se ejecuta fuera del event loop)"""
     try:
         # 1. Obtener configuración activa
-        query_config = f"""
-        SELECT *
-        FROM `{TABLE_ENCUESTAS_CONFIG}`
-        WHERE activo = TRUE
-        LIMIT 1
-        """
-        config_result = list(client.query(query_config).result())
-        if not config_result:
-            raise HTTPException(status_code=400, detail="No hay configuración activa")
-        
-        config = dict(config_result[0])
+        config = obtener_configuracion()
         
         # 2. Periodo actual
-        ahora = datetime.now()
+        ahora = datetime.now(pytz.UTC)
         periodo = ahora.strftime("%Y%m")
         
-        # 3. Fecha límite
-        dias_responder = config['dias_para_responder']
-        fecha_limite = ahora + timedelta(days=dias_responder)
+        # 3. Calendario de envíos del periodo (igual para todos los usuarios)
+        programacion = construir_programacion(config, ahora)
         
-        # 4. Obtener instalaciones activas
-        query_inst = f"""
-        SELECT DISTINCT cliente_rol, instalacion_rol
-        FROM `{TABLE_USUARIO_INST}`
-        WHERE puede_ver = TRUE
-        ORDER BY cliente_rol, instalacion_rol
-        """
-        instalaciones = list(client.query(query_inst).result())
+        if motor == "bigquery":
+            resultado = generar_encuestas_bigquery(
+                periodo, ahora, programacion, dry_run, shard_index, shard_count
+            )
+        else:
+            resultado = generar_encuestas_python(
+                periodo, ahora, programacion, dry_run, shard_index, shard_count, reportar
+            )
+        
+        return {
+            "success": True,
+            "motor": motor,
+            "dry_run": dry_run,
+            "periodo": periodo,
+            "shard_index": shard_index,
+            "shard_count": shard_count,
+            **resultado
+        }
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        log(f"❌ Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def generar_encuestas_python(periodo, ahora, programacion, dry_run=False,
+                             shard_index=0, shard_count=1, reportar=None):
+    """
+    Arma encuestas y notificaciones en la API y las escribe por lotes de
+    instalaciones. Cada lote escrito queda registrado en
+    encuestas_generacion_progreso para que un reintento lo omita.
+    """
+    fecha_limite = programacion.fecha_limite
+    
+    # 4. Obtener instalaciones del shard con sus usuarios (una sola consulta)
+    filtro, parametros_shard = filtro_shard("ui", shard_index, shard_count)
+    query_inst = f"""
+    SELECT
+        ui.cliente_rol,
+        ui.instalacion_rol,
+        u.email_login,
+        u.fcm_token,
+        ui.requiere_encuesta_individual as requiere_individual
+    FROM `{TABLE_USUARIO_INST}` ui
+    LEFT JOIN `{TABLE_USUARIOS}` u
+      ON ui.email_login = u.email_login
+     AND u.activo = TRUE
+    WHERE ui.puede_ver = TRUE
+      AND {filtro}
+    ORDER BY ui.cliente_rol, ui.instalacion_rol
+    """
+    
+    # 4.1 Instalaciones terminadas en un intento anterior (se omiten)
+    terminadas = obtener_instalaciones_terminadas(periodo, shard_index, shard_count)
+    
+    # 4.2 Filas ya escritas por un intento interrumpido (no se duplican)
+    existentes = {
+        clave: encuesta_id
+        for clave, encuesta_id in obtener_encuestas_existentes(periodo, shard_index, shard_count).items()
+        if (clave[0], clave[1]) not in terminadas
+    }
+    notificaciones_existentes = obtener_notificaciones_existentes(list(existentes.values()), periodo)
+    
+    total_encuestas = 0
+    total_notificaciones = 0
+    procesadas = 0
+    omitidas = 0
+    
+    # Las instalaciones se leen por páginas a medida que se procesan
+    def instalaciones_pendientes():
+        nonlocal omitidas
+        filas = iterar_consulta("generacion_instalaciones", query_inst, parametros_shard)
+        for clave, usuarios in agrupar_por_instalacion(filas):
+            if clave in terminadas:
+                omitidas += 1
+            else:
+                yield clave, usuarios
+    
+    # 5. Generar encuestas por lotes de instalaciones
+    envios = programacion.filas_base()
+    for lote in en_lotes(instalaciones_pendientes(), GENERACION_LOTE_INSTALACIONES):
+        inicio_armado = time.perf_counter()
         encuestas_creadas = []
         notificaciones_programadas = []
         
-        # 5. Generar encuestas por instalación
-        for inst in instalaciones:
-            cliente_rol = inst.cliente_rol
-            instalacion_rol = inst.instalacion_rol
-            
-            # 5.1 Crear encuesta COMPARTIDA
-            encuesta_compartida_id = str(uuid.uuid4())
-            encuesta_compartida = {
-                'encuesta_id': encuesta_compartida_id,
-                'periodo': periodo,
-                'cliente_rol': cliente_rol,
-                'instalacion_rol': instalacion_rol,
-                'modo': 'compartida',
-                'email_destinatario': None,
-                'estado': 'pendiente',
-                'fecha_creacion': ahora,
-                'fecha_limite': fecha_limite,
-                'respondido_por_email': None,
-                'respondido_por_nombre': None,
-                'tipo_respuesta': None,
-                'fecha_respuesta': None
-            }
-            encuestas_creadas.append(encuesta_compartida)
+        for (cliente_rol, instalacion_rol), usuarios in lote:
+            # 5.1 Encuesta COMPARTIDA
+            encuesta_compartida_id = existentes.get((cliente_rol, instalacion_rol, 'compartida', None))
+            if not encuesta_compartida_id:
+                encuesta_compartida = nueva_solicitud(
+                    periodo, cliente_rol, instalacion_rol, 'compartida', None, ahora, fecha_limite
+                )
+                encuestas_creadas.append(encuesta_compartida)
+                encuesta_compartida_id = encuesta_compartida['encuesta_id']
             
-            # 5.2 Usuarios con encuesta INDIVIDUAL
-            query_individuales = f"""
-            SELECT DISTINCT u.email_login
-            FROM `{TABLE_USUARIO_INST}` ui
-            INNER JOIN `{TABLE_USUARIOS}` u ON ui.email_login = u.email_login
-            WHERE ui.cliente_rol = @cliente_rol
-              AND ui.instalacion_rol = @instalacion_rol
-              AND ui.requiere_encuesta_individual = TRUE
-              AND ui.puede_ver = TRUE
-              AND u.activo = TRUE
-            """
-            job_config_ind = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("cliente_rol", "STRING", cliente_rol),
-                    bigquery.ScalarQueryParameter("instalacion_rol", "STRING", instalacion_rol),
-                ]
-            )
-            usuarios_individuales = list(client.query(query_individuales, job_config=job_config_ind).result())
+            # 5.2 Usuarios activos con encuesta INDIVIDUAL (sin repetir email)
+            usuarios_individuales = list(dict.fromkeys(
+                u.email_login for u in usuarios if u.requiere_individual
+            ))
             
-            # 5.3 Crear encuestas individuales
-            for usuario in usuarios_individuales:
-                encuesta_individual = {
-                    'encuesta_id': str(uuid.uuid4()),
-                    'periodo': periodo,
-                    'cliente_rol': cliente_rol,
-                    'instalacion_rol': instalacion_rol,
-                    'modo': 'individual',
-                    'email_destinatario': usuario.email_login,
-                    'estado': 'pendiente',
-                    'fecha_creacion': ahora,
-                    'fecha_limite': fecha_limite,
-                    'respondido_por_email': None,
-                    'respondido_por_nombre': None,
-                    'tipo_respuesta': None,
-                    'fecha_respuesta': None
-                }
-                encuestas_creadas.append(encuesta_individual)
+            # 5.3 Encuestas individuales (índice email -> encuesta_id)
+            encuestas_individuales = {}
+            for email in usuarios_individuales:
+                encuesta_id = existentes.get((cliente_rol, instalacion_rol, 'individual', email))
+                if not encuesta_id:
+                    encuesta_individual = nueva_solicitud(
+                        periodo, cliente_rol, instalacion_rol, 'individual', email, ahora, fecha_limite
+                    )
+                    encuestas_creadas.append(encuesta_individual)
+                    encuesta_id = encuesta_individual['encuesta_id']
+                encuestas_individuales[email] = encuesta_id
             
-            # 5.4 Usuarios con FCM token (para notificaciones)
-            query_fcm = f"""
-            SELECT 
-                u.email_login,
-                u.fcm_token,
-                ui.requiere_encuesta_individual as requiere_individual
-            FROM `{TABLE_USUARIO_INST}` ui
-            INNER JOIN `{TABLE_USUARIOS}` u ON ui.email_login = u.email_login
-            WHERE ui.cliente_rol = @cliente_rol
-              AND ui.instalacion_rol = @instalacion_rol
-              AND ui.puede_ver = TRUE
-              AND u.activo = TRUE
-              AND u.fcm_token IS NOT NULL
-              AND u.fcm_token != ''
-            """
-            job_config_fcm = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("cliente_rol", "STRING", cliente_rol),
-                    bigquery.ScalarQueryParameter("instalacion_rol", "STRING", instalacion_rol),
-                ]
-            )
-            usuarios_fcm = list(client.query(query_fcm, job_config=job_config_fcm).result())
+            # 5.4 Usuarios activos con FCM token (para notificaciones)
+            usuarios_fcm = [u for u in usuarios if u.fcm_token]
             
-            # 5.5 Programar notificaciones
+            # 5.5 Destinos (encuesta_id, email, tópico): cada usuario con su
+            # encuesta, o con ENVIO_POR_TOPICO uno solo por instalación para la compartida
+            destinos = []
             for usuario in usuarios_fcm:
-                # Determinar encuesta
-                encuesta_id = None
                 if usuario.requiere_individual:
-                    for enc in encuestas_creadas:
-                        if (enc['modo'] == 'individual' and 
-                            enc['email_destinatario'] == usuario.email_login):
-                            encuesta_id = enc['encuesta_id']
-                            break
-                else:
-                    encuesta_id = encuesta_compartida_id
-                
+                    destinos.append((encuestas_individuales.get(usuario.email_login), usuario.email_login, None))
+                elif not ENVIO_POR_TOPICO:
+                    destinos.append((encuesta_compartida_id, usuario.email_login, None))
+            if ENVIO_POR_TOPICO and any(not u.requiere_individual for u in usuarios_fcm):
+                destinos.append((encuesta_compartida_id, None, topico_instalacion(cliente_rol, instalacion_rol)))
+            
+            # 5.6 Programar notificaciones
+            for encuesta_id, email, topico in destinos:
                 if encuesta_id:
                     notifs = programar_notificaciones(
                         encuesta_id=encuesta_id,
-                        fcm_token=usuario.fcm_token,
                         instalacion=instalacion_rol,
-                        fecha_inicio=ahora,
-                        dia_rec1=config['dia_recordatorio_1'],
-                        dia_rec2=config['dia_recordatorio_2'],
-                        horario_inicio=config['horario_inicio'],
-                        dias_laborales=config['dias_laborales']
+                        envios=envios,
+                        email_destinatario=email,
+                        topico=topico
                     )
+                    if notificaciones_existentes:
+                        notifs = [
+                            n for n in notifs
+                            if (encuesta_id, email, n['tipo']) not in notificaciones_existentes
+                        ]
                     notificaciones_programadas.extend(notifs)
         
-        # 6. Insertar encuestas
-        if encuestas_creadas:
-            errors = client.insert_rows_json(TABLE_ENCUESTAS_SOLICITUDES, encuestas_creadas)
-            if errors:
-                raise HTTPException(status_code=500, detail=f"Error insertando encuestas: {errors}")
+        metrica_etapa_segundos.observar(time.perf_counter() - inicio_armado, etapa="generacion_armado")
         
-        # 7. Insertar notificaciones
-        if notificaciones_programadas:
-            errors = client.insert_rows_json(TABLE_ENCUESTAS_NOTIF_PROG, notificaciones_programadas)
-            if errors:
-                raise HTTPException(status_code=500, detail=f"Error insertando notificaciones: {errors}")
+        # 6. Escribir el lote y registrarlo como terminado
+        if not dry_run:
+            with metrica_etapa_segundos.medir(etapa="generacion_escritura"):
+                escribir_lote_generacion(
+                    periodo, lote, encuestas_creadas, notificaciones_programadas,
+                    shard_index, shard_count
+                )
         
-        return {
-            "success": True,
-            "periodo": periodo,
-            "encuestas_creadas": len(encuestas_creadas),
-            "notificaciones_programadas": len(notificaciones_programadas)
+        total_encuestas += len(encuestas_creadas)
+        total_notificaciones += len(notificaciones_programadas)
+        procesadas += len(lote)
+        if reportar:
+            reportar(
+                instalaciones_procesadas=procesadas,
+                instalaciones_omitidas=omitidas,
+                encuestas_creadas=total_encuestas,
+                notificaciones_programadas=total_notificaciones
+            )
+    
+    return {
+        "encuestas_creadas": total_encuestas,
+        "notificaciones_programadas": total_notificaciones,
+        "instalaciones_procesadas": procesadas,
+        "instalaciones_omitidas": omitidas
+    }
+
+
+def escribir_lote_generacion(periodo, lote, encuestas, notificaciones, shard_index, shard_count):
+    """Escribe encuestas, notificaciones y el checkpoint de un lote de instalaciones"""
+    # fecha_creacion es la de escritura del lote: el índice de pendientes la usa como marca
+    fecha_creacion = datetime.now(pytz.UTC).isoformat()
+    for encuesta in encuestas:
+        encuesta['fecha_creacion'] = fecha_creacion
+    
+    errors = escritor.escribir(TABLE_ENCUESTAS_SOLICITUDES, encuestas, 'encuesta_id')
+    if errors:
+        raise HTTPException(status_code=500, detail=f"Error insertando encuestas: {errors}")
+    
+    errors = escritor.escribir(TABLE_ENCUESTAS_NOTIF_PROG, notificaciones, 'notificacion_id')
+    if errors:
+        raise HTTPException(status_code=500, detail=f"Error insertando notificaciones: {errors}")
+    
+    fecha_fin = datetime.now(pytz.UTC).isoformat()
+    checkpoints = [
+        {
+            'periodo': periodo,
+            'cliente_rol': cliente_rol,
+            'instalacion_rol': instalacion_rol,
+            'shard_index': shard_index,
+            'shard_count': shard_count,
+            'fecha_fin': fecha_fin
         }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"❌ Error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        for (cliente_rol, instalacion_rol), _ in lote
+    ]
+    errors = escritor.escribir(TABLE_ENCUESTAS_GEN_PROGRESO, checkpoints, 'instalacion_rol')
+    if errors:
+        raise HTTPException(status_code=500, detail=f"Error registrando progreso: {errors}")
+
+
+def generar_encuestas_bigquery(periodo, ahora, programacion, dry_run=False,
+                               shard_index=0, shard_count=1):
+    """
+    Crea encuestas y notificaciones con un script dentro de BigQuery.
+    Replica la lógica del motor Python sin pasar filas por la API; las
+    escrituras van en una transacción junto con el checkpoint del shard.
+    Usa la misma programación precalculada (fechas y plantillas).
+    """
+    filtro, parametros_shard = filtro_shard("ui", shard_index, shard_count)
+    script = f"""
+    -- Miembros de las instalaciones del shard que aún no terminan el periodo
+    CREATE TEMP TABLE miembros AS
+    SELECT
+        ui.cliente_rol,
+        ui.instalacion_rol,
+        u.email_login,
+        u.fcm_token,
+        COALESCE(ui.requiere_encuesta_individual, FALSE) AS requiere_individual
+    FROM `{TABLE_USUARIO_INST}` ui
+    LEFT JOIN `{TABLE_USUARIOS}` u
+      ON ui.email_login = u.email_login
+     AND u.activo = TRUE
+    WHERE ui.puede_ver = TRUE
+      AND {filtro}
+      AND NOT EXISTS (
+          SELECT 1
+          FROM `{TABLE_ENCUESTAS_GEN_PROGRESO}` p
+          WHERE p.periodo = @periodo
+            AND p.fecha_fin >= @inicio_periodo
+            AND p.cliente_rol = ui.cliente_rol
+            AND p.instalacion_rol = ui.instalacion_rol
+      );
+    
+    -- Encuestas del periodo escritas por un intento interrumpido
+    CREATE TEMP TABLE existentes AS
+    SELECT s.encuesta_id, s.cliente_rol, s.instalacion_rol, s.modo, s.email_destinatario
+    FROM `{TABLE_ENCUESTAS_SOLICITUDES}` s
+    WHERE s.periodo = @periodo
+      AND s.fecha_creacion >= @inicio_periodo
+      AND EXISTS (
+          SELECT 1 FROM miembros m
+          WHERE m.cliente_rol = s.cliente_rol AND m.instalacion_rol = s.instalacion_rol
+      );
+    
+    CREATE TEMP TABLE notificaciones_existentes (
+        encuesta_id STRING, tipo STRING, email_destinatario STRING
+    );
+    IF EXISTS (SELECT 1 FROM existentes) THEN
+        INSERT INTO notificaciones_existentes
+        SELECT n.encuesta_id, n.tipo, n.email_destinatario
+        FROM `{TABLE_ENCUESTAS_NOTIF_PROG}` n
+        WHERE n.fecha_programada >= @inicio_periodo
+          AND n.encuesta_id IN (SELECT encuesta_id FROM existentes);
+    END IF;
+    
+    CREATE TEMP TABLE nuevas_encuestas AS
+    SELECT GENERATE_UUID() AS encuesta_id, i.cliente_rol, i.instalacion_rol,
+           'compartida' AS modo, CAST(NULL AS STRING) AS email_destinatario
+    FROM (SELECT DISTINCT cliente_rol, instalacion_rol FROM miembros) i
+    WHERE NOT EXISTS (
+        SELECT 1 FROM existentes e
+        WHERE e.cliente_rol = i.cliente_rol AND e.instalacion_rol = i.instalacion_rol
+          AND e.modo = 'compartida'
+    )
+    UNION ALL
+    SELECT GENERATE_UUID(), i.cliente_rol, i.instalacion_rol, 'individual', i.email_login
+    FROM (
+        SELECT DISTINCT cliente_rol, instalacion_rol, email_login
+        FROM miembros
+        WHERE email_login IS NOT NULL AND requiere_individual
+    ) i
+    WHERE NOT EXISTS (
+        SELECT 1 FROM existentes e
+        WHERE e.cliente_rol = i.cliente_rol AND e.instalacion_rol = i.instalacion_rol
+          AND e.modo = 'individual' AND e.email_destinatario = i.email_login
+    );
+    
+    CREATE TEMP TABLE encuestas_periodo AS
+    SELECT encuesta_id, cliente_rol, instalacion_rol, modo, email_destinatario FROM nuevas_encuestas
+    UNION ALL
+    SELECT encuesta_id, cliente_rol, instalacion_rol, modo, email_destinatario FROM existentes;
+    
+    CREATE TEMP TABLE calendario AS
+    SELECT * FROM UNNEST(@calendario);
+
+    -- Por usuario; con @por_topico la compartida va una vez por instalación
+    CREATE TEMP TABLE nuevas_notificaciones AS
+    SELECT
+        GENERATE_UUID() AS notificacion_id,
+        c.plantilla_id,
+        e.encuesta_id,
+        c.tipo,
+        m.instalacion_rol,
+        m.email_login AS email_destinatario,
+        c.fecha_programada,
+        CAST(NULL AS STRING) AS topico
+    FROM miembros m
+    JOIN encuestas_periodo e
+      ON e.cliente_rol = m.cliente_rol
+     AND e.instalacion_rol = m.instalacion_rol
+     AND IF(m.requiere_individual,
+            e.modo = 'individual' AND e.email_destinatario = m.email_login,
+            e.modo = 'compartida')
+    CROSS JOIN calendario c
+    WHERE m.fcm_token IS NOT NULL
+      AND m.fcm_token != ''
+      AND (m.requiere_individual OR NOT @por_topico)
+      AND NOT EXISTS (
+          SELECT 1 FROM notificaciones_existentes x
+          WHERE x.encuesta_id = e.encuesta_id
+            AND x.tipo = c.tipo
+            AND x.email_destinatario = m.email_login
+      )
+    UNION ALL
+    SELECT
+        GENERATE_UUID(),
+        c.plantilla_id,
+        e.encuesta_id,
+        c.tipo,
+        e.instalacion_rol,
+        CAST(NULL AS STRING),
+        c.fecha_programada,
+        CONCAT(@prefijo_topico, SUBSTR(TO_HEX(SHA256(FORMAT('%s|%s', e.cliente_rol, e.instalacion_rol))), 1, 32))
+    FROM encuestas_periodo e
+    CROSS JOIN calendario c
+    WHERE @por_topico
+      AND e.modo = 'compartida'
+      AND EXISTS (
+          SELECT 1 FROM miembros m
+          WHERE m.cliente_rol = e.cliente_rol
+            AND m.instalacion_rol = e.instalacion_rol
+            AND NOT m.requiere_individual
+            AND m.fcm_token IS NOT NULL
+            AND m.fcm_token != ''
+      )
+      AND NOT EXISTS (
+          SELECT 1 FROM notificaciones_existentes x
+          WHERE x.encuesta_id = e.encuesta_id
+            AND x.tipo = c.tipo
+            AND x.email_destinatario IS NULL
+      );
+    
+    BEGIN TRANSACTION;
+    
+    INSERT INTO `{TABLE_ENCUESTAS_SOLICITUDES}` (
+        encuesta_id, periodo, cliente_rol, instalacion_rol, modo,
+        email_destinatario, estado, fecha_creacion, fecha_limite
+    )
+    SELECT
+        encuesta_id, @periodo, cliente_rol, instalacion_rol, modo,
+        email_destinatario, 'pendiente', @ahora, @fecha_limite
+    FROM nuevas_encuestas
+    WHERE NOT @dry_run;
+    
+    INSERT INTO `{TABLE_ENCUESTAS_NOTIF_PROG}` (
+        notificacion_id, plantilla_id, encuesta_id, tipo, instalacion_rol,
+        email_destinatario, fecha_programada, estado, intentos, topico
+    )
+    SELECT
+        notificacion_id, plantilla_id, encuesta_id, tipo, instalacion_rol,
+        email_destinatario, fecha_programada, 'pendiente', 0, topico
+    FROM nuevas_notificaciones
+    WHERE NOT @dry_run;
+    
+    INSERT INTO `{TABLE_ENCUESTAS_GEN_PROGRESO}` (
+        periodo, cliente_rol, instalacion_rol, shard_index, shard_count, fecha_fin
+    )
+    SELECT DISTINCT
+        @periodo, cliente_rol, instalacion_rol, @shard_index, @shard_count, CURRENT_TIMESTAMP()
+    FROM miembros
+    WHERE NOT @dry_run;
+    
+    COMMIT TRANSACTION;
+    
+    SELECT
+        (SELECT COUNT(*) FROM nuevas_encuestas) AS encuestas_creadas,
+        (SELECT COUNT(*) FROM nuevas_notificaciones) AS notificaciones_programadas,
+        (SELECT COUNT(DISTINCT FORMAT('%s|%s', cliente_rol, instalacion_rol)) FROM miembros)
+            AS instalaciones_procesadas;
+    """
+    job_config = bigquery.QueryJobConfig(
+        labels={"operacion": "generacion_bigquery"},
+        query_parameters=[
+            bigquery.ScalarQueryParameter("periodo", "STRING", periodo),
+            bigquery.ScalarQueryParameter("inicio_periodo", "TIMESTAMP", inicio_periodo(periodo)),
+            bigquery.ScalarQueryParameter("ahora", "TIMESTAMP", ahora),
+            bigquery.ScalarQueryParameter("fecha_limite", "TIMESTAMP", programacion.fecha_limite),
+            bigquery.ArrayQueryParameter("calendario", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("plantilla_id", "STRING", envio.plantilla_id),
+                    bigquery.ScalarQueryParameter("tipo", "STRING", envio.tipo),
+                    bigquery.ScalarQueryParameter("fecha_programada", "TIMESTAMP", envio.fecha_programada),
+                )
+                for envio in programacion.envios
+            ]),
+            bigquery.ScalarQueryParameter("dry_run", "BOOL", dry_run),
+            bigquery.ScalarQueryParameter("por_topico", "BOOL", ENVIO_POR_TOPICO),
+            bigquery.ScalarQueryParameter("prefijo_topico", "STRING", TOPICO_PREFIJO),
+            *parametros_shard,
+        ]
+    )
+    inicio = time.perf_counter()
+    job = client.query(script, job_config=job_config)
+    conteos = list(job.result())[0]
+    registrar_consumo("generacion_bigquery", job, time.perf_counter() - inicio)
+    
+    return {
+        "encuestas_creadas": conteos.encuestas_creadas,
+        "notificaciones_programadas": conteos.notificaciones_programadas,
+        "instalaciones_procesadas": conteos.instalaciones_procesadas,
+        "bytes_procesados": job.total_bytes_processed
+    }
 
 
 # ============================================
@@ -260,288 +747,2682 @@ async def generar_encuestas_mensuales():
 # ============================================
 
 @app.post("/api/notificaciones/enviar")
-async def enviar_notificaciones_push():
+async def enviar_notificaciones_push(drenar: bool = False, cursor: Optional[str] = None,
+                                     presupuesto_segundos: float = PRESUPUESTO_DRENADO_SEGUNDOS,
+                                     esperar: bool = False):
     """
     Envía notificaciones push programadas.
     Se ejecuta diariamente vía Cloud Scheduler.
+    
+    Con drenar=true recorre todas las vencidas por páginas hasta agotarlas
+    o hasta presupuesto_segundos, y devuelve un cursor para continuar.
+    Corre como trabajo en segundo plano; con esperar=true responde al terminar.
     """
+    desde = decodificar_cursor(cursor)
+    
+    # Con la configuración en caché, fuera de horario se responde sin tocar BigQuery
+    try:
+        config = await run_in_threadpool(obtener_configuracion)
+    except HTTPException:
+        raise
+    except Exception as e:
+        log(f"❌ Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    ahora_chile = datetime.now(pytz.UTC).astimezone(TZ_CHILE)
+    fuera_de_ventana = verificar_ventana_envio(config, ahora_chile)
+    if fuera_de_ventana:
+        return fuera_de_ventana
+    
+    return await despachar_trabajo(
+        "enviar_notificaciones", ejecutar_envio, esperar,
+        drenar=drenar, desde=desde, presupuesto_segundos=presupuesto_segundos
+    )
+
+
+def ejecutar_envio(drenar=False, desde=None, presupuesto_segundos=PRESUPUESTO_DRENADO_SEGUNDOS,
+                   reportar=None):
+    """Envía las notificaciones vencidas (se ejecuta fuera del event loop)"""
     try:
         # Obtener hora actual en zona horaria de Chile
-        tz_chile = pytz.timezone('America/Santiago')
         ahora_utc = datetime.now(pytz.UTC)
-        ahora_chile = ahora_utc.astimezone(tz_chile)
+        ahora_chile = ahora_utc.astimezone(TZ_CHILE)
         
-        print(f"🕐 Hora UTC: {ahora_utc.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-        print(f"🕐 Hora Chile: {ahora_chile.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        log(f"🕐 Hora UTC: {ahora_utc.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        log(f"🕐 Hora Chile: {ahora_chile.strftime('%Y-%m-%d %H:%M:%S %Z')}")
         
         # 1. Verificar horario permitido
-        query_config = f"""
-        SELECT horario_inicio, horario_fin, dias_laborales, notificaciones_activas
-        FROM `{TABLE_ENCUESTAS_CONFIG}`
-        WHERE activo = TRUE
-        LIMIT 1
-        """
-        config_result = list(client.query(query_config).result())
-        if not config_result:
-            raise HTTPException(status_code=400, detail="No hay configuración activa")
-        
-        config = dict(config_result[0])
-        
-        # Verificar si están activas
-        if not config['notificaciones_activas']:
-            print("⚠️ Notificaciones desactivadas")
-            return {"success": True, "message": "Notificaciones desactivadas", "enviadas": 0}
-        
-        # Verificar día laboral (usar hora de Chile)
-        dia_semana = ahora_chile.weekday()  # 0=Lunes, 1=Martes, ..., 4=Viernes, 5=Sábado, 6=Domingo
-        if dia_semana not in config['dias_laborales']:
-            print(f"⚠️ Fuera de días laborales. Día actual: {dia_semana}, Días permitidos: {config['dias_laborales']}")
-            return {"success": True, "message": "Fuera de días laborales", "enviadas": 0}
-        
-        # Verificar horario (usar hora de Chile)
-        hora_actual = ahora_chile.hour
-        if hora_actual < config['horario_inicio'] or hora_actual >= config['horario_fin']:
-            print(f"⚠️ Fuera de horario. Hora actual: {hora_actual}, Horario permitido: {config['horario_inicio']}-{config['horario_fin']}")
-            return {"success": True, "message": "Fuera de horario", "enviadas": 0}
+        config = obtener_configuracion()
+        fuera_de_ventana = verificar_ventana_envio(config, ahora_chile)
+        if fuera_de_ventana:
+            return fuera_de_ventana
         
         # 2. Obtener notificaciones pendientes (comparar en UTC)
-        query_notif = f"""
-        SELECT *
-        FROM `{TABLE_ENCUESTAS_NOTIF_PROG}`
-        WHERE estado = 'pendiente'
-          AND fecha_programada <= @ahora_utc
-        ORDER BY fecha_programada ASC
-        LIMIT 100
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("ahora_utc", "TIMESTAMP", ahora_utc),
-            ]
-        )
-        print(f"📊 Buscando notificaciones programadas antes de: {ahora_utc.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-        notificaciones = list(client.query(query_notif, job_config=job_config).result())
+        log(f"📊 Buscando notificaciones programadas antes de: {ahora_utc.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        if drenar:
+            return drenar_notificaciones(ahora_utc, desde, presupuesto_segundos, reportar)
+        
+        notificaciones = obtener_notificaciones_pendientes(ahora_utc, limite=100)
         
         if not notificaciones:
             return {"success": True, "message": "No hay notificaciones pendientes", "enviadas": 0}
         
-        # 3. Obtener access token
-        access_token = obtener_fcm_access_token()
-        
-        # 4. Enviar notificaciones
-        enviadas = 0
-        fallidas = 0
-        logs = []
-        
-        for notif in notificaciones:
-            try:
-                notif_dict = dict(notif)
-                resultado = enviar_fcm(
-                    fcm_token=notif_dict['fcm_token'],
-                    titulo=notif_dict['titulo'],
-                    cuerpo=notif_dict['cuerpo'],
-                    data=json.loads(notif_dict['data']) if notif_dict['data'] else {},
-                    access_token=access_token
-                )
-                
-                if resultado['success']:
-                    # Actualizar como enviada
-                    query_update = f"""
-                    UPDATE `{TABLE_ENCUESTAS_NOTIF_PROG}`
-                    SET estado = 'enviada', fecha_envio = CURRENT_TIMESTAMP()
-                    WHERE notificacion_id = @notif_id
-                    """
-                    job_config_upd = bigquery.QueryJobConfig(
-                        query_parameters=[
-                            bigquery.ScalarQueryParameter("notif_id", "STRING", notif_dict['notificacion_id']),
-                        ]
-                    )
-                    client.query(query_update, job_config=job_config_upd).result()
-                    enviadas += 1
-                    
-                    # Log exitoso
-                    logs.append({
-                        'log_id': str(uuid.uuid4()),
-                        'encuesta_id': json.loads(notif_dict['data'])['encuesta_id'],
-                        'email_destinatario': obtener_email_por_token(notif_dict['fcm_token']),
-                        'tipo_notificacion': json.loads(notif_dict['data'])['tipo'],
-                        'fecha_envio': ahora_utc.isoformat(),
-                        'estado': 'exitoso',
-                        'error_mensaje': None
-                    })
-                else:
-                    # Actualizar como fallida
-                    query_update_fail = f"""
-                    UPDATE `{TABLE_ENCUESTAS_NOTIF_PROG}`
-                    SET estado = 'fallida', error_mensaje = @error
-                    WHERE notificacion_id = @notif_id
-                    """
-                    job_config_fail = bigquery.QueryJobConfig(
-                        query_parameters=[
-                            bigquery.ScalarQueryParameter("notif_id", "STRING", notif_dict['notificacion_id']),
-                            bigquery.ScalarQueryParameter("error", "STRING", resultado['error']),
-                        ]
-                    )
-                    client.query(query_update_fail, job_config=job_config_fail).result()
-                    fallidas += 1
-                    
-                    # Log fallido
-                    logs.append({
-                        'log_id': str(uuid.uuid4()),
-                        'encuesta_id': json.loads(notif_dict['data'])['encuesta_id'],
-                        'email_destinatario': obtener_email_por_token(notif_dict['fcm_token']),
-                        'tipo_notificacion': json.loads(notif_dict['data'])['tipo'],
-                        'fecha_envio': ahora_utc.isoformat(),
-                        'estado': 'fallido',
-                        'error_mensaje': resultado['error']
-                    })
-                    
-            except Exception as e:
-                print(f"❌ Error procesando notificación: {e}")
-                fallidas += 1
-        
-        # 5. Insertar logs
-        if logs:
-            errors = client.insert_rows_json(TABLE_ENCUESTAS_NOTIF_LOG, logs)
-            if errors:
-                print(f"⚠️ Error insertando logs: {errors}")
+        # 3. Enviar, actualizar estados y registrar logs
+        resultado = procesar_notificaciones(notificaciones, ahora_utc)
+        if reportar:
+            reportar(**resultado)
         
         return {
             "success": True,
-            "enviadas": enviadas,
-            "fallidas": fallidas,
+            "enviadas": resultado['enviadas'],
+            "fallidas": resultado['fallidas'],
+            "reintentos": resultado['reintentos'],
+            "tokens_invalidos": resultado['tokens_invalidos'],
+            "mensajes": resultado['mensajes'],
             "total": len(notificaciones)
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error: {str(e)}")
+        log(f"❌ Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# ============================================
-# FUNCIONES AUXILIARES
-# ============================================
+def procesar_notificaciones(notificaciones, ahora_utc):
+    """Envía una página de notificaciones, actualiza estados y registra logs"""
+    # 1. Asegurar access token vigente (se reutiliza entre ejecuciones)
+    obtener_fcm_access_token()
+    
+    # 2. Enviar notificaciones
+    enviadas = 0
+    fallidas = 0
+    reintentos = 0
+    tokens_invalidos = set()
+    logs = []
+    estados = []
+    
+    # 2.1 Armar mensajes desde las plantillas (uno por dispositivo y tipo)
+    inicio_armado = time.perf_counter()
+    pendientes = []
+    descartadas = []
+    for notif in notificaciones:
+        notif_dict = dict(notif)
+        try:
+            renderizar_notificacion(notif_dict)
+            pendientes.append(notif_dict)
+        except ValueError as e:
+            log(f"❌ Error procesando notificación: {e}")
+            descartadas.append((notif_dict, {'success': False, 'error': str(e)}, 'permanente'))
+    grupos = agrupar_notificaciones(pendientes)
+    mensajes = [renderizar_grupo(grupo) for grupo in grupos]
+    
+    metrica_etapa_segundos.observar(time.perf_counter() - inicio_armado, etapa="envio_armado")
+    
+    # 2.2 Enviar en paralelo
+    with metrica_etapa_segundos.medir(etapa="envio_fcm"):
+        resultados = despachador_fcm.enviar_lote(mensajes)
+    
+    # 2.3 Registrar resultados: cada fila corre la suerte del mensaje que la
+    # incluyó (los errores se clasifican según el código FCM)
+    enviados = [
+        (notif_dict, resultado, None if resultado['success'] else clasificar_error_fcm(resultado))
+        for grupo, resultado in zip(grupos, resultados)
+        for notif_dict in grupo
+    ]
+    for notif_dict, resultado, clase in enviados + descartadas:
+        try:
+            intentos = notif_dict['intentos'] + 1
+            if resultado['success']:
+                # Marcar como enviada (se aplica en lote al final)
+                estados.append({
+                    'notificacion_id': notif_dict['notificacion_id'],
+                    'estado': 'enviada',
+                    'intentos': intentos,
+                    'fecha_programada': None,
+                    'fecha_envio': datetime.now(pytz.UTC),
+                    'error_mensaje': None
+                })
+                enviadas += 1
+                metrica_notificaciones.inc(resultado='enviada')
+                
+                # Log exitoso
+                logs.append({
+                    'log_id': str(uuid.uuid4()),
+                    'encuesta_id': notif_dict['encuesta_id'],
+                    'email_destinatario': notif_dict['email_destinatario'],
+                    'tipo_notificacion': notif_dict['tipo'],
+                    'fecha_envio': ahora_utc.isoformat(),
+                    'estado': 'exitoso',
+                    'error_mensaje': None
+                })
+            elif clase == 'transitorio' and intentos < NOTIFICACION_MAX_INTENTOS:
+                # Vuelve a quedar pendiente más adelante (backoff exponencial)
+                espera = calcular_espera_reintento(intentos, resultado.get('retry_after'))
+                estados.append({
+                    'notificacion_id': notif_dict['notificacion_id'],
+                    'estado': 'pendiente',
+                    'intentos': intentos,
+                    'fecha_programada': ahora_utc + timedelta(seconds=espera),
+                    'fecha_envio': None,
+                    'error_mensaje': resultado['error']
+                })
+                reintentos += 1
+                metrica_notificaciones.inc(resultado='reintento')
+                
+                logs.append({
+                    'log_id': str(uuid.uuid4()),
+                    'encuesta_id': notif_dict['encuesta_id'],
+                    'email_destinatario': notif_dict['email_destinatario'],
+                    'tipo_notificacion': notif_dict['tipo'],
+                    'fecha_envio': ahora_utc.isoformat(),
+                    'estado': 'reintento',
+                    'error_mensaje': resultado['error']
+                })
+            else:
+                # Marcar como fallida (se aplica en lote al final)
+                estados.append({
+                    'notificacion_id': notif_dict['notificacion_id'],
+                    'estado': 'fallida',
+                    'intentos': intentos,
+                    'fecha_programada': None,
+                    'fecha_envio': None,
+                    'error_mensaje': resultado['error']
+                })
+                fallidas += 1
+                if clase == 'token_invalido' and notif_dict['fcm_token']:
+                    tokens_invalidos.add(notif_dict['fcm_token'])
+                metrica_notificaciones.inc(resultado=clase if clase == 'token_invalido' else 'fallida')
+                
+                # Log fallido
+                logs.append({
+                    'log_id': str(uuid.uuid4()),
+                    'encuesta_id': notif_dict['encuesta_id'],
+                    'email_destinatario': notif_dict['email_destinatario'],
+                    'tipo_notificacion': notif_dict['tipo'],
+                    'fecha_envio': ahora_utc.isoformat(),
+                    'estado': 'fallido',
+                    'error_mensaje': resultado['error']
+                })
+                
+        except Exception as e:
+            log(f"❌ Error procesando notificación: {e}")
+            fallidas += 1
+    
+    # 3. Actualizar estados con un MERGE por lote
+    with metrica_etapa_segundos.medir(etapa="envio_estados"):
+        actualizar_estados_notificaciones(estados, ahora_utc)
+    
+    # 4. Borrar los tokens muertos para no volver a programarles envíos
+    if tokens_invalidos:
+        invalidar_tokens_fcm(tokens_invalidos)
+    
+    # 5. Insertar logs
+    if logs:
+        with metrica_etapa_segundos.medir(etapa="envio_logs"):
+            errors = escritor.escribir(TABLE_ENCUESTAS_NOTIF_LOG, logs, 'log_id')
+        if errors:
+            log(f"⚠️ Error insertando logs: {errors}")
+    
+    return {
+        "enviadas": enviadas,
+        "fallidas": fallidas,
+        "reintentos": reintentos,
+        "tokens_invalidos": len(tokens_invalidos),
+        "mensajes": len(mensajes)
+    }
 
-def programar_notificaciones(encuesta_id, fcm_token, instalacion, 
-                             fecha_inicio, dia_rec1, dia_rec2, 
-                             horario_inicio, dias_laborales):
-    """Programa 3 notificaciones"""
-    notificaciones = []
-    
-    # Notificación 1: Nueva encuesta
-    fecha_1 = ajustar_fecha_laboral(fecha_inicio, horario_inicio, dias_laborales)
-    notificaciones.append({
-        'notificacion_id': str(uuid.uuid4()),
-        'fcm_token': fcm_token,
-        'titulo': '📋 Nueva Encuesta Disponible',
-        'cuerpo': f'Tiene una nueva encuesta de satisfacción para {instalacion}',
-        'data': json.dumps({"encuesta_id": encuesta_id, "tipo": "nueva"}),
-        'fecha_programada': fecha_1.isoformat(),
-        'estado': 'pendiente',
-        'fecha_envio': None,
-        'error_mensaje': None
-    })
+
+def drenar_notificaciones(ahora_utc, desde, presupuesto_segundos, reportar=None):
+    """
+    Recorre todas las notificaciones vencidas por páginas (keyset sobre
+    fecha_programada, email_destinatario, notificacion_id) hasta agotarlas o hasta que la
+    siguiente página no quepa en el presupuesto de tiempo.
+    """
+    inicio = time.monotonic()
+    enviadas = 0
+    fallidas = 0
+    reintentos = 0
+    tokens_invalidos = 0
+    mensajes = 0
+    total = 0
+    paginas = 0
+    agotado = False
     
-    # Notificación 2: Recordatorio 1
-    fecha_2 = ajustar_fecha_laboral(
-        fecha_inicio + timedelta(days=dia_rec1 - 1),
-        horario_inicio,
-        dias_laborales
-    )
-    notificaciones.append({
-        'notificacion_id': str(uuid.uuid4()),
-        'fcm_token': fcm_token,
-        'titulo': '🔔 Recordatorio de Encuesta',
-        'cuerpo': f'Recuerde completar la encuesta de {instalacion}',
-        'data': json.dumps({"encuesta_id": encuesta_id, "tipo": "recordatorio_1"}),
-        'fecha_programada': fecha_2.isoformat(),
-        'estado': 'pendiente',
-        'fecha_envio': None,
-        'error_mensaje': None
-    })
+    # Una sola consulta cuyo resultado se recorre por páginas
+    pendientes = paginas_notificaciones_pendientes(ahora_utc, desde, TAMANO_PAGINA_DRENADO)
+    with ThreadPoolExecutor(max_workers=1) as lector:
+        # La página siguiente se lee mientras se envía la actual
+        def leer_pagina():
+            return lector.submit(contextvars.copy_context().run, next, pendientes, None)
+        
+        futura = leer_pagina()
+        while True:
+            inicio_pagina = time.monotonic()
+            notificaciones = futura.result()
+            if notificaciones is None:
+                agotado = True
+                break
+            
+            ultima = notificaciones[-1]
+            desde = (ultima.fecha_programada, ultima.email_destinatario or '', ultima.notificacion_id)
+            futura = leer_pagina()
+            
+            resultado = procesar_notificaciones(notificaciones, ahora_utc)
+            enviadas += resultado['enviadas']
+            fallidas += resultado['fallidas']
+            reintentos += resultado['reintentos']
+            tokens_invalidos += resultado['tokens_invalidos']
+            mensajes += resultado['mensajes']
+            total += len(notificaciones)
+            paginas += 1
+            if reportar:
+                reportar(paginas=paginas, enviadas=enviadas, fallidas=fallidas,
+                         reintentos=reintentos, tokens_invalidos=tokens_invalidos,
+                         mensajes=mensajes, total=total)
+            
+            transcurrido = time.monotonic() - inicio
+            if transcurrido + (time.monotonic() - inicio_pagina) > presupuesto_segundos:
+                log(f"⏱️ Presupuesto agotado tras {paginas} páginas ({transcurrido:.0f}s)")
+                break
+    pendientes.close()
     
-    # Notificación 3: Recordatorio 2
-    fecha_3 = ajustar_fecha_laboral(
-        fecha_inicio + timedelta(days=dia_rec2 - 1),
-        horario_inicio,
-        dias_laborales
-    )
-    notificaciones.append({
-        'notificacion_id': str(uuid.uuid4()),
-        'fcm_token': fcm_token,
-        'titulo': '⚠️ Último Recordatorio',
-        'cuerpo': f'La encuesta de {instalacion} vence pronto',
-        'data': json.dumps({"encuesta_id": encuesta_id, "tipo": "recordatorio_2"}),
-        'fecha_programada': fecha_3.isoformat(),
-        'estado': 'pendiente',
-        'fecha_envio': None,
-        'error_mensaje': None
-    })
+    restantes = 0 if agotado else contar_notificaciones_pendientes(ahora_utc, desde)
     
-    return notificaciones
+    return {
+        "success": True,
+        "enviadas": enviadas,
+        "fallidas": fallidas,
+        "reintentos": reintentos,
+        "tokens_invalidos": tokens_invalidos,
+        "mensajes": mensajes,
+        "total": total,
+        "paginas": paginas,
+        "restantes": restantes,
+        "cursor": codificar_cursor(desde) if restantes else None
+    }
 
 
-def ajustar_fecha_laboral(fecha, hora_inicio, dias_laborales):
-    """Ajusta fecha a día laboral"""
-    # dias_laborales usa formato weekday(): 0=Lunes, 1=Martes, ..., 4=Viernes
-    while fecha.weekday() not in dias_laborales:
-        fecha += timedelta(days=1)
-    fecha = fecha.replace(hour=hora_inicio, minute=0, second=0, microsecond=0)
-    return fecha
+# ============================================
+# ENDPOINT 3: ESTADO DE TRABAJOS
+# ============================================
 
+@app.get("/api/jobs/{job_id}")
+async def obtener_trabajo(job_id: str):
+    """Estado, progreso y resultado de un trabajo en segundo plano"""
+    with _lock_trabajos:
+        trabajo = _trabajos.get(job_id)
+        if trabajo:
+            return vista_trabajo(trabajo)
+    
+    # Trabajo de otra instancia (o ya podado del historial local)
+    trabajo = await run_in_threadpool(leer_trabajo_compartido, job_id)
+    if not trabajo:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return trabajo
 
-def obtener_fcm_access_token():
-    """Obtiene access token para FCM"""
-    credentials, project = google.auth.default(
-        scopes=['https://www.googleapis.com/auth/firebase.messaging']
-    )
-    request = google.auth.transport.requests.Request()
-    credentials.refresh(request)
-    return credentials.token
 
+# ============================================
+# ENDPOINT 4: CONFIGURACIÓN
+# ============================================
 
-def enviar_fcm(fcm_token, titulo, cuerpo, data, access_token):
-    """Envía notificación FCM"""
-    url = f"https://fcm.googleapis.com/v1/projects/{PROJECT_ID}/messages:send"
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
-    payload = {
-        'message': {
-            'token': fcm_token,
-            'notification': {'title': titulo, 'body': cuerpo},
-            'data': data,
-            'android': {'priority': 'high'}
-        }
-    }
-    
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        if response.status_code == 200:
-            return {'success': True, 'error': None}
-        else:
-            return {'success': False, 'error': f"{response.status_code} - {response.text}"}
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
+@app.post("/api/configuracion/invalidar")
+async def invalidar_configuracion():
+    """Descarta la configuración y las preguntas en caché; la próxima lectura va a BigQuery"""
+    invalidar_cache_configuracion()
+    invalidar_cache_preguntas()
+    return {"success": True, "message": "Caché de configuración invalidada"}
 
 
-def obtener_email_por_token(fcm_token):
-    """Obtiene email por FCM token"""
-    query = f"""
-    SELECT email_login
-    FROM `{TABLE_USUARIOS}`
-    WHERE fcm_token = @token
-    LIMIT 1
+# ============================================
+# ENDPOINT 5: TÓPICOS FCM
+# ============================================
+
+@app.post("/api/topicos/sincronizar")
+async def sincronizar_topicos(esperar: bool = False):
     """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("token", "STRING", fcm_token),
-        ]
+    Ajusta las suscripciones de los tokens a los tópicos de sus
+    instalaciones según usuario_instalaciones (altas y bajas por lotes
+    con la API Instance ID). Conviene correrlo cuando cambian los
+    miembros y siempre antes de generar con ENVIO_POR_TOPICO.
+    """
+    return await despachar_trabajo("sincronizar_topicos", ejecutar_sincronizacion_topicos, esperar)
+
+
+def ejecutar_sincronizacion_topicos(reportar=None):
+    """Aplica las diferencias entre suscripciones deseadas y registradas"""
+    # 1. Diferencias: (token, instalación) que falta suscribir o que sobra.
+    #    Solo se suscriben los usuarios que reciben la encuesta compartida.
+    query_diferencias = f"""
+    WITH deseadas AS (
+        SELECT DISTINCT u.fcm_token, ui.cliente_rol, ui.instalacion_rol
+        FROM `{TABLE_USUARIO_INST}` ui
+        JOIN `{TABLE_USUARIOS}` u
+          ON ui.email_login = u.email_login
+         AND u.activo = TRUE
+        WHERE ui.puede_ver = TRUE
+          AND NOT COALESCE(ui.requiere_encuesta_individual, FALSE)
+          AND u.fcm_token IS NOT NULL
+          AND u.fcm_token != ''
+    )
+    SELECT
+        COALESCE(d.fcm_token, s.fcm_token) AS fcm_token,
+        COALESCE(d.cliente_rol, s.cliente_rol) AS cliente_rol,
+        COALESCE(d.instalacion_rol, s.instalacion_rol) AS instalacion_rol,
+        IF(s.fcm_token IS NULL, 'alta', 'baja') AS accion
+    FROM deseadas d
+    FULL OUTER JOIN `{TABLE_ENCUESTAS_SUSCRIPCIONES}` s
+      ON d.fcm_token = s.fcm_token
+     AND d.cliente_rol = s.cliente_rol
+     AND d.instalacion_rol = s.instalacion_rol
+    WHERE d.fcm_token IS NULL OR s.fcm_token IS NULL
+    ORDER BY cliente_rol, instalacion_rol, accion
+    """
+    filas = iterar_consulta("topicos_diferencias", query_diferencias)
+    lotes = (
+        (accion, cliente_rol, instalacion_rol, [f.fcm_token for f in lote])
+        for (cliente_rol, instalacion_rol, accion), grupo in itertools.groupby(
+            filas, key=lambda f: (f.cliente_rol, f.instalacion_rol, f.accion)
+        )
+        for lote in en_lotes(grupo, IID_LOTE_TOKENS)
+    )
+    
+    # 2. batchAdd / batchRemove en paralelo y registro por lote
+    altas = 0
+    bajas = 0
+    errores = 0
+    tokens_invalidos = set()
+    obtener_fcm_access_token()
+    with ThreadPoolExecutor(max_workers=FCM_CONCURRENCIA) as pool:
+        for tanda in en_lotes(lotes, FCM_CONCURRENCIA):
+            futuras = [
+                pool.submit(contextvars.copy_context().run, aplicar_lote_topico, *lote)
+                for lote in tanda
+            ]
+            suscritas = []
+            eliminadas = []
+            for futura in futuras:
+                resultado = futura.result()
+                suscritas.extend(resultado['suscritas'])
+                eliminadas.extend(resultado['eliminadas'])
+                tokens_invalidos.update(resultado['tokens_invalidos'])
+                errores += resultado['errores']
+            registrar_suscripciones(suscritas, eliminadas)
+            altas += len(suscritas)
+            bajas += len(eliminadas)
+            if reportar:
+                reportar(altas=altas, bajas=bajas, errores=errores)
+    
+    # 3. Tokens que Instance ID no reconoce: fuera de usuarios_app
+    if tokens_invalidos:
+        invalidar_tokens_fcm(tokens_invalidos)
+    
+    return {
+        "success": True,
+        "altas": altas,
+        "bajas": bajas,
+        "errores": errores,
+        "tokens_invalidos": len(tokens_invalidos)
+    }
+
+
+def aplicar_lote_topico(accion, cliente_rol, instalacion_rol, tokens):
+    """
+    Suscribe o desuscribe un lote de tokens del tópico de la instalación.
+    Devuelve las filas a registrar, los tokens muertos y los errores
+    (los lotes con error transitorio se reintentan en la próxima sincronización).
+    """
+    topico = topico_instalacion(cliente_rol, instalacion_rol)
+    resultado = {'suscritas': [], 'eliminadas': [], 'tokens_invalidos': [], 'errores': 0}
+    try:
+        errores = llamar_iid('batchAdd' if accion == 'alta' else 'batchRemove', topico, tokens)
+    except Exception as e:
+        log(f"⚠️ Error en Instance ID ({accion} {topico}, {len(tokens)} tokens): {e}")
+        resultado['errores'] = len(tokens)
+        return resultado
+    
+    ahora = datetime.now(pytz.UTC).isoformat()
+    for token, error in zip(tokens, errores):
+        if error in ('NOT_FOUND', 'INVALID_ARGUMENT'):
+            resultado['tokens_invalidos'].append(token)
+            if accion == 'baja':
+                # Un token muerto tampoco sigue suscrito: la fila se borra igual
+                resultado['eliminadas'].append((token, cliente_rol, instalacion_rol))
+        elif error:
+            resultado['errores'] += 1
+        elif accion == 'alta':
+            resultado['suscritas'].append({
+                'fcm_token': token,
+                'cliente_rol': cliente_rol,
+                'instalacion_rol': instalacion_rol,
+                'topico': topico,
+                'fecha_alta': ahora
+            })
+        else:
+            resultado['eliminadas'].append((token, cliente_rol, instalacion_rol))
+    return resultado
+
+
+def llamar_iid(metodo, topico, tokens):
+    """batchAdd/batchRemove de Instance ID: error por token (None si quedó bien)"""
+    response = despachador_fcm.sesion.post(
+        f"{IID_URL}:{metodo}",
+        headers={
+            'Authorization': f'Bearer {obtener_fcm_access_token()}',
+            'Content-Type': 'application/json',
+            'access_token_auth': 'true',
+        },
+        json={'to': f'/topics/{topico}', 'registration_tokens': tokens},
+        timeout=FCM_TIMEOUT_SEGUNDOS
+    )
+    response.raise_for_status()
+    resultados = response.json().get('results') or [{}] * len(tokens)
+    return [r.get('error') for r in resultados]
+
+
+def registrar_suscripciones(suscritas, eliminadas):
+    """Escribe las altas y borra las bajas en encuestas_suscripciones_topico"""
+    if suscritas:
+        errors = escritor.escribir(TABLE_ENCUESTAS_SUSCRIPCIONES, suscritas, 'fcm_token')
+        if errors:
+            raise HTTPException(status_code=500, detail=f"Error registrando suscripciones: {errors}")
+    
+    query_bajas = f"""
+    DELETE FROM `{TABLE_ENCUESTAS_SUSCRIPCIONES}` s
+    WHERE EXISTS (
+        SELECT 1 FROM UNNEST(@bajas) b
+        WHERE b.fcm_token = s.fcm_token
+          AND b.cliente_rol = s.cliente_rol
+          AND b.instalacion_rol = s.instalacion_rol
+    )
+    """
+    for inicio in range(0, len(eliminadas), TAMANO_LOTE_ESTADOS):
+        ejecutar_consulta("topicos_bajas", query_bajas, [
+            bigquery.ArrayQueryParameter("bajas", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("fcm_token", "STRING", token),
+                    bigquery.ScalarQueryParameter("cliente_rol", "STRING", cliente_rol),
+                    bigquery.ScalarQueryParameter("instalacion_rol", "STRING", instalacion_rol),
+                )
+                for token, cliente_rol, instalacion_rol in eliminadas[inicio:inicio + TAMANO_LOTE_ESTADOS]
+            ]),
+        ])
+
+
+def topico_instalacion(cliente_rol, instalacion_rol):
+    """Tópico FCM de la instalación (el script de generación en BigQuery calcula lo mismo)"""
+    clave = f"{cliente_rol}|{instalacion_rol}"
+    return TOPICO_PREFIJO + hashlib.sha256(clave.encode()).hexdigest()[:32]
+
+
+# ============================================
+# ENDPOINT 6: RESPONDER ENCUESTA
+# ============================================
+
+class RespuestaPregunta(BaseModel):
+    pregunta_id: str
+    valor: Optional[int] = None
+    comentario: Optional[str] = None
+
+
+class EnvioRespuestas(BaseModel):
+    email_login: str
+    nombre: Optional[str] = None
+    respuestas: List[RespuestaPregunta]
+
+
+@app.post("/api/encuestas/{encuesta_id}/respuestas", status_code=202)
+async def responder_encuesta(encuesta_id: str, envio: EnvioRespuestas):
+    """
+    Recibe las respuestas de una encuesta. Se validan contra las preguntas
+    activas y quedan en cola: se escriben en lotes junto con el MERGE que
+    marca la solicitud como completada. Solo vale la primera respuesta.
+    """
+    # 1. Ya respondida en esta instancia: se rechaza sin ir a BigQuery
+    if encuesta_id in cola_respuestas.respondidas:
+        raise HTTPException(status_code=409, detail="La encuesta ya fue respondida")
+    
+    # 2. Validar contra las preguntas activas (en caché)
+    preguntas = await run_in_threadpool(obtener_preguntas)
+    validar_respuestas(preguntas, envio.respuestas)
+    
+    # 3. Validar la solicitud (en caché por encuesta_id)
+    ahora = datetime.now(pytz.UTC)
+    solicitud = await run_in_threadpool(obtener_solicitud, encuesta_id)
+    verificar_solicitud(solicitud, envio.email_login, ahora)
+    
+    # 3.1 Una compartida solo la responde un miembro de su instalación
+    if solicitud.modo == 'compartida' and not await run_in_threadpool(
+        responde_compartida, envio.email_login, solicitud.cliente_rol, solicitud.instalacion_rol
+    ):
+        raise HTTPException(status_code=403, detail="El usuario no responde la encuesta de esta instalación")
+    
+    # 4. Encolar (la primera respuesta gana también entre requests simultáneos)
+    email = envio.email_login.strip()
+    filas = [
+        {
+            'respuesta_id': str(uuid.uuid4()),
+            'encuesta_id': encuesta_id,
+            'pregunta_id': r.pregunta_id,
+            'email_login': email,
+            'valor': r.valor,
+            'comentario': r.comentario,
+            'fecha_respuesta': ahora
+        }
+        for r in envio.respuestas
+    ]
+    aceptada = cola_respuestas.agregar({
+        'encuesta_id': encuesta_id,
+        'email_login': email,
+        'nombre': envio.nombre,
+        'fecha_respuesta': ahora,
+        'fecha_creacion': solicitud.fecha_creacion,
+        'filas': filas,
+    })
+    if not aceptada:
+        raise HTTPException(status_code=409, detail="La encuesta ya fue respondida")
+    indice_pendientes.quitar(encuesta_id)
+    
+    return {"success": True, "encuesta_id": encuesta_id, "estado": "recibida"}
+
+
+def validar_respuestas(preguntas, respuestas):
+    """Una respuesta por pregunta activa, con valor y comentario según su tipo (422 si no)"""
+    errores = []
+    por_pregunta = {}
+    for respuesta in respuestas:
+        if respuesta.pregunta_id in por_pregunta:
+            errores.append(f"Pregunta repetida: {respuesta.pregunta_id}")
+        por_pregunta[respuesta.pregunta_id] = respuesta
+    
+    for pregunta_id in por_pregunta.keys() - preguntas.keys():
+        errores.append(f"Pregunta desconocida: {pregunta_id}")
+    
+    for pregunta in preguntas.values():
+        respuesta = por_pregunta.get(pregunta.pregunta_id)
+        if respuesta is None:
+            errores.append(f"Falta la pregunta {pregunta.orden}: {pregunta.pregunta_id}")
+            continue
+        if pregunta.tipo == 'escala' and respuesta.valor not in ESCALA_RESPUESTA:
+            errores.append(f"Pregunta {pregunta.orden}: el valor debe estar entre 1 y 5")
+        if pregunta.tipo != 'escala' and respuesta.valor is not None:
+            errores.append(f"Pregunta {pregunta.orden}: es de texto, no lleva valor")
+        if respuesta.comentario:
+            if pregunta.tipo == 'escala' and not pregunta.permite_comentario:
+                errores.append(f"Pregunta {pregunta.orden}: no admite comentario")
+            if len(respuesta.comentario) > RESPUESTA_COMENTARIO_MAX:
+                errores.append(f"Pregunta {pregunta.orden}: comentario de más de {RESPUESTA_COMENTARIO_MAX} caracteres")
+    
+    if errores:
+        raise HTTPException(status_code=422, detail=errores)
+
+
+def verificar_solicitud(solicitud, email_login, ahora):
+    """Rechaza encuestas inexistentes, ya respondidas, vencidas o de otro usuario"""
+    if solicitud is None:
+        raise HTTPException(status_code=404, detail="Encuesta no encontrada")
+    if solicitud.estado == 'completada':
+        cola_respuestas.respondidas.add(solicitud.encuesta_id)
+        raise HTTPException(status_code=409, detail="La encuesta ya fue respondida")
+    if solicitud.estado == 'vencida' or ahora > solicitud.fecha_limite:
+        raise HTTPException(status_code=410, detail="La encuesta está vencida")
+    if (solicitud.modo == 'individual'
+            and (solicitud.email_destinatario or '').lower() != email_login.strip().lower()):
+        raise HTTPException(status_code=403, detail="La encuesta es de otro usuario")
+
+
+@dataclass(frozen=True)
+class Solicitud:
+    """Campos de encuestas_solicitudes que se revisan al responder"""
+    encuesta_id: str
+    cliente_rol: str
+    instalacion_rol: str
+    modo: str
+    email_destinatario: Optional[str]
+    estado: str
+    fecha_creacion: datetime
+    fecha_limite: datetime
+
+
+_cache_solicitudes = OrderedDict()
+_lock_solicitudes = threading.Lock()
+
+
+def obtener_solicitud(encuesta_id):
+    """
+    Solicitud por encuesta_id (índice de pendientes, LRU en memoria; None si
+    no existe). Completadas y vencidas no cambian y quedan en caché; una
+    pendiente se relee después de SOLICITUDES_PENDIENTE_TTL_SEGUNDOS.
+    """
+    solicitud = indice_pendientes.solicitud(encuesta_id)
+    if solicitud:
+        return solicitud
+    
+    with _lock_solicitudes:
+        entrada = _cache_solicitudes.get(encuesta_id)
+        if entrada and time.monotonic() < entrada[1]:
+            _cache_solicitudes.move_to_end(encuesta_id)
+            return entrada[0]
+    
+    query_solicitud = f"""
+    SELECT encuesta_id, cliente_rol, instalacion_rol, modo, email_destinatario,
+           estado, fecha_creacion, fecha_limite
+    FROM `{TABLE_ENCUESTAS_SOLICITUDES}`
+    WHERE encuesta_id = @encuesta_id
+      AND fecha_creacion >= @desde
+    LIMIT 1
+    """
+    filas = list(ejecutar_consulta("respuestas_solicitud", query_solicitud, [
+        bigquery.ScalarQueryParameter("encuesta_id", "STRING", encuesta_id),
+        bigquery.ScalarQueryParameter(
+            "desde", "TIMESTAMP", datetime.now(pytz.UTC) - timedelta(days=VENTANA_SOLICITUDES_DIAS)
+        ),
+    ]))
+    if not filas:
+        return None
+    
+    solicitud = Solicitud(**dict(filas[0]))
+    expira = (
+        time.monotonic() + SOLICITUDES_PENDIENTE_TTL_SEGUNDOS
+        if solicitud.estado == 'pendiente' else float('inf')
+    )
+    with _lock_solicitudes:
+        _cache_solicitudes[encuesta_id] = (solicitud, expira)
+        _cache_solicitudes.move_to_end(encuesta_id)
+        if len(_cache_solicitudes) > SOLICITUDES_CACHE_MAX:
+            _cache_solicitudes.popitem(last=False)
+    return solicitud
+
+
+_cache_miembros = OrderedDict()
+_lock_miembros = threading.Lock()
+
+
+def responde_compartida(email_login, cliente_rol, instalacion_rol):
+    """
+    True si el usuario está activo, ve la instalación y no tiene encuesta
+    individual en ella. Se revisa primero el índice de pendientes; si no
+    lo confirma, una consulta en caché por MIEMBROS_CACHE_TTL_SEGUNDOS.
+    """
+    email = email_login.strip().lower()
+    clave = (cliente_rol, instalacion_rol)
+    if clave in (indice_pendientes.instalaciones_de(email) or ()):
+        return True
+    
+    with _lock_miembros:
+        entrada = _cache_miembros.get((email, clave))
+        if entrada and time.monotonic() < entrada[1]:
+            _cache_miembros.move_to_end((email, clave))
+            return entrada[0]
+    
+    query_miembro = f"""
+    SELECT COUNT(*) > 0 AS es_miembro
+    FROM `{TABLE_USUARIO_INST}` ui
+    JOIN `{TABLE_USUARIOS}` u
+      ON ui.email_login = u.email_login
+     AND u.activo = TRUE
+    WHERE ui.cliente_rol = @cliente_rol
+      AND ui.instalacion_rol = @instalacion_rol
+      AND LOWER(ui.email_login) = @email
+      AND ui.puede_ver = TRUE
+      AND NOT COALESCE(ui.requiere_encuesta_individual, FALSE)
+    """
+    filas = list(ejecutar_consulta("respuestas_miembro", query_miembro, [
+        bigquery.ScalarQueryParameter("cliente_rol", "STRING", cliente_rol),
+        bigquery.ScalarQueryParameter("instalacion_rol", "STRING", instalacion_rol),
+        bigquery.ScalarQueryParameter("email", "STRING", email),
+    ]))
+    es_miembro = bool(filas and filas[0]['es_miembro'])
+    with _lock_miembros:
+        _cache_miembros[(email, clave)] = (es_miembro, time.monotonic() + MIEMBROS_CACHE_TTL_SEGUNDOS)
+        _cache_miembros.move_to_end((email, clave))
+        if len(_cache_miembros) > SOLICITUDES_CACHE_MAX:
+            _cache_miembros.popitem(last=False)
+    return es_miembro
+
+
+@app.on_event("shutdown")
+def vaciar_cola_respuestas():
+    """Escribe las respuestas encoladas antes de que la instancia se detenga"""
+    cola_respuestas.cerrar()
+
+
+# ============================================
+# ENDPOINT 7: ENCUESTAS PENDIENTES
+# ============================================
+
+@app.get("/api/encuestas/pendientes")
+async def encuestas_pendientes(email: str):
+    """
+    Encuestas que el usuario aún puede responder en el periodo: las
+    individuales a su nombre y las compartidas de sus instalaciones.
+    Se responde desde el índice en memoria, sin consultar BigQuery; si
+    está desactualizado se refresca en segundo plano.
+    """
+    if not indice_pendientes.cargado:
+        # Sin snapshot (o ilegible): la primera carga de la instancia es síncrona
+        await run_in_threadpool(indice_pendientes.actualizar)
+    else:
+        indice_pendientes.actualizar_en_segundo_plano()
+    
+    with metrica_pendientes_segundos.medir():
+        ahora = datetime.now(pytz.UTC)
+        encuestas = [
+            {
+                "encuesta_id": s.encuesta_id,
+                "cliente_rol": s.cliente_rol,
+                "instalacion_rol": s.instalacion_rol,
+                "modo": s.modo,
+                "fecha_limite": s.fecha_limite.isoformat(),
+            }
+            for s in indice_pendientes.pendientes(email, ahora)
+            if s.encuesta_id not in cola_respuestas.respondidas
+        ]
+    
+    return {
+        "email": email.strip().lower(),
+        "periodo": indice_pendientes.periodo,
+        "total": len(encuestas),
+        "encuestas": encuestas,
+        "actualizado": indice_pendientes.marca,
+    }
+
+
+@app.on_event("startup")
+def preparar_indice_pendientes():
+    """Carga el snapshot del índice antes de recibir tráfico y lo pone al día en segundo plano"""
+    indice_pendientes.cargar_snapshot()
+    indice_pendientes.actualizar_en_segundo_plano()
+
+
+# ============================================
+# FUNCIONES AUXILIARES
+# ============================================
+
+def verificar_ventana_envio(config, ahora_chile):
+    """Respuesta de salida si no corresponde enviar ahora, o None"""
+    # Verificar si están activas
+    if not config.notificaciones_activas:
+        log("⚠️ Notificaciones desactivadas")
+        return {"success": True, "message": "Notificaciones desactivadas", "enviadas": 0}
+    
+    # Verificar día laboral (usar hora de Chile)
+    dia_semana = ahora_chile.weekday()  # 0=Lunes, 1=Martes, ..., 4=Viernes, 5=Sábado, 6=Domingo
+    if dia_semana not in config.dias_laborales:
+        log(f"⚠️ Fuera de días laborales. Día actual: {dia_semana}, Días permitidos: {config.dias_laborales}")
+        return {"success": True, "message": "Fuera de días laborales", "enviadas": 0}
+    
+    # Verificar horario (usar hora de Chile)
+    hora_actual = ahora_chile.hour
+    if hora_actual < config.horario_inicio or hora_actual >= config.horario_fin:
+        log(f"⚠️ Fuera de horario. Hora actual: {hora_actual}, Horario permitido: {config.horario_inicio}-{config.horario_fin}")
+        return {"success": True, "message": "Fuera de horario", "enviadas": 0}
+    
+    return None
+
+
+def programar_notificaciones(encuesta_id, instalacion, envios, email_destinatario=None, topico=None):
+    """Programa 3 notificaciones a partir de los envíos precalculados (filas_base)"""
+    return [
+        {
+            **envio,
+            'notificacion_id': str(uuid.uuid4()),
+            'encuesta_id': encuesta_id,
+            'instalacion_rol': instalacion,
+            'email_destinatario': email_destinatario,
+            'topico': topico,
+        }
+        for envio in envios
+    ]
+
+
+def renderizar_notificacion(notif):
+    """Mensaje FCM (token o tópico, título, cuerpo, data) de una fila compacta"""
+    if not notif['fcm_token'] and not notif['topico']:
+        raise ValueError(f"Usuario sin token FCM: {notif['email_destinatario']}")
+    plantilla = PLANTILLAS_NOTIFICACION.get(notif['plantilla_id'])
+    if plantilla is None:
+        raise ValueError(f"Plantilla desconocida: {notif['plantilla_id']}")
+    return {
+        'fcm_token': notif['fcm_token'],
+        'topico': notif['topico'],
+        'titulo': plantilla.titulo,
+        'cuerpo': plantilla.cuerpo.format(instalacion=notif['instalacion_rol']),
+        'data': {'encuesta_id': notif['encuesta_id'], 'tipo': notif['tipo']}
+    }
+
+
+def agrupar_notificaciones(notificaciones):
+    """
+    Agrupa por (fcm_token, tópico, tipo) en el orden de llegada, en grupos de hasta
+    NOTIFICACION_RESUMEN_MAX. Sin AGRUPAR_NOTIFICACIONES cada una va sola.
+    """
+    if not AGRUPAR_NOTIFICACIONES:
+        return [[notif] for notif in notificaciones]
+    grupos = {}
+    for notif in notificaciones:
+        grupos.setdefault((notif['fcm_token'], notif['topico'], notif['tipo']), []).append(notif)
+    return [
+        lote
+        for grupo in grupos.values()
+        for lote in en_lotes(grupo, NOTIFICACION_RESUMEN_MAX)
+    ]
+
+
+def renderizar_grupo(grupo):
+    """Mensaje FCM de un grupo: la notificación misma si es una sola, o un resumen"""
+    if len(grupo) == 1:
+        return renderizar_notificacion(grupo[0])
+    primera = grupo[0]
+    plantilla = PLANTILLAS_RESUMEN[primera['tipo']]
+    encuesta_ids = list(dict.fromkeys(n['encuesta_id'] for n in grupo))
+    instalaciones = list(dict.fromkeys(n['instalacion_rol'] for n in grupo))
+    if len(instalaciones) > 3:
+        instalaciones = instalaciones[:3] + [f"{len(instalaciones) - 3} más"]
+    return {
+        'fcm_token': primera['fcm_token'],
+        'topico': primera['topico'],
+        'titulo': plantilla.titulo,
+        'cuerpo': plantilla.cuerpo.format(
+            cantidad=len(encuesta_ids), instalaciones=", ".join(instalaciones)
+        ),
+        # encuesta_id (la primera) para las versiones de la app que no leen la lista
+        'data': {
+            'encuesta_id': encuesta_ids[0],
+            'encuesta_ids': ",".join(encuesta_ids),
+            'cantidad': str(len(encuesta_ids)),
+            'tipo': primera['tipo'],
+        }
+    }
+
+
+def nueva_solicitud(periodo, cliente_rol, instalacion_rol, modo, email, ahora, fecha_limite):
+    """Fila nueva de encuestas_solicitudes"""
+    return {
+        'encuesta_id': str(uuid.uuid4()),
+        'periodo': periodo,
+        'cliente_rol': cliente_rol,
+        'instalacion_rol': instalacion_rol,
+        'modo': modo,
+        'email_destinatario': email,
+        'estado': 'pendiente',
+        'fecha_creacion': ahora.isoformat(),
+        'fecha_limite': fecha_limite.isoformat(),
+        'respondido_por_email': None,
+        'respondido_por_nombre': None,
+        'tipo_respuesta': None,
+        'fecha_respuesta': None
+    }
+
+
+def filtro_shard(alias, shard_index, shard_count):
+    """Condición SQL y parámetros que asignan cada instalación a un shard por hash"""
+    condicion = (
+        f"MOD(ABS(FARM_FINGERPRINT(CONCAT({alias}.cliente_rol, '|', {alias}.instalacion_rol))), "
+        f"@shard_count) = @shard_index"
+    )
+    parametros = [
+        bigquery.ScalarQueryParameter("shard_index", "INT64", shard_index),
+        bigquery.ScalarQueryParameter("shard_count", "INT64", shard_count),
+    ]
+    return condicion, parametros
+
+
+def inicio_periodo(periodo):
+    """Primer instante (UTC) del periodo YYYYMM; cota inferior para podar particiones"""
+    return datetime.strptime(periodo, "%Y%m").replace(tzinfo=pytz.UTC)
+
+
+def obtener_instalaciones_terminadas(periodo, shard_index, shard_count):
+    """Instalaciones del shard con checkpoint en el periodo"""
+    filtro, parametros = filtro_shard("p", shard_index, shard_count)
+    query = f"""
+    SELECT DISTINCT p.cliente_rol, p.instalacion_rol
+    FROM `{TABLE_ENCUESTAS_GEN_PROGRESO}` p
+    WHERE p.periodo = @periodo
+      AND p.fecha_fin >= @inicio_periodo
+      AND {filtro}
+    """
+    filas = ejecutar_consulta("generacion_terminadas", query, [
+        bigquery.ScalarQueryParameter("periodo", "STRING", periodo),
+        bigquery.ScalarQueryParameter("inicio_periodo", "TIMESTAMP", inicio_periodo(periodo)),
+        *parametros,
+    ])
+    return {(fila.cliente_rol, fila.instalacion_rol) for fila in filas}
+
+
+def obtener_encuestas_existentes(periodo, shard_index, shard_count):
+    """Encuestas del periodo en el shard: (cliente, instalación, modo, email) -> encuesta_id"""
+    filtro, parametros = filtro_shard("s", shard_index, shard_count)
+    query = f"""
+    SELECT s.encuesta_id, s.cliente_rol, s.instalacion_rol, s.modo, s.email_destinatario
+    FROM `{TABLE_ENCUESTAS_SOLICITUDES}` s
+    WHERE s.periodo = @periodo
+      AND s.fecha_creacion >= @inicio_periodo
+      AND {filtro}
+    """
+    filas = ejecutar_consulta("generacion_existentes", query, [
+        bigquery.ScalarQueryParameter("periodo", "STRING", periodo),
+        bigquery.ScalarQueryParameter("inicio_periodo", "TIMESTAMP", inicio_periodo(periodo)),
+        *parametros,
+    ])
+    return {
+        (fila.cliente_rol, fila.instalacion_rol, fila.modo, fila.email_destinatario): fila.encuesta_id
+        for fila in filas
+    }
+
+
+def obtener_notificaciones_existentes(encuesta_ids, periodo):
+    """Notificaciones ya programadas para esas encuestas: {(encuesta_id, email, tipo)}"""
+    if not encuesta_ids:
+        return set()
+    query = f"""
+    SELECT encuesta_id, email_destinatario, tipo
+    FROM `{TABLE_ENCUESTAS_NOTIF_PROG}`
+    WHERE fecha_programada >= @inicio_periodo
+      AND encuesta_id IN UNNEST(@encuesta_ids)
+    """
+    filas = ejecutar_consulta("generacion_notificaciones_existentes", query, [
+        bigquery.ScalarQueryParameter("inicio_periodo", "TIMESTAMP", inicio_periodo(periodo)),
+        bigquery.ArrayQueryParameter("encuesta_ids", "STRING", encuesta_ids),
+    ])
+    return {(fila.encuesta_id, fila.email_destinatario, fila.tipo) for fila in filas}
+
+
+def agrupar_por_instalacion(filas):
+    """Genera ((cliente_rol, instalacion_rol), usuarios) desde filas ordenadas por esa clave"""
+    for clave, grupo in itertools.groupby(filas, key=lambda f: (f.cliente_rol, f.instalacion_rol)):
+        yield clave, [fila for fila in grupo if fila.email_login]
+
+
+def en_lotes(iterable, tamano):
+    """Genera listas de hasta `tamano` elementos sin materializar el iterable"""
+    iterador = iter(iterable)
+    while True:
+        lote = list(itertools.islice(iterador, tamano))
+        if not lote:
+            return
+        yield lote
+
+
+def obtener_fcm_access_token():
+    """Obtiene access token para FCM"""
+    return proveedor_token_fcm.obtener_token()
+
+
+def enviar_fcm(fcm_token, titulo, cuerpo, data, access_token, sesion=None, topico=None):
+    """Envía notificación FCM a un token o, si viene, a un tópico"""
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json',
+    }
+    payload = {
+        'message': {
+            **({'topic': topico} if topico else {'token': fcm_token}),
+            'notification': {'title': titulo, 'body': cuerpo},
+            'data': data,
+            'android': {'priority': 'high'}
+        }
+    }
+    
+    inicio = time.perf_counter()
+    try:
+        response = (sesion or requests).post(
+            FCM_URL, headers=headers, json=payload, timeout=FCM_TIMEOUT_SEGUNDOS
+        )
+        metrica_fcm_segundos.observar(time.perf_counter() - inicio, status=response.status_code)
+        if response.status_code == 200:
+            return {'success': True, 'error': None, 'status_code': 200, 'codigo': None,
+                    'retry_after': None}
+        else:
+            return {
+                'success': False,
+                'error': f"{response.status_code} - {response.text}",
+                'status_code': response.status_code,
+                'codigo': leer_codigo_error_fcm(response),
+                'retry_after': leer_retry_after(response.headers.get('Retry-After'))
+            }
+    except Exception as e:
+        metrica_fcm_segundos.observar(time.perf_counter() - inicio, status="error")
+        return {'success': False, 'error': str(e), 'status_code': None, 'codigo': None,
+                'retry_after': None}
+
+
+def leer_codigo_error_fcm(response):
+    """errorCode de FcmError (p. ej. UNREGISTERED) o, si no viene, el status del error"""
+    try:
+        error = response.json().get('error', {})
+    except ValueError:
+        return None
+    for detalle in error.get('details', []):
+        if detalle.get('errorCode'):
+            return detalle['errorCode']
+    return error.get('status')
+
+
+def clasificar_error_fcm(resultado):
+    """
+    'token_invalido' (el token no sirve más), 'transitorio' (429, 5xx,
+    timeout o error de red: se reintenta) o 'permanente'.
+    """
+    if resultado['codigo'] in CODIGOS_TOKEN_INVALIDO:
+        return 'token_invalido'
+    status_code = resultado['status_code']
+    if status_code is None or status_code == 429 or status_code >= 500:
+        return 'transitorio'
+    return 'permanente'
+
+
+def calcular_espera_reintento(intentos, retry_after=None):
+    """Segundos hasta el próximo intento: base * 2^(intentos-1), acotado, o Retry-After si es mayor"""
+    espera = NOTIFICACION_REINTENTO_BASE_SEGUNDOS * 2 ** (intentos - 1)
+    return min(max(espera, retry_after or 0), NOTIFICACION_REINTENTO_MAX_SEGUNDOS)
+
+
+def leer_retry_after(valor):
+    """Convierte el header Retry-After (segundos) a float"""
+    try:
+        return float(valor) if valor else None
+    except ValueError:
+        return None
+
+
+def filtro_pendientes_desde(desde):
+    """Condición y parámetros keyset para continuar después de `desde`"""
+    if desde is None:
+        return "", []
+    condicion = """
+      AND (n.fecha_programada > @desde_fecha
+           OR (n.fecha_programada = @desde_fecha AND IFNULL(n.email_destinatario, '') > @desde_email)
+           OR (n.fecha_programada = @desde_fecha AND IFNULL(n.email_destinatario, '') = @desde_email
+               AND n.notificacion_id > @desde_id))
+    """
+    parametros = [
+        bigquery.ScalarQueryParameter("desde_fecha", "TIMESTAMP", desde[0]),
+        bigquery.ScalarQueryParameter("desde_email", "STRING", desde[1]),
+        bigquery.ScalarQueryParameter("desde_id", "STRING", desde[2]),
+    ]
+    return condicion, parametros
+
+
+def obtener_notificaciones_pendientes(ahora_utc, desde=None, limite=100):
+    """Hasta `limite` notificaciones vencidas, en una lista"""
+    return [
+        fila
+        for pagina in paginas_notificaciones_pendientes(ahora_utc, desde, limite, limite)
+        for fila in pagina
+    ]
+
+
+def paginas_notificaciones_pendientes(ahora_utc, desde=None, tamano_pagina=TAMANO_PAGINA_DRENADO,
+                                      limite=None):
+    """
+    Genera páginas de notificaciones vencidas ordenadas por (fecha_programada,
+    email_destinatario, notificacion_id): las de un mismo usuario quedan
+    juntas y se pueden agrupar. Solo lee las columnas compactas; el token
+    FCM es el vigente del usuario. Las filas del formato antiguo sin migrar
+    (plantilla_id NULL, ver esquema.py) quedan pendientes hasta completarlas.
+    """
+    condicion, parametros = filtro_pendientes_desde(desde)
+    clausula_limite = "LIMIT @limite" if limite else ""
+    query_notif = f"""
+    SELECT
+        n.notificacion_id,
+        n.plantilla_id,
+        n.encuesta_id,
+        n.tipo,
+        n.instalacion_rol,
+        n.email_destinatario,
+        n.fecha_programada,
+        COALESCE(n.intentos, 0) AS intentos,
+        n.topico,
+        u.fcm_token
+    FROM `{TABLE_ENCUESTAS_NOTIF_PROG}` n
+    LEFT JOIN (
+        SELECT email_login, ANY_VALUE(fcm_token) AS fcm_token
+        FROM `{TABLE_USUARIOS}`
+        WHERE fcm_token IS NOT NULL AND fcm_token != ''
+        GROUP BY email_login
+    ) u ON n.email_destinatario = u.email_login
+    WHERE n.estado = 'pendiente'
+      AND n.fecha_programada BETWEEN @desde_ventana AND @ahora_utc
+      AND n.plantilla_id IS NOT NULL
+      {condicion}
+    ORDER BY n.fecha_programada ASC, IFNULL(n.email_destinatario, '') ASC, n.notificacion_id ASC
+    {clausula_limite}
+    """
+    parametros_limite = [bigquery.ScalarQueryParameter("limite", "INT64", limite)] if limite else []
+    return iterar_paginas("envio_pendientes", query_notif, [
+        *parametros_ventana(ahora_utc),
+        *parametros_limite,
+        *parametros,
+    ], tamano_pagina)
+
+
+def contar_notificaciones_pendientes(ahora_utc, desde=None):
+    """Cuenta notificaciones vencidas después de `desde`"""
+    condicion, parametros = filtro_pendientes_desde(desde)
+    query_count = f"""
+    SELECT COUNT(*) AS restantes
+    FROM `{TABLE_ENCUESTAS_NOTIF_PROG}` n
+    WHERE n.estado = 'pendiente'
+      AND n.fecha_programada BETWEEN @desde_ventana AND @ahora_utc
+      AND n.plantilla_id IS NOT NULL
+      {condicion}
+    """
+    filas = ejecutar_consulta("envio_conteo", query_count, [
+        *parametros_ventana(ahora_utc),
+        *parametros,
+    ])
+    return list(filas)[0].restantes
+
+
+def parametros_ventana(ahora_utc):
+    """Parámetros @desde_ventana/@ahora_utc: rango de fecha_programada que se lee"""
+    return [
+        bigquery.ScalarQueryParameter(
+            "desde_ventana", "TIMESTAMP", ahora_utc - timedelta(days=VENTANA_PENDIENTES_DIAS)
+        ),
+        bigquery.ScalarQueryParameter("ahora_utc", "TIMESTAMP", ahora_utc),
+    ]
+
+
+def codificar_cursor(desde):
+    """Cursor opaco (fecha_programada, email_destinatario, notificacion_id) para reanudar el drenado"""
+    fecha, email, notificacion_id = desde
+    valor = json.dumps([fecha.isoformat(), email, notificacion_id])
+    return base64.urlsafe_b64encode(valor.encode()).decode()
+
+
+def decodificar_cursor(cursor):
+    """Inverso de codificar_cursor"""
+    if not cursor:
+        return None
+    try:
+        fecha, email, notificacion_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(fecha), email, notificacion_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def actualizar_estados_notificaciones(estados, ahora_utc):
+    """Aplica estados de envío con un MERGE por cada lote"""
+    # El rango de fecha_programada en el ON poda particiones de la tabla destino
+    query_merge = f"""
+    MERGE `{TABLE_ENCUESTAS_NOTIF_PROG}` t
+    USING (SELECT * FROM UNNEST(@estados)) s
+    ON t.notificacion_id = s.notificacion_id
+       AND t.fecha_programada BETWEEN @desde_ventana AND @ahora_utc
+    WHEN MATCHED THEN UPDATE SET
+        estado = s.estado,
+        intentos = s.intentos,
+        fecha_programada = IF(s.estado = 'pendiente', s.fecha_programada, t.fecha_programada),
+        fecha_envio = IF(s.estado = 'enviada', s.fecha_envio, t.fecha_envio),
+        error_mensaje = IF(s.estado = 'enviada', t.error_mensaje, s.error_mensaje)
+    """
+    for inicio in range(0, len(estados), TAMANO_LOTE_ESTADOS):
+        lote = estados[inicio:inicio + TAMANO_LOTE_ESTADOS]
+        ejecutar_consulta("envio_estados", query_merge, [
+            *parametros_ventana(ahora_utc),
+            bigquery.ArrayQueryParameter("estados", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("notificacion_id", "STRING", e['notificacion_id']),
+                    bigquery.ScalarQueryParameter("estado", "STRING", e['estado']),
+                    bigquery.ScalarQueryParameter("intentos", "INT64", e['intentos']),
+                    bigquery.ScalarQueryParameter("fecha_programada", "TIMESTAMP", e['fecha_programada']),
+                    bigquery.ScalarQueryParameter("fecha_envio", "TIMESTAMP", e['fecha_envio']),
+                    bigquery.ScalarQueryParameter("error_mensaje", "STRING", e['error_mensaje']),
+                )
+                for e in lote
+            ]),
+        ])
+
+
+def invalidar_tokens_fcm(tokens):
+    """Borra de usuarios_app los tokens que FCM reportó como muertos (UNREGISTERED, …)"""
+    query_tokens = f"""
+    UPDATE `{TABLE_USUARIOS}`
+    SET fcm_token = NULL
+    WHERE fcm_token IN UNNEST(@tokens)
+    """
+    try:
+        ejecutar_consulta("envio_tokens_invalidos", query_tokens, [
+            bigquery.ArrayQueryParameter("tokens", "STRING", sorted(tokens)),
+        ])
+        log(f"🧹 {len(tokens)} tokens FCM inválidos borrados", tokens=len(tokens))
+    except Exception as e:
+        # Las notificaciones ya quedaron fallidas; se reintenta con el próximo error
+        log(f"⚠️ No se pudieron borrar {len(tokens)} tokens FCM inválidos: {e}")
+
+# ============================================
+# CONSULTAS A BIGQUERY
+# ============================================
+
+# Cada job lleva la etiqueta `operacion`: el costo se ve en /metrics y
+# también se puede cruzar en INFORMATION_SCHEMA.JOBS.
+
+# Consumo del trabajo en curso (lo fija correr_trabajo)
+_consumo_trabajo = contextvars.ContextVar("consumo_trabajo", default=None)
+
+
+def ejecutar_consulta(operacion, query, parametros=(), tamano_pagina=None):
+    """Ejecuta una consulta etiquetada con `operacion`, registra su consumo y devuelve las filas"""
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=list(parametros),
+        labels={"operacion": operacion},
+    )
+    inicio = time.perf_counter()
+    job = client.query(query, job_config=job_config)
+    filas = job.result(page_size=tamano_pagina)
+    registrar_consumo(operacion, job, time.perf_counter() - inicio)
+    return filas
+
+
+def iterar_paginas(operacion, query, parametros=(), tamano_pagina=TAMANO_PAGINA_CONSULTA):
+    """
+    Genera el resultado en listas de hasta `tamano_pagina` filas; cada página
+    se pide recién cuando se consume la anterior. Resultados grandes se leen
+    con la Storage Read API si está instalada. La consulta se lanza al pedir
+    la primera página.
+    """
+    filas = ejecutar_consulta(operacion, query, parametros, tamano_pagina)
+    cliente_storage = obtener_cliente_storage(filas.total_rows)
+    if cliente_storage is None:
+        paginas = (list(pagina) for pagina in filas.pages)
+    else:
+        paginas = en_lotes(filas_storage(filas, cliente_storage), tamano_pagina)
+    while True:
+        with metrica_bq_segundos.medir(operacion=operacion, etapa="lectura"):
+            pagina = next(paginas, None)
+        if pagina is None:
+            return
+        yield pagina
+
+
+def iterar_consulta(operacion, query, parametros=(), tamano_pagina=TAMANO_PAGINA_CONSULTA):
+    """Genera las filas del resultado una a una, leyendo por páginas"""
+    for pagina in iterar_paginas(operacion, query, parametros, tamano_pagina):
+        yield from pagina
+
+
+_cliente_storage = None
+_lock_cliente_storage = threading.Lock()
+
+
+def obtener_cliente_storage(total_filas):
+    """Cliente de la Storage Read API si conviene para `total_filas`, o None"""
+    global _cliente_storage
+    if bigquery_storage is None or not USAR_STORAGE_API:
+        return None
+    if (total_filas or 0) < STORAGE_API_UMBRAL_FILAS:
+        return None
+    with _lock_cliente_storage:
+        if _cliente_storage is None:
+            _cliente_storage = bigquery_storage.BigQueryReadClient()
+        return _cliente_storage
+
+
+def filas_storage(filas, cliente_storage):
+    """Filas (bigquery.Row) leídas por lotes Arrow desde la Storage Read API"""
+    indices = {campo.name: i for i, campo in enumerate(filas.schema)}
+    for lote in filas.to_arrow_iterable(bqstorage_client=cliente_storage):
+        columnas = [columna.to_pylist() for columna in lote.columns]
+        for valores in zip(*columnas):
+            yield bigquery.Row(valores, indices)
+
+
+def registrar_consumo(operacion, job, segundos):
+    """Registra duración, bytes y slot-ms del job en las métricas y en el trabajo en curso"""
+    consumo = {
+        'consultas': 1,
+        'segundos': segundos,
+        'bytes_procesados': job.total_bytes_processed or 0,
+        'bytes_facturados': job.total_bytes_billed or 0,
+        'slot_ms': job.slot_millis or 0,
+    }
+    metrica_bq_segundos.observar(segundos, operacion=operacion, etapa="ejecucion")
+    metrica_bq_jobs.inc(operacion=operacion)
+    metrica_bq_bytes_procesados.inc(consumo['bytes_procesados'], operacion=operacion)
+    metrica_bq_bytes_facturados.inc(consumo['bytes_facturados'], operacion=operacion)
+    metrica_bq_slot_ms.inc(consumo['slot_ms'], operacion=operacion)
+    
+    consumo_trabajo = _consumo_trabajo.get()
+    if consumo_trabajo is not None:
+        with _lock_trabajos:
+            total = consumo_trabajo.setdefault(operacion, dict.fromkeys(consumo, 0))
+            for campo, valor in consumo.items():
+                total[campo] += valor
+    log(f"📊 {operacion}: {consumo['bytes_procesados'] / 1024 ** 2:.1f} MiB procesados",
+        operacion=operacion, job_id=job.job_id, **consumo)
+
+
+# ============================================
+# ESCRITURA EN BIGQUERY
+# ============================================
+
+class EscritorBigQuery:
+    """
+    Escribe filas con load jobs divididos por cantidad de filas y bytes.
+    A diferencia de insert_rows_json, las filas quedan confirmadas al
+    terminar el job (sin streaming buffer) y se pueden modificar con DML.
+    
+    escribir() devuelve una lista de errores, vacía si todo se escribió;
+    cada error trae los ids de las filas del lote afectado.
+    """
+    
+    def __init__(self, cliente=None, max_filas=ESCRITURA_MAX_FILAS, max_bytes=ESCRITURA_MAX_BYTES):
+        self.cliente = cliente
+        self.max_filas = max_filas
+        self.max_bytes = max_bytes
+        self._esquemas = {}
+    
+    def escribir(self, tabla, filas, campo_id):
+        errores = []
+        nombre_tabla = tabla.split(".")[-1]
+        for lote in self.dividir(filas):
+            try:
+                with metrica_bq_segundos.medir(operacion=f"carga_{nombre_tabla}", etapa="carga"):
+                    self._escribir_lote(tabla, lote)
+                metrica_bq_filas_escritas.inc(len(lote), tabla=nombre_tabla)
+            except Exception as e:
+                log(f"❌ Error escribiendo {len(lote)} filas en {tabla}: {e}")
+                errores.append({
+                    'error': str(e),
+                    'ids': [fila.get(campo_id) for fila in lote]
+                })
+        return errores
+    
+    def dividir(self, filas):
+        """Agrupa filas serializadas en lotes bajo max_filas y max_bytes"""
+        lote = []
+        bytes_lote = 0
+        for fila in filas:
+            fila = serializar_fila(fila)
+            tamano = len(json.dumps(fila, ensure_ascii=False).encode()) + 1
+            if lote and (len(lote) >= self.max_filas or bytes_lote + tamano > self.max_bytes):
+                yield lote
+                lote = []
+                bytes_lote = 0
+            lote.append(fila)
+            bytes_lote += tamano
+        if lote:
+            yield lote
+    
+    def _escribir_lote(self, tabla, lote):
+        job_config = bigquery.LoadJobConfig(
+            schema=self._esquema(tabla),
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        self.cliente.load_table_from_json(lote, tabla, job_config=job_config).result()
+    
+    def _esquema(self, tabla):
+        if tabla not in self._esquemas:
+            self._esquemas[tabla] = self.cliente.get_table(tabla).schema
+        return self._esquemas[tabla]
+
+
+class EscritorMemoria(EscritorBigQuery):
+    """Escritor local para pruebas: guarda las filas en self.tablas"""
+    
+    def __init__(self, max_filas=ESCRITURA_MAX_FILAS, max_bytes=ESCRITURA_MAX_BYTES):
+        super().__init__(None, max_filas, max_bytes)
+        self.tablas = {}
+    
+    def _escribir_lote(self, tabla, lote):
+        self.tablas.setdefault(tabla, []).extend(lote)
+
+
+def serializar_fila(fila):
+    """Convierte datetimes a ISO 8601 para poder enviarlos como JSON"""
+    return {
+        campo: valor.isoformat() if isinstance(valor, datetime) else valor
+        for campo, valor in fila.items()
+    }
+
+
+escritor = EscritorBigQuery(client)
+
+
+# ============================================
+# COLA DE RESPUESTAS
+# ============================================
+
+class ColaRespuestas:
+    """
+    Respuestas aceptadas a la espera de escritura. Un hilo las escribe en
+    lotes de hasta max_envios, o cuando la más antigua cumple max_segundos.
+    `respondidas` guarda las encuestas aceptadas por esta instancia: la
+    primera respuesta gana sin consultar BigQuery. Un lote que no se pudo
+    escribir vuelve al frente de la cola y se reintenta: ya se respondió 202.
+    """
+    
+    def __init__(self, escribir_lote, max_envios=RESPUESTAS_LOTE_MAX, max_segundos=RESPUESTAS_LOTE_SEGUNDOS):
+        self.escribir_lote = escribir_lote
+        self.max_envios = max_envios
+        self.max_segundos = max_segundos
+        self.respondidas = set()
+        self._pendientes = []
+        self._condicion = threading.Condition()
+        self._hilo = None
+        self._cerrada = False
+        self._fallos = 0
+        self._reintento_en = 0
+        self._en_escritura = []
+    
+    def agregar(self, envio):
+        """Encola el envío; False si la encuesta ya tenía respuesta"""
+        with self._condicion:
+            if envio['encuesta_id'] in self.respondidas:
+                return False
+            self.respondidas.add(envio['encuesta_id'])
+            self._pendientes.append({**envio, 'recibido': time.monotonic()})
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._correr, name="cola-respuestas", daemon=True)
+                self._hilo.start()
+            self._condicion.notify()
+        return True
+    
+    def cerrar(self, timeout=RESPUESTAS_CIERRE_SEGUNDOS):
+        """Escribe lo pendiente y detiene el hilo; registra lo que no alcanzó a escribirse"""
+        with self._condicion:
+            self._cerrada = True
+            self._reintento_en = 0
+            self._condicion.notify()
+        if self._hilo:
+            self._hilo.join(timeout)
+        
+        with self._condicion:
+            sin_escribir = self._en_escritura + self._pendientes
+        if sin_escribir:
+            # Quedan en el log para recuperarlas: el cliente ya recibió 202
+            log(
+                f"❌ {len(sin_escribir)} respuestas sin escribir al detener la instancia",
+                severidad="ERROR",
+                envios=[{k: v for k, v in envio.items() if k != 'recibido'} for envio in sin_escribir],
+            )
+    
+    def _correr(self):
+        while True:
+            with self._condicion:
+                while not self._pendientes and not self._cerrada:
+                    self._condicion.wait()
+                if not self._pendientes:
+                    return
+                # Tras un fallo, esperar el reintento
+                while (restante := self._reintento_en - time.monotonic()) > 0:
+                    self._condicion.wait(restante)
+                # Esperar a llenar el lote o a que venza el plazo del más antiguo
+                plazo = self._pendientes[0]['recibido'] + self.max_segundos
+                while len(self._pendientes) < self.max_envios and not self._cerrada:
+                    restante = plazo - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._condicion.wait(restante)
+                lote = self._pendientes[:self.max_envios]
+                del self._pendientes[:self.max_envios]
+                self._en_escritura = lote
+            self._escribir(lote)
+    
+    def _escribir(self, lote):
+        try:
+            with metrica_etapa_segundos.medir(etapa="respuestas_escritura"):
+                self.escribir_lote(lote)
+        except Exception as e:
+            with self._condicion:
+                # Vuelve al frente de la cola: nunca se descarta una respuesta aceptada
+                self._pendientes[:0] = lote
+                self._en_escritura = []
+                self._fallos += 1
+                tope = 1 if self._cerrada else RESPUESTAS_REINTENTO_MAX_SEGUNDOS
+                espera = min(2 ** (self._fallos - 1), tope)
+                self._reintento_en = time.monotonic() + espera
+            log(f"⚠️ Error escribiendo {len(lote)} respuestas (fallo {self._fallos}), reintento en {espera:.0f}s: {e}")
+            return
+        
+        with self._condicion:
+            self._en_escritura = []
+            self._fallos = 0
+
+
+def escribir_lote_respuestas(lote):
+    """
+    Escribe un lote de respuestas en una transacción: primero el MERGE que
+    completa las solicitudes que seguían pendientes (la primera respuesta
+    gana, también entre instancias) y después solo las filas de los envíos
+    que quedaron como respuesta de su solicitud. Un reintento no duplica
+    filas: las respuesta_id ya escritas se omiten.
+    """
+    script = f"""
+    DECLARE filas_insertadas INT64 DEFAULT 0;
+    
+    BEGIN TRANSACTION;
+    
+    -- 1. Solicitudes completadas (solo si seguían pendientes)
+    MERGE `{TABLE_ENCUESTAS_SOLICITUDES}` t
+    USING (SELECT * FROM UNNEST(@respondidas)) s
+    ON t.encuesta_id = s.encuesta_id
+       AND t.fecha_creacion >= @desde
+    WHEN MATCHED AND t.estado = 'pendiente' THEN UPDATE SET
+        estado = 'completada',
+        respondido_por_email = s.email_login,
+        respondido_por_nombre = s.nombre,
+        fecha_respuesta = s.fecha_respuesta;
+    
+    -- 2. Respuestas de los envíos ganadores (mismo email y fecha que la solicitud)
+    INSERT INTO `{TABLE_ENCUESTAS_RESPUESTAS}` (
+        respuesta_id, encuesta_id, pregunta_id, email_login, valor, comentario, fecha_respuesta
+    )
+    SELECT r.respuesta_id, r.encuesta_id, r.pregunta_id, r.email_login, r.valor, r.comentario,
+           r.fecha_respuesta
+    FROM UNNEST(@filas) r
+    JOIN `{TABLE_ENCUESTAS_SOLICITUDES}` t
+      ON t.encuesta_id = r.encuesta_id
+     AND t.fecha_creacion >= @desde
+     AND t.respondido_por_email = r.email_login
+     AND t.fecha_respuesta = r.fecha_respuesta
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM `{TABLE_ENCUESTAS_RESPUESTAS}` x
+        WHERE x.fecha_respuesta >= @desde_respuesta
+          AND x.respuesta_id = r.respuesta_id
+    );
+    SET filas_insertadas = @@row_count;
+    
+    COMMIT TRANSACTION;
+    
+    SELECT filas_insertadas;
+    """
+    filas = list(ejecutar_consulta("respuestas_completar", script, [
+        bigquery.ScalarQueryParameter("desde", "TIMESTAMP", min(e['fecha_creacion'] for e in lote)),
+        bigquery.ScalarQueryParameter(
+            "desde_respuesta", "TIMESTAMP", min(e['fecha_respuesta'] for e in lote)
+        ),
+        bigquery.ArrayQueryParameter("respondidas", "STRUCT", [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("encuesta_id", "STRING", e['encuesta_id']),
+                bigquery.ScalarQueryParameter("email_login", "STRING", e['email_login']),
+                bigquery.ScalarQueryParameter("nombre", "STRING", e['nombre']),
+                bigquery.ScalarQueryParameter("fecha_respuesta", "TIMESTAMP", e['fecha_respuesta']),
+            )
+            for e in lote
+        ]),
+        bigquery.ArrayQueryParameter("filas", "STRUCT", [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("respuesta_id", "STRING", f['respuesta_id']),
+                bigquery.ScalarQueryParameter("encuesta_id", "STRING", f['encuesta_id']),
+                bigquery.ScalarQueryParameter("pregunta_id", "STRING", f['pregunta_id']),
+                bigquery.ScalarQueryParameter("email_login", "STRING", f['email_login']),
+                bigquery.ScalarQueryParameter("valor", "INT64", f['valor']),
+                bigquery.ScalarQueryParameter("comentario", "STRING", f['comentario']),
+                bigquery.ScalarQueryParameter("fecha_respuesta", "TIMESTAMP", f['fecha_respuesta']),
+            )
+            for e in lote for f in e['filas']
+        ]),
+    ]))
+    insertadas = filas[0]['filas_insertadas'] if filas else 0
+    metrica_bq_filas_escritas.inc(insertadas, tabla="encuestas_respuestas")
+    log(f"📝 {len(lote)} encuestas respondidas escritas ({insertadas} respuestas)",
+        encuestas=len(lote), respuestas=insertadas)
+
+
+cola_respuestas = ColaRespuestas(escribir_lote_respuestas)
+
+
+# ============================================
+# ÍNDICE DE ENCUESTAS PENDIENTES
+# ============================================
+
+class IndicePendientes:
+    """
+    Encuestas pendientes del periodo en memoria: las individuales por email
+    y las compartidas por (cliente_rol, instalacion_rol), más las
+    instalaciones que ve cada usuario. La primera carga lee el periodo; las
+    siguientes solo las solicitudes creadas o respondidas desde la última
+    marca. El snapshot compartido (GCS o volumen montado) evita la primera
+    carga en una instancia nueva.
+    """
+    
+    def __init__(self, ruta_snapshot=INDICE_SNAPSHOT_RUTA):
+        self.ruta_snapshot = ruta_snapshot
+        self.periodo = None
+        self.marca = None  # inicio (UTC) de la última actualización aplicada
+        self.miembros_leidos = None
+        self._solicitudes = {}
+        self._por_email = {}
+        self._por_instalacion = {}
+        self._miembros = {}
+        self._proxima = 0.0
+        self._snapshot_escrito = 0.0
+        self._en_curso = False
+        self._lock = threading.Lock()
+        self._lock_actualizacion = threading.Lock()
+    
+    @property
+    def cargado(self):
+        return self.periodo is not None
+    
+    # ---------- Lectura ----------
+    
+    def pendientes(self, email, ahora):
+        """Solicitudes no vencidas que `email` puede responder, por fecha límite"""
+        email = email.strip().lower()
+        with self._lock:
+            encuesta_ids = set(self._por_email.get(email, ()))
+            for clave in self._miembros.get(email, ()):
+                encuesta_ids.update(self._por_instalacion.get(clave, ()))
+            solicitudes = [self._solicitudes[encuesta_id] for encuesta_id in encuesta_ids]
+        return sorted(
+            (s for s in solicitudes if s.fecha_limite > ahora),
+            key=lambda s: (s.fecha_limite, s.instalacion_rol, s.encuesta_id)
+        )
+    
+    def solicitud(self, encuesta_id):
+        """Solicitud pendiente del índice, o None"""
+        with self._lock:
+            return self._solicitudes.get(encuesta_id)
+    
+    def instalaciones_de(self, email):
+        """(cliente_rol, instalacion_rol) cuya compartida responde `email`; None si aún no se leyeron"""
+        with self._lock:
+            if self.miembros_leidos is None:
+                return None
+            return self._miembros.get(email.strip().lower(), ())
+    
+    def quitar(self, encuesta_id):
+        """Saca una encuesta respondida sin esperar a la próxima actualización"""
+        with self._lock:
+            self._quitar(encuesta_id)
+    
+    # ---------- Actualización ----------
+    
+    def actualizar_en_segundo_plano(self):
+        """Lanza una actualización en un hilo si el índice está desactualizado y no hay otra en curso"""
+        with self._lock:
+            if self._en_curso or (self.cargado and time.monotonic() < self._proxima):
+                return
+            self._en_curso = True
+        threading.Thread(target=self._actualizar_en_hilo, name="indice-pendientes", daemon=True).start()
+    
+    def _actualizar_en_hilo(self):
+        try:
+            self.actualizar()
+        except Exception as e:
+            log(f"⚠️ Error actualizando el índice de pendientes: {e}")
+        finally:
+            with self._lock:
+                self._en_curso = False
+    
+    def actualizar(self):
+        """Pone el índice al día (una actualización a la vez; las demás esperan y la reutilizan)"""
+        with self._lock_actualizacion:
+            if self.cargado and time.monotonic() < self._proxima:
+                return
+            self._proxima = time.monotonic() + INDICE_REFRESCO_SEGUNDOS
+            ahora = datetime.now(pytz.UTC)
+            periodo = ahora.strftime("%Y%m")
+            with metrica_etapa_segundos.medir(etapa="indice_pendientes"):
+                # 1. Instalaciones de cada usuario (sin marca de cambios: se releen completas)
+                if (self.miembros_leidos is None
+                        or (ahora - self.miembros_leidos).total_seconds() > INDICE_MIEMBROS_SEGUNDOS):
+                    miembros = leer_instalaciones_usuarios()
+                    with self._lock:
+                        self._miembros = miembros
+                    self.miembros_leidos = ahora
+                
+                # 2. Solicitudes: el periodo completo al partir o al cambiar de mes, si no los cambios
+                if periodo != self.periodo:
+                    self._cargar_periodo(periodo, ahora)
+                else:
+                    self._aplicar_cambios(periodo, ahora)
+                self.marca = ahora
+            
+            if time.monotonic() >= self._snapshot_escrito + INDICE_SNAPSHOT_SEGUNDOS:
+                self.guardar_snapshot()
+    
+    def _cargar_periodo(self, periodo, ahora):
+        solicitudes = {}
+        for pagina in leer_solicitudes_periodo(periodo, ahora):
+            for fila in pagina:
+                solicitudes[fila['encuesta_id']] = Solicitud(**dict(fila))
+        self._reemplazar(periodo, solicitudes)
+        log(f"📇 Índice de pendientes cargado: {len(solicitudes)} encuestas del periodo {periodo}",
+            periodo=periodo, encuestas=len(solicitudes))
+    
+    def _aplicar_cambios(self, periodo, ahora):
+        # El margen cubre escrituras que se hacen visibles después de la marca;
+        # aplicar una fila dos veces no cambia el resultado
+        desde = self.marca - timedelta(seconds=INDICE_MARGEN_SEGUNDOS)
+        cambios = 0
+        for pagina in leer_solicitudes_periodo(periodo, ahora, desde):
+            with self._lock:
+                for fila in pagina:
+                    if fila['estado'] == 'pendiente' and fila['fecha_limite'] > ahora:
+                        self._poner(Solicitud(**dict(fila)))
+                    else:
+                        self._quitar(fila['encuesta_id'])
+            cambios += len(pagina)
+        if cambios:
+            log(f"📇 Índice de pendientes: {cambios} solicitudes revisadas desde {desde.isoformat()}",
+                cambios=cambios, pendientes=len(self._solicitudes))
+    
+    def _reemplazar(self, periodo, solicitudes, miembros=None):
+        """Cambia todo el contenido de una vez (el índice nuevo se arma fuera del lock)"""
+        por_email = {}
+        por_instalacion = {}
+        for solicitud in solicitudes.values():
+            indice, clave = self._ubicacion(solicitud, por_email, por_instalacion)
+            indice.setdefault(clave, set()).add(solicitud.encuesta_id)
+        with self._lock:
+            self._solicitudes = solicitudes
+            self._por_email = por_email
+            self._por_instalacion = por_instalacion
+            if miembros is not None:
+                self._miembros = miembros
+            self.periodo = periodo
+    
+    @staticmethod
+    def _ubicacion(solicitud, por_email, por_instalacion):
+        """(índice, clave) donde va la solicitud: por email si es individual, si no por instalación"""
+        if solicitud.modo == 'individual':
+            return por_email, (solicitud.email_destinatario or '').lower()
+        return por_instalacion, (solicitud.cliente_rol, solicitud.instalacion_rol)
+    
+    def _poner(self, solicitud):
+        self._quitar(solicitud.encuesta_id)
+        self._solicitudes[solicitud.encuesta_id] = solicitud
+        indice, clave = self._ubicacion(solicitud, self._por_email, self._por_instalacion)
+        indice.setdefault(clave, set()).add(solicitud.encuesta_id)
+    
+    def _quitar(self, encuesta_id):
+        solicitud = self._solicitudes.pop(encuesta_id, None)
+        if solicitud is None:
+            return
+        indice, clave = self._ubicacion(solicitud, self._por_email, self._por_instalacion)
+        encuesta_ids = indice.get(clave)
+        if encuesta_ids:
+            encuesta_ids.discard(encuesta_id)
+            if not encuesta_ids:
+                del indice[clave]
+    
+    # ---------- Snapshot ----------
+    
+    def guardar_snapshot(self):
+        """
+        Escribe el índice en ruta_snapshot (JSON por líneas con gzip), línea a
+        línea para no duplicarlo en memoria, en un temporal que después
+        reemplaza al anterior. Se descarta si supera INDICE_SNAPSHOT_MAX_BYTES.
+        """
+        if not self.ruta_snapshot or not self.cargado:
+            return
+        self._snapshot_escrito = time.monotonic()
+        with self._lock:
+            solicitudes = list(self._solicitudes.values())
+            miembros = list(self._miembros.items())
+        
+        cabecera = {
+            "periodo": self.periodo,
+            "marca": self.marca.isoformat(),
+            "miembros_leidos": self.miembros_leidos.isoformat(),
+        }
+        lineas = itertools.chain(
+            [cabecera],
+            (
+                ["s", s.encuesta_id, s.cliente_rol, s.instalacion_rol, s.modo, s.email_destinatario,
+                 s.fecha_creacion.isoformat(), s.fecha_limite.isoformat()]
+                for s in solicitudes
+            ),
+            (["m", email, claves] for email, claves in miembros),
+        )
+        # Temporal propio de la instancia: varias escriben el mismo snapshot
+        temporal = f"{self.ruta_snapshot}.{uuid.uuid4().hex}.tmp"
+        escritos = 0
+        try:
+            with abrir_snapshot(temporal, "wb") as crudo:
+                with gzip.open(crudo, "wt", encoding="utf-8") as archivo:
+                    for linea in lineas:
+                        texto = json.dumps(linea, ensure_ascii=False) + "\n"
+                        escritos += len(texto)
+                        if escritos > INDICE_SNAPSHOT_MAX_BYTES:
+                            raise ValueError(f"supera {INDICE_SNAPSHOT_MAX_BYTES} bytes")
+                        archivo.write(texto)
+            reemplazar_snapshot(temporal, self.ruta_snapshot)
+        except Exception as e:
+            log(f"⚠️ No se guardó el snapshot del índice de pendientes: {e}")
+            borrar_snapshot(temporal)
+            return
+        log(f"💾 Snapshot del índice de pendientes: {len(solicitudes)} encuestas",
+            ruta=self.ruta_snapshot, bytes=escritos)
+    
+    def cargar_snapshot(self):
+        """Restaura el snapshot si es del periodo actual; True si se cargó"""
+        if not self.ruta_snapshot:
+            return False
+        periodo = datetime.now(pytz.UTC).strftime("%Y%m")
+        solicitudes = {}
+        miembros = {}
+        instalaciones = {}
+        leidos = 0
+        try:
+            with abrir_snapshot(self.ruta_snapshot, "rb") as crudo:
+                with gzip.open(crudo, "rt", encoding="utf-8") as archivo:
+                    cabecera = json.loads(next(archivo))
+                    if cabecera["periodo"] != periodo:
+                        log(f"⚠️ Snapshot del índice de pendientes de otro periodo: {cabecera['periodo']}")
+                        return False
+                    for linea in archivo:
+                        leidos += len(linea)
+                        if leidos > INDICE_SNAPSHOT_MAX_BYTES:
+                            raise ValueError(f"supera {INDICE_SNAPSHOT_MAX_BYTES} bytes")
+                        tipo, *campos = json.loads(linea)
+                        if tipo == "s":
+                            encuesta_id, cliente_rol, instalacion_rol, modo, email, creacion, limite = campos
+                            solicitudes[encuesta_id] = Solicitud(
+                                encuesta_id, cliente_rol, instalacion_rol, modo, email, 'pendiente',
+                                datetime.fromisoformat(creacion), datetime.fromisoformat(limite)
+                            )
+                        else:
+                            email, claves = campos
+                            # Una sola tupla por instalación, compartida entre usuarios
+                            miembros[email] = tuple(
+                                instalaciones.setdefault(tuple(clave), tuple(clave)) for clave in claves
+                            )
+        except (FileNotFoundError, NotFound):
+            log("📇 Sin snapshot del índice de pendientes", ruta=self.ruta_snapshot)
+            return False
+        except Exception as e:
+            log(f"⚠️ No se pudo leer el snapshot del índice de pendientes: {e}")
+            return False
+        
+        with self._lock_actualizacion:
+            if self.cargado:
+                return False
+            self._reemplazar(periodo, solicitudes, miembros)
+            self.marca = datetime.fromisoformat(cabecera["marca"])
+            self.miembros_leidos = datetime.fromisoformat(cabecera["miembros_leidos"])
+        log(f"📇 Índice de pendientes restaurado del snapshot: {len(solicitudes)} encuestas",
+            periodo=periodo, encuestas=len(solicitudes), marca=cabecera["marca"])
+        return True
+
+
+_cliente_gcs = None
+
+
+def objeto_gcs(ruta):
+    """Blob de Cloud Storage para una ruta gs://bucket/objeto"""
+    global _cliente_gcs
+    if storage is None:
+        raise RuntimeError("google-cloud-storage no está instalado")
+    if _cliente_gcs is None:
+        _cliente_gcs = storage.Client(project=PROJECT_ID)
+    bucket, _, nombre = ruta[len("gs://"):].partition("/")
+    return _cliente_gcs.bucket(bucket).blob(nombre)
+
+
+def abrir_snapshot(ruta, modo):
+    """Archivo binario del snapshot ('rb' o 'wb'): objeto de GCS o archivo local"""
+    if ruta.startswith("gs://"):
+        objeto = objeto_gcs(ruta)
+        if modo == "wb":
+            # gzip llama flush(), que el escritor de GCS solo acepta si se ignora
+            return objeto.open(modo, ignore_flush=True)
+        return objeto.open(modo)
+    return open(ruta, modo)
+
+
+def reemplazar_snapshot(temporal, ruta):
+    """Pone el temporal en lugar del snapshot: nunca se lee uno a medio escribir"""
+    if ruta.startswith("gs://"):
+        origen = objeto_gcs(temporal)
+        origen.bucket.copy_blob(origen, origen.bucket, objeto_gcs(ruta).name)
+        origen.delete()
+    else:
+        os.replace(temporal, ruta)
+
+
+def borrar_snapshot(ruta):
+    """Borra un snapshot (o temporal) si existe"""
+    try:
+        if ruta.startswith("gs://"):
+            objeto_gcs(ruta).delete()
+        elif os.path.exists(ruta):
+            os.remove(ruta)
+    except NotFound:
+        pass
+    except Exception as e:
+        log(f"⚠️ No se pudo borrar {ruta}: {e}")
+
+
+def leer_solicitudes_periodo(periodo, ahora, desde=None):
+    """
+    Páginas de solicitudes del periodo: las pendientes y no vencidas, o con
+    `desde` las creadas o respondidas desde esa fecha (en cualquier estado)
+    """
+    parametros = [
+        bigquery.ScalarQueryParameter("periodo", "STRING", periodo),
+        bigquery.ScalarQueryParameter("inicio_periodo", "TIMESTAMP", inicio_periodo(periodo)),
+    ]
+    if desde is None:
+        operacion = "pendientes_carga"
+        filtro = "s.estado = 'pendiente' AND s.fecha_limite > @ahora"
+        parametros.append(bigquery.ScalarQueryParameter("ahora", "TIMESTAMP", ahora))
+    else:
+        operacion = "pendientes_cambios"
+        filtro = "(s.fecha_creacion >= @desde OR s.fecha_respuesta >= @desde)"
+        parametros.append(bigquery.ScalarQueryParameter("desde", "TIMESTAMP", desde))
+    
+    query_solicitudes = f"""
+    SELECT s.encuesta_id, s.cliente_rol, s.instalacion_rol, s.modo, s.email_destinatario,
+           s.estado, s.fecha_creacion, s.fecha_limite
+    FROM `{TABLE_ENCUESTAS_SOLICITUDES}` s
+    WHERE s.periodo = @periodo
+      AND s.fecha_creacion >= @inicio_periodo
+      AND {filtro}
+    """
+    return iterar_paginas(operacion, query_solicitudes, parametros)
+
+
+def leer_instalaciones_usuarios():
+    """
+    {email en minúsculas: ((cliente_rol, instalacion_rol), ...)} de los
+    usuarios activos que responden la encuesta compartida de su instalación
+    """
+    query_miembros = f"""
+    SELECT LOWER(u.email_login) AS email, ui.cliente_rol, ui.instalacion_rol
+    FROM `{TABLE_USUARIO_INST}` ui
+    JOIN `{TABLE_USUARIOS}` u
+      ON ui.email_login = u.email_login
+     AND u.activo = TRUE
+    WHERE ui.puede_ver = TRUE
+      AND NOT COALESCE(ui.requiere_encuesta_individual, FALSE)
+    """
+    instalaciones = {}
+    miembros = {}
+    for fila in iterar_consulta("pendientes_miembros", query_miembros):
+        clave = (fila['cliente_rol'], fila['instalacion_rol'])
+        miembros.setdefault(fila['email'], []).append(instalaciones.setdefault(clave, clave))
+    return {email: tuple(claves) for email, claves in miembros.items()}
+
+
+indice_pendientes = IndicePendientes()
+
+
+# ============================================
+# CONFIGURACIÓN ACTIVA (CACHÉ)
+# ============================================
+
+@dataclass(frozen=True)
+class ConfiguracionEncuestas:
+    """Fila activa de encuestas_configuracion"""
+    dias_para_responder: int
+    dia_recordatorio_1: int
+    dia_recordatorio_2: int
+    notificaciones_activas: bool
+    horario_inicio: int
+    horario_fin: int
+    dias_laborales: tuple
+    
+    @classmethod
+    def desde_fila(cls, fila):
+        return cls(
+            dias_para_responder=fila['dias_para_responder'],
+            dia_recordatorio_1=fila['dia_recordatorio_1'],
+            dia_recordatorio_2=fila['dia_recordatorio_2'],
+            notificaciones_activas=bool(fila['notificaciones_activas']),
+            horario_inicio=fila['horario_inicio'],
+            horario_fin=fila['horario_fin'],
+            dias_laborales=tuple(fila['dias_laborales'] or ()),
+        )
+
+
+_cache_configuracion = {'config': None, 'expira': 0.0}
+_lock_configuracion = threading.Lock()
+
+
+def obtener_configuracion():
+    """Configuración activa, leída de BigQuery a lo más una vez por CONFIG_TTL_SEGUNDOS"""
+    with _lock_configuracion:
+        if _cache_configuracion['config'] and time.monotonic() < _cache_configuracion['expira']:
+            return _cache_configuracion['config']
+        
+        query_config = f"""
+        SELECT
+            dias_para_responder, dia_recordatorio_1, dia_recordatorio_2,
+            notificaciones_activas, horario_inicio, horario_fin, dias_laborales
+        FROM `{TABLE_ENCUESTAS_CONFIG}`
+        WHERE activo = TRUE
+        LIMIT 1
+        """
+        config_result = list(ejecutar_consulta("configuracion", query_config))
+        if not config_result:
+            raise HTTPException(status_code=400, detail="No hay configuración activa")
+        
+        config = ConfiguracionEncuestas.desde_fila(config_result[0])
+        _cache_configuracion['config'] = config
+        _cache_configuracion['expira'] = time.monotonic() + CONFIG_TTL_SEGUNDOS
+        return config
+
+
+def invalidar_cache_configuracion():
+    """Fuerza la relectura de la configuración activa"""
+    with _lock_configuracion:
+        _cache_configuracion['config'] = None
+        _cache_configuracion['expira'] = 0.0
+
+
+@dataclass(frozen=True)
+class Pregunta:
+    """Fila activa de encuestas_preguntas"""
+    pregunta_id: str
+    orden: int
+    texto: str
+    tipo: str  # "escala" (1-5) o "texto"
+    permite_comentario: bool
+
+
+_cache_preguntas = {'preguntas': None, 'expira': 0.0}
+_lock_preguntas = threading.Lock()
+
+
+def obtener_preguntas():
+    """Preguntas activas {pregunta_id: Pregunta}, leídas a lo más una vez por CONFIG_TTL_SEGUNDOS"""
+    with _lock_preguntas:
+        if _cache_preguntas['preguntas'] and time.monotonic() < _cache_preguntas['expira']:
+            return _cache_preguntas['preguntas']
+        
+        query_preguntas = f"""
+        SELECT pregunta_id, orden, texto, tipo, COALESCE(permite_comentario, FALSE) AS permite_comentario
+        FROM `{TABLE_ENCUESTAS_PREGUNTAS}`
+        WHERE activo = TRUE
+        ORDER BY orden
+        """
+        preguntas = {
+            fila['pregunta_id']: Pregunta(**dict(fila))
+            for fila in ejecutar_consulta("preguntas", query_preguntas)
+        }
+        if not preguntas:
+            raise HTTPException(status_code=503, detail="No hay preguntas activas")
+        
+        _cache_preguntas['preguntas'] = preguntas
+        _cache_preguntas['expira'] = time.monotonic() + CONFIG_TTL_SEGUNDOS
+        return preguntas
+
+
+def invalidar_cache_preguntas():
+    """Fuerza la relectura de las preguntas activas"""
+    with _lock_preguntas:
+        _cache_preguntas['preguntas'] = None
+        _cache_preguntas['expira'] = 0.0
+
+
+# ============================================
+# PROGRAMACIÓN DE NOTIFICACIONES
+# ============================================
+
+@dataclass(frozen=True)
+class PlantillaNotificacion:
+    """Texto de una notificación; el cuerpo lleva {instalacion} (o {cantidad} e {instalaciones} en un resumen)"""
+    tipo: str
+    titulo: str
+    cuerpo: str
+
+
+# Registro de plantillas: las filas programadas solo guardan plantilla_id
+# y el texto se arma al enviar. Un cambio de texto es una plantilla nueva.
+PLANTILLAS_NOTIFICACION = {
+    'encuesta_nueva_v1': PlantillaNotificacion(
+        'nueva', '📋 Nueva Encuesta Disponible',
+        'Tiene una nueva encuesta de satisfacción para {instalacion}'),
+    'encuesta_recordatorio_1_v1': PlantillaNotificacion(
+        'recordatorio_1', '🔔 Recordatorio de Encuesta',
+        'Recuerde completar la encuesta de {instalacion}'),
+    'encuesta_recordatorio_2_v1': PlantillaNotificacion(
+        'recordatorio_2', '⚠️ Último Recordatorio',
+        'La encuesta de {instalacion} vence pronto'),
+}
+
+# Resúmenes por tipo: varias encuestas del mismo tipo para un dispositivo
+# en un solo mensaje (el cuerpo lleva {cantidad} e {instalaciones})
+PLANTILLAS_RESUMEN = {
+    'nueva': PlantillaNotificacion(
+        'nueva', '📋 Nuevas Encuestas Disponibles',
+        'Tiene {cantidad} nuevas encuestas de satisfacción: {instalaciones}'),
+    'recordatorio_1': PlantillaNotificacion(
+        'recordatorio_1', '🔔 Recordatorio de Encuestas',
+        'Recuerde completar {cantidad} encuestas: {instalaciones}'),
+    'recordatorio_2': PlantillaNotificacion(
+        'recordatorio_2', '⚠️ Último Recordatorio',
+        '{cantidad} encuestas vencen pronto: {instalaciones}'),
+}
+
+# Plantillas de las 3 notificaciones de cada encuesta, en orden
+NOTIFICACIONES_ENCUESTA = (
+    'encuesta_nueva_v1',
+    'encuesta_recordatorio_1_v1',
+    'encuesta_recordatorio_2_v1',
+)
+
+
+class CalendarioLaboral:
+    """Días hábiles (dias_laborales sin feriados) de un rango de fechas"""
+    
+    def __init__(self, dias_laborales, feriados, desde, hasta):
+        self.dias_habiles = []
+        dia = desde
+        while dia <= hasta:
+            if dia.weekday() in dias_laborales and dia not in feriados:
+                self.dias_habiles.append(dia)
+            dia += timedelta(days=1)
+    
+    def siguiente_habil(self, dia):
+        """El mismo día si es hábil, si no el siguiente hábil"""
+        i = bisect.bisect_left(self.dias_habiles, dia)
+        if i == len(self.dias_habiles):
+            raise HTTPException(status_code=400, detail=f"No hay días hábiles desde {dia}")
+        return self.dias_habiles[i]
+
+
+@dataclass(frozen=True)
+class EnvioProgramado:
+    """Una de las 3 notificaciones del periodo, antes de asignar usuario"""
+    plantilla_id: str
+    tipo: str
+    fecha_programada: datetime
+
+
+@dataclass(frozen=True)
+class ProgramacionNotificaciones:
+    """Fechas y plantillas de envío de una ejecución de generación"""
+    fecha_limite: datetime
+    envios: tuple
+    
+    def filas_base(self):
+        """Campos comunes de las filas de cada envío (se completan por usuario)"""
+        return [
+            {
+                'plantilla_id': envio.plantilla_id,
+                'tipo': envio.tipo,
+                'fecha_programada': envio.fecha_programada.isoformat(),
+                'estado': 'pendiente',
+                'intentos': 0,
+                'fecha_envio': None,
+                'error_mensaje': None
+            }
+            for envio in self.envios
+        ]
+
+
+def construir_programacion(config, ahora):
+    """
+    Calcula una sola vez por ejecución las fechas de las 3 notificaciones:
+    el día hábil (hora de Chile) en o después del día 1, dia_recordatorio_1
+    y dia_recordatorio_2, a la hora horario_inicio, expresado en UTC.
+    """
+    inicio = ahora.astimezone(TZ_CHILE).date()
+    desfases = (0, config.dia_recordatorio_1 - 1, config.dia_recordatorio_2 - 1)
+    fin = inicio + timedelta(days=max(max(desfases), config.dias_para_responder) + 31)
+    calendario = CalendarioLaboral(
+        config.dias_laborales, obtener_feriados(inicio, fin), inicio, fin
+    )
+    
+    envios = []
+    for plantilla_id, desfase in zip(NOTIFICACIONES_ENCUESTA, desfases):
+        dia = calendario.siguiente_habil(inicio + timedelta(days=desfase))
+        fecha_local = TZ_CHILE.localize(
+            datetime.combine(dia, hora_del_dia(hour=config.horario_inicio))
+        )
+        envios.append(EnvioProgramado(
+            plantilla_id=plantilla_id,
+            tipo=PLANTILLAS_NOTIFICACION[plantilla_id].tipo,
+            fecha_programada=fecha_local.astimezone(pytz.UTC),
+        ))
+    
+    return ProgramacionNotificaciones(
+        fecha_limite=ahora + timedelta(days=config.dias_para_responder),
+        envios=tuple(envios),
     )
-    result = list(client.query(query, job_config=job_config).result())
-    return result[0].email_login if result else None
+
+
+def obtener_feriados(desde, hasta):
+    """Fechas de encuestas_feriados en el rango (vacío si la tabla no existe)"""
+    query = f"""
+    SELECT fecha
+    FROM `{TABLE_ENCUESTAS_FERIADOS}`
+    WHERE fecha BETWEEN @desde AND @hasta
+    """
+    try:
+        filas = ejecutar_consulta("feriados", query, [
+            bigquery.ScalarQueryParameter("desde", "DATE", desde),
+            bigquery.ScalarQueryParameter("hasta", "DATE", hasta),
+        ])
+        return {fila.fecha for fila in filas}
+    except NotFound:
+        log(f"⚠️ No existe {TABLE_ENCUESTAS_FERIADOS}, se programa sin feriados")
+        return set()
+
+
+# ============================================
+# DESPACHO FCM
+# ============================================
+
+class ProveedorTokenFCM:
+    """
+    Access token de FCM compartido por todo el proceso.
+    Reutiliza el token hasta poco antes de que expire y lo renueva una
+    sola vez bajo lock mientras los demás envíos esperan.
+    """
+    
+    def __init__(self, margen_segundos=FCM_MARGEN_TOKEN_SEGUNDOS):
+        self.margen = timedelta(seconds=margen_segundos)
+        self._credenciales = None
+        self._lock = threading.Lock()
+    
+    def obtener_token(self):
+        with self._lock:
+            if self._debe_renovar():
+                self._renovar()
+            return self._credenciales.token
+    
+    def renovar(self, token_rechazado):
+        """Renueva el token si el vigente es el que FCM rechazó (401)"""
+        with self._lock:
+            if self._credenciales is None or self._credenciales.token == token_rechazado:
+                self._renovar()
+            return self._credenciales.token
+    
+    def _debe_renovar(self):
+        credenciales = self._credenciales
+        if credenciales is None or not credenciales.token:
+            return True
+        if credenciales.expiry is None:
+            return False
+        # expiry es UTC sin zona horaria (convención de google-auth)
+        return datetime.utcnow() >= credenciales.expiry - self.margen
+    
+    def _renovar(self):
+        if self._credenciales is None:
+            self._credenciales, _ = google.auth.default(
+                scopes=['https://www.googleapis.com/auth/firebase.messaging']
+            )
+        self._credenciales.refresh(google.auth.transport.requests.Request())
+        log(f"🔑 Token FCM renovado, expira {self._credenciales.expiry}")
+
+
+proveedor_token_fcm = ProveedorTokenFCM()
+
+
+class DespachadorFCM:
+    """
+    Envía mensajes FCM en paralelo sobre una sesión HTTP con keep-alive.
+    Ante 429/503 pausa a todos los workers (Retry-After o backoff
+    exponencial) y reintenta el mensaje; ante 401 reintenta una vez con
+    un token renovado.
+    """
+    
+    def __init__(self, proveedor_token=proveedor_token_fcm,
+                 concurrencia=FCM_CONCURRENCIA, max_reintentos=FCM_MAX_REINTENTOS):
+        self.proveedor_token = proveedor_token
+        self.concurrencia = concurrencia
+        self.max_reintentos = max_reintentos
+        self.sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=concurrencia)
+        self.sesion.mount("https://", adaptador)
+        self.sesion.mount("http://", adaptador)
+        self._lock = threading.Lock()
+        self._pausa_hasta = 0.0
+    
+    def enviar_lote(self, mensajes):
+        """Envía los mensajes y devuelve los resultados en el mismo orden"""
+        if not mensajes:
+            return []
+        with ThreadPoolExecutor(max_workers=self.concurrencia) as pool:
+            # Cada envío corre en el contexto del trabajo (run_id en los logs)
+            futuras = [pool.submit(contextvars.copy_context().run, self._enviar, m) for m in mensajes]
+            return [futura.result() for futura in futuras]
+    
+    def _enviar(self, mensaje):
+        token_renovado = False
+        intento = 0
+        while True:
+            self._esperar_pausa()
+            access_token = self.proveedor_token.obtener_token()
+            resultado = enviar_fcm(
+                fcm_token=mensaje['fcm_token'],
+                titulo=mensaje['titulo'],
+                cuerpo=mensaje['cuerpo'],
+                data=mensaje['data'],
+                access_token=access_token,
+                sesion=self.sesion,
+                topico=mensaje['topico']
+            )
+            if resultado['status_code'] == 401 and not token_renovado:
+                self.proveedor_token.renovar(access_token)
+                token_renovado = True
+                continue
+            if resultado['status_code'] not in (429, 503) or intento == self.max_reintentos:
+                return resultado
+            self._pausar(resultado['retry_after'] or 2 ** intento)
+            intento += 1
+    
+    def _esperar_pausa(self):
+        with self._lock:
+            espera = self._pausa_hasta - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+    
+    def _pausar(self, segundos):
+        segundos = min(segundos, FCM_MAX_ESPERA_SEGUNDOS)
+        log(f"⏳ FCM limitado, pausando envíos {segundos:.1f}s")
+        with self._lock:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+
+
+despachador_fcm = DespachadorFCM()
+
+
+# ============================================
+# TRABAJOS EN SEGUNDO PLANO
+# ============================================
+
+# Los trabajos corren en un pool acotado para no bloquear el event loop
+# (BigQuery y FCM son llamadas bloqueantes). Solo puede haber un trabajo
+# activo por tipo: un segundo disparo del scheduler recibe el existente.
+# Con TRABAJOS_RUTA esto vale entre instancias (lease en Cloud Storage) y
+# el estado se publica para que /api/jobs responda en cualquiera.
+executor_trabajos = ThreadPoolExecutor(
+    max_workers=TRABAJOS_MAX_CONCURRENTES, thread_name_prefix="trabajo"
+)
+_trabajos = {}
+_trabajos_activos = {}
+_lock_trabajos = threading.Lock()
+_lock_lanzamiento = threading.Lock()
+ESTADOS_TERMINADOS = ('completado', 'fallido')
+
+
+class LeaseTrabajo:
+    """
+    Lease entre instancias de un tipo de trabajo: un objeto en TRABAJOS_RUTA
+    que solo se crea si no existe (if_generation_match=0). Se renueva
+    mientras el trabajo corre y se borra al terminar; si la instancia muere,
+    vence a los TRABAJOS_LEASE_SEGUNDOS y otra puede tomarlo.
+    """
+    
+    def __init__(self, tipo):
+        nombre = tipo.replace(':', '_').replace('/', '-')
+        self.ruta = f"{TRABAJOS_RUTA}/leases/{nombre}.json"
+        self.job_id = None
+        self.generacion = None
+        self._detener = threading.Event()
+        self._hilo = None
+    
+    def tomar(self, job_id):
+        """Toma el lease para job_id: None si se tomó, o el job_id que lo tiene"""
+        for _ in range(3):
+            objeto = objeto_gcs(self.ruta)
+            try:
+                self._escribir(objeto, job_id, 0)
+                return None
+            except PreconditionFailed:
+                pass
+            
+            try:
+                objeto.reload()
+                dueno = json.loads(objeto.download_as_bytes(if_generation_match=objeto.generation))
+            except (NotFound, PreconditionFailed):
+                continue  # se liberó o renovó entre medio
+            if dueno['expira'] > time.time():
+                return dueno['job_id']
+            
+            try:
+                self._escribir(objeto, job_id, objeto.generation)
+            except PreconditionFailed:
+                continue
+            log(f"⚠️ Lease vencido de {dueno['job_id']}: lo toma {job_id}", ruta=self.ruta)
+            return None
+        raise HTTPException(status_code=409, detail=f"No se pudo tomar el lease de {self.ruta}")
+    
+    def dueno(self):
+        """job_id que tiene el lease vigente, o None"""
+        try:
+            datos = json.loads(objeto_gcs(self.ruta).download_as_bytes())
+        except NotFound:
+            return None
+        return datos['job_id'] if datos['expira'] > time.time() else None
+    
+    def mantener(self):
+        """Renueva el lease en segundo plano hasta liberar()"""
+        self._hilo = threading.Thread(target=self._renovar, name="lease-trabajo", daemon=True)
+        self._hilo.start()
+    
+    def liberar(self):
+        """Deja de renovar y borra el lease si sigue siendo nuestro"""
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join()
+        try:
+            objeto_gcs(self.ruta).delete(if_generation_match=self.generacion)
+        except (NotFound, PreconditionFailed):
+            pass
+        except Exception as e:
+            log(f"⚠️ No se pudo liberar el lease {self.ruta}: {e}")
+    
+    def _escribir(self, objeto, job_id, generacion):
+        datos = json.dumps({'job_id': job_id, 'expira': time.time() + TRABAJOS_LEASE_SEGUNDOS})
+        objeto.upload_from_string(datos, content_type="application/json", if_generation_match=generacion)
+        self.job_id = job_id
+        self.generacion = objeto.generation
+    
+    def _renovar(self):
+        while not self._detener.wait(TRABAJOS_LEASE_SEGUNDOS / 3):
+            try:
+                self._escribir(objeto_gcs(self.ruta), self.job_id, self.generacion)
+            except PreconditionFailed:
+                log(f"❌ Se perdió el lease {self.ruta} del trabajo {self.job_id}", severidad="ERROR")
+                return
+            except Exception as e:
+                log(f"⚠️ No se pudo renovar el lease {self.ruta}: {e}")
+
+
+def guardar_trabajo_compartido(trabajo):
+    """Publica el estado del trabajo para que cualquier instancia lo consulte"""
+    if not TRABAJOS_RUTA:
+        return
+    with _lock_trabajos:
+        contenido = json.dumps(jsonable_encoder(vista_trabajo(trabajo)))
+    try:
+        objeto_gcs(f"{TRABAJOS_RUTA}/estado/{trabajo['job_id']}.json").upload_from_string(
+            contenido, content_type="application/json"
+        )
+    except Exception as e:
+        log(f"⚠️ No se pudo publicar el estado del trabajo {trabajo['job_id']}: {e}")
+
+
+def leer_trabajo_compartido(job_id):
+    """Estado publicado de un trabajo, o None si no existe"""
+    if not TRABAJOS_RUTA:
+        return None
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return None
+    try:
+        return json.loads(objeto_gcs(f"{TRABAJOS_RUTA}/estado/{job_id}.json").download_as_bytes())
+    except NotFound:
+        return None
+
+
+def lanzar_trabajo(tipo, funcion, **parametros):
+    """
+    Encola un trabajo o devuelve el que ya está activo para ese tipo, en esta
+    instancia o (con TRABAJOS_RUTA) en otra. Un trabajo de otra instancia se
+    devuelve como su estado publicado, sin 'futuro'.
+    """
+    with _lock_lanzamiento:
+        with _lock_trabajos:
+            activo = _trabajos_activos.get(tipo)
+            if activo:
+                return _trabajos[activo], True
+        
+        job_id = str(uuid.uuid4())
+        lease = None
+        if TRABAJOS_RUTA:
+            lease = LeaseTrabajo(tipo)
+            try:
+                dueno = lease.tomar(job_id)
+            except HTTPException:
+                raise
+            except Exception as e:
+                log(f"❌ Error tomando el lease {lease.ruta}: {e}")
+                raise HTTPException(status_code=500, detail=str(e))
+            if dueno:
+                remoto = leer_trabajo_compartido(dueno) or {
+                    'job_id': dueno, 'tipo': tipo, 'estado': 'en_curso', 'progreso': {}
+                }
+                return remoto, True
+            lease.mantener()
+        
+        trabajo = {
+            'job_id': job_id,
+            'tipo': tipo,
+            'estado': 'en_cola',
+            'parametros': parametros,
+            'progreso': {},
+            'consultas': {},
+            'resultado': None,
+            'error': None,
+            'status_code': None,
+            'fecha_creacion': datetime.now(pytz.UTC).isoformat(),
+            'fecha_inicio': None,
+            'fecha_fin': None,
+        }
+        with _lock_trabajos:
+            _trabajos[job_id] = trabajo
+            _trabajos_activos[tipo] = job_id
+            podar_historial_trabajos()
+        # Se publica antes de lanzarlo: el hilo del trabajo publica después
+        guardar_trabajo_compartido(trabajo)
+        with _lock_trabajos:
+            trabajo['futuro'] = executor_trabajos.submit(correr_trabajo, trabajo, funcion, parametros, lease)
+        return trabajo, False
+
+
+def correr_trabajo(trabajo, funcion, parametros, lease=None):
+    """Ejecuta el trabajo registrando estado, progreso y resultado"""
+    publicado = [time.monotonic()]
+    
+    def reportar(**progreso):
+        with _lock_trabajos:
+            trabajo['progreso'].update(progreso)
+            if time.monotonic() - publicado[0] < TRABAJOS_PUBLICACION_SEGUNDOS:
+                return
+            publicado[0] = time.monotonic()
+        guardar_trabajo_compartido(trabajo)
+    
+    with _lock_trabajos:
+        trabajo['estado'] = 'en_curso'
+        trabajo['fecha_inicio'] = datetime.now(pytz.UTC).isoformat()
+    guardar_trabajo_compartido(trabajo)
+    contexto_consumo = _consumo_trabajo.set(trabajo['consultas'])
+    contexto_run_id = _run_id.set(trabajo['job_id'])
+    inicio = time.perf_counter()
+    try:
+        resultado = funcion(reportar=reportar, **parametros)
+        with _lock_trabajos:
+            trabajo['estado'] = 'completado'
+            trabajo['resultado'] = resultado
+    except HTTPException as e:
+        with _lock_trabajos:
+            trabajo['estado'] = 'fallido'
+            trabajo['error'] = e.detail
+            trabajo['status_code'] = e.status_code
+    except Exception as e:
+        log(f"❌ Error en trabajo {trabajo['job_id']}: {e}")
+        with _lock_trabajos:
+            trabajo['estado'] = 'fallido'
+            trabajo['error'] = str(e)
+            trabajo['status_code'] = 500
+    finally:
+        segundos = time.perf_counter() - inicio
+        with _lock_trabajos:
+            trabajo['fecha_fin'] = datetime.now(pytz.UTC).isoformat()
+            _trabajos_activos.pop(trabajo['tipo'], None)
+            consultas = {op: dict(total) for op, total in trabajo['consultas'].items()}
+        # El estado final queda publicado antes de soltar el lease
+        guardar_trabajo_compartido(trabajo)
+        if lease:
+            lease.liberar()
+        metrica_trabajo_segundos.observar(
+            segundos, tipo=trabajo['tipo'].split(':')[0], estado=trabajo['estado']
+        )
+        log(f"🏁 Trabajo {trabajo['tipo']} {trabajo['estado']} en {segundos:.1f}s",
+            tipo=trabajo['tipo'], estado=trabajo['estado'], segundos=segundos, consultas=consultas)
+        _run_id.reset(contexto_run_id)
+        _consumo_trabajo.reset(contexto_consumo)
+
+
+def podar_historial_trabajos():
+    """Descarta los trabajos terminados más antiguos (llamar con el lock tomado)"""
+    terminados = [
+        job_id for job_id, t in _trabajos.items()
+        if t['estado'] in ESTADOS_TERMINADOS
+    ]
+    for job_id in terminados[:max(0, len(_trabajos) - TRABAJOS_HISTORIAL_MAX)]:
+        del _trabajos[job_id]
+
+
+def vista_trabajo(trabajo):
+    """Representación JSON de un trabajo (llamar con el lock tomado)"""
+    vista = {k: v for k, v in trabajo.items() if k != 'futuro'}
+    vista['progreso'] = dict(trabajo['progreso'])
+    vista['consultas'] = {op: dict(total) for op, total in trabajo['consultas'].items()}
+    return vista
+
+
+async def esperar_trabajo_compartido(tipo, job_id):
+    """Sondea el estado publicado de un trabajo de otra instancia hasta que termine"""
+    lease = LeaseTrabajo(tipo)
+    while True:
+        trabajo = await run_in_threadpool(leer_trabajo_compartido, job_id)
+        if trabajo and trabajo['estado'] in ESTADOS_TERMINADOS:
+            return trabajo
+        if await run_in_threadpool(lease.dueno) != job_id:
+            # Sin lease: o terminó recién, o su instancia murió
+            trabajo = await run_in_threadpool(leer_trabajo_compartido, job_id)
+            if trabajo and trabajo['estado'] in ESTADOS_TERMINADOS:
+                return trabajo
+            raise HTTPException(status_code=500, detail=f"Trabajo {job_id} interrumpido en otra instancia")
+        await asyncio.sleep(TRABAJOS_SONDEO_SEGUNDOS)
+
+
+async def despachar_trabajo(tipo, funcion, esperar, **parametros):
+    """Lanza el trabajo y responde con su id, o con el resultado si esperar=True"""
+    trabajo, duplicado = await run_in_threadpool(lanzar_trabajo, tipo, funcion, **parametros)
+    if duplicado:
+        log(f"⚠️ Ya hay un trabajo {tipo} en curso: {trabajo['job_id']}")
+    
+    if 'futuro' not in trabajo:
+        # Corre en otra instancia: solo se conoce su estado publicado
+        if esperar:
+            trabajo = await esperar_trabajo_compartido(tipo, trabajo['job_id'])
+            if trabajo['estado'] == 'fallido':
+                raise HTTPException(status_code=trabajo['status_code'] or 500, detail=trabajo['error'])
+            return trabajo['resultado']
+        return JSONResponse(status_code=202, content=jsonable_encoder({**trabajo, "duplicado": True}))
+    
+    if esperar:
+        await asyncio.wrap_future(trabajo['futuro'])
+        with _lock_trabajos:
+            if trabajo['estado'] == 'fallido':
+                raise HTTPException(status_code=trabajo['status_code'], detail=trabajo['error'])
+            return trabajo['resultado']
+    
+    with _lock_trabajos:
+        contenido = {**vista_trabajo(trabajo), "duplicado": duplicado}
+    return JSONResponse(status_code=202, content=jsonable_encoder(contenido))
+
 
 # ============================================
 # EJECUTAR
@@ -0,0 +1,124 @@
+"""
+Métricas en memoria con exposición en formato de texto de Prometheus
+(contadores e histogramas con etiquetas), sin dependencias externas.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+# Buckets en segundos (los de Prometheus más 30 y 60 para jobs de BigQuery)
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrica:
+    """Base: nombre, ayuda, etiquetas y valores por combinación de etiquetas"""
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def _clave(self, etiquetas):
+        if set(etiquetas) != set(self.etiquetas):
+            raise ValueError(f"{self.nombre} espera etiquetas {self.etiquetas}, recibió {tuple(etiquetas)}")
+        return tuple(str(etiquetas[e]) for e in self.etiquetas)
+
+    def _formatear_etiquetas(self, clave, extra=()):
+        pares = list(zip(self.etiquetas, clave)) + list(extra)
+        if not pares:
+            return ""
+        return "{" + ",".join(f'{k}="{escapar(v)}"' for k, v in pares) + "}"
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with self._lock:
+            valores = sorted(self._valores.items())
+        for clave, valor in valores:
+            lineas.extend(self._lineas(clave, valor))
+        return lineas
+
+
+class Contador(Metrica):
+    tipo = "counter"
+
+    def inc(self, valor=1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def _lineas(self, clave, valor):
+        return [f"{self.nombre}{self._formatear_etiquetas(clave)} {valor}"]
+
+
+class Histograma(Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, valor, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            conteos, suma, total = self._valores.get(clave, ([0] * len(self.buckets), 0.0, 0))
+            conteos = [c + (valor <= limite) for c, limite in zip(conteos, self.buckets)]
+            self._valores[clave] = (conteos, suma + valor, total + 1)
+
+    @contextmanager
+    def medir(self, **etiquetas):
+        """Observa la duración del bloque en segundos"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **etiquetas)
+
+    def _lineas(self, clave, valor):
+        conteos, suma, total = valor
+        lineas = [
+            f"{self.nombre}_bucket{self._formatear_etiquetas(clave, [('le', formatear_numero(limite))])} {conteo}"
+            for limite, conteo in zip(self.buckets, conteos)
+        ]
+        lineas.append(f"{self.nombre}_bucket{self._formatear_etiquetas(clave, [('le', '+Inf')])} {total}")
+        lineas.append(f"{self.nombre}_sum{self._formatear_etiquetas(clave)} {suma}")
+        lineas.append(f"{self.nombre}_count{self._formatear_etiquetas(clave)} {total}")
+        return lineas
+
+
+class Registro:
+    """Conjunto de métricas que se exponen juntas en /metrics"""
+
+    def __init__(self):
+        self._metricas = []
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._agregar(Contador(nombre, ayuda, etiquetas))
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEGUNDOS):
+        return self._agregar(Histograma(nombre, ayuda, etiquetas, buckets))
+
+    def _agregar(self, metrica):
+        self._metricas.append(metrica)
+        return metrica
+
+    def exponer(self):
+        """Texto en formato de exposición de Prometheus 0.0.4"""
+        lineas = []
+        for metrica in self._metricas:
+            lineas.extend(metrica.exponer())
+        return "\n".join(lineas) + "\n"
+
+
+def escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formatear_numero(valor):
+    return repr(float(valor))
+
+
+registro = Registro()